@@ -76,12 +76,14 @@ __mic_complete_opt()
     "
     loop_exts="
         --shrink
+        --build-from-dir
         --compress-image=
         --compress-disk-image=
     "
     raw_exts="
         --fstab-entry=
         --generate-bmap
+        --build-from-dir
         --compress-image=
         --compress-disk-image=
     "
@@ -141,11 +143,15 @@ __mic_complete_val()
         gz
         bz2
         lzo
+        xz
+        zst
     "
     compress_disk_image_values="
         gz
         bz2
         lzo
+        xz
+        zst
     "
 
     declare -F _split_longopt &>/dev/null && _split_longopt
@@ -214,6 +220,7 @@ __mic_main ()
         create
         chroot
         convert
+        cache
     "
     alias="
         cr
@@ -243,6 +250,13 @@ __mic_main ()
         --copy-kernel
         --check-pkgs=
         --record-pkgs=
+        --download-threads=
+        --compress-level=
+        --compress-threads=
+        --profile
+        --no-rootfs-cache
+        --no-squashfs-cache
+        --refresh-metadata
         --install-pkgs=
         --local-pkgs-path=
     "
@@ -252,6 +266,9 @@ __mic_main ()
     chroot_opts="
         --saveto=
     "
+    cache_opts="
+        --max-size=
+    "
     help_opts="
     "
 
@@ -263,6 +280,7 @@ __mic_main ()
         livecd
         liveusb
         loop
+        multi
         raw
     "
     convert_args="
@@ -274,10 +292,15 @@ __mic_main ()
     "
     chroot_args="
     "
+    cache_args="
+        stats
+        prune
+    "
     help_args="
         create
         convert
         chroot
+        cache
     "
 
     local cur prev words cword
@@ -25,11 +25,12 @@
 """ Compression and Archiving
 
 Utility functions for creating archive files (tarballs, zip files, etc)
-and compressing files (gzip, bzip2, lzop, etc)
+and compressing files (gzip, bzip2, lzop, xz, zstd, etc)
 """
 
 import os
 import shutil
+import hashlib
 import tempfile
 import subprocess
 from mic import msger
@@ -37,6 +38,7 @@ from mic import msger
 __all__ = [
             "get_compress_formats",
             "compress",
+            "compress_sparse",
             "decompress",
             "get_archive_formats",
             "get_archive_suffixes",
@@ -82,11 +84,54 @@ def _call_external(cmdln_or_args):
 
     return (proc.returncode, outdata, errdata)
 
-def _do_gzip(input_name, compression=True):
+# the valid compression levels of each format
+_COMPRESS_LEVELS = {
+    "gz" :  (1, 9),
+    "bz2":  (1, 9),
+    "lzo":  (1, 9),
+    "xz" :  (0, 9),
+    "zst":  (1, 22),
+}
+
+def check_compress_level(compress_format, level):
+    """ Check the compression level of a format, raise ValueError if it is
+    out of the range of the format
+
+    @compress_format: the compression format
+    @level: the compression level, None for the default of the compressor
+    """
+    if level is None:
+        return
+
+    low, high = _COMPRESS_LEVELS[compress_format]
+    if not isinstance(level, (int, long)) or not low <= level <= high:
+        raise ValueError, "invalid '%s' compress level '%s', it should be " \
+                          "within [%d, %d]" % (compress_format, level,
+                                               low, high)
+
+def _get_level_opts(compress_format, level):
+    """ Get the command line options to set the compression level
+
+    @compress_format: the compression format
+    @level: the compression level, None for the default of the compressor
+    @retval: a list of command line options
+    """
+    if level is None:
+        return []
+
+    check_compress_level(compress_format, level)
+
+    if compress_format == "zst" and level > 19:
+        return ["--ultra", "-%d" % level]
+    return ["-%d" % level]
+
+def _do_gzip(input_name, compression=True, level=None, threads=None):
     """ Compress/decompress the file with 'gzip' utility.
 
     @input_name: the file name to compress/decompress
     @compress: True for compressing, False for decompressing
+    @level: the compression level, None for the default
+    @threads: the number of threads for 'pigz', None or 0 for all CPUs
     @retval: the path of the compressed/decompressed file
     """
     if which("pigz") is not None:
@@ -95,7 +140,10 @@ def _do_gzip(input_name, compression=True):
         compressor = "gzip"
 
     if compression:
-        cmdln = [compressor, "-f", input_name]
+        cmdln = [compressor, "-f"] + _get_level_opts("gz", level)
+        if threads and compressor == "pigz":
+            cmdln.extend(["-p", str(threads)])
+        cmdln.append(input_name)
     else:
         cmdln = [compressor, "-d", "-f", input_name]
 
@@ -109,11 +157,13 @@ def _do_gzip(input_name, compression=True):
 
     return output_name
 
-def _do_bzip2(input_name, compression=True):
+def _do_bzip2(input_name, compression=True, level=None, threads=None):
     """ Compress/decompress the file with 'bzip2' utility.
 
     @input_name: the file name to compress/decompress
     @compress: True for compressing, False for decompressing
+    @level: the compression level, None for the default
+    @threads: the number of threads for 'pbzip2', None or 0 for all CPUs
     @retval: the path of the compressed/decompressed file
     """
     if which("pbzip2") is not None:
@@ -122,7 +172,10 @@ def _do_bzip2(input_name, compression=True):
         compressor = "bzip2"
 
     if compression:
-        cmdln = [compressor, "-f", input_name]
+        cmdln = [compressor, "-f"] + _get_level_opts("bz2", level)
+        if threads and compressor == "pbzip2":
+            cmdln.append("-p%d" % threads)
+        cmdln.append(input_name)
     else:
         cmdln = [compressor, "-d", "-f", input_name]
 
@@ -136,17 +189,20 @@ def _do_bzip2(input_name, compression=True):
 
     return output_name
 
-def _do_lzop(input_name, compression=True):
+def _do_lzop(input_name, compression=True, level=None, threads=None):
     """ Compress/decompress the file with 'lzop' utility.
 
     @input_name: the file name to compress/decompress
     @compress: True for compressing, False for decompressing
+    @level: the compression level, None for the default
+    @threads: ignored, 'lzop' is single-threaded
     @retval: the path of the compressed/decompressed file
     """
     compressor = "lzop"
 
     if compression:
-        cmdln = [compressor, "-f", "-U", input_name]
+        cmdln = [compressor, "-f", "-U"] + _get_level_opts("lzo", level)
+        cmdln.append(input_name)
     else:
         cmdln = [compressor, "-d", "-f", "-U", input_name]
 
@@ -160,19 +216,82 @@ def _do_lzop(input_name, compression=True):
 
     return output_name
 
+def _do_xz(input_name, compression=True, level=None, threads=None):
+    """ Compress/decompress the file with 'xz' utility.
+
+    @input_name: the file name to compress/decompress
+    @compress: True for compressing, False for decompressing
+    @level: the compression level, None for the default
+    @threads: the number of threads, None or 0 for all CPUs
+    @retval: the path of the compressed/decompressed file
+    """
+    compressor = "xz"
+
+    if compression:
+        cmdln = [compressor, "-f", "-T%d" % (threads or 0)]
+        cmdln.extend(_get_level_opts("xz", level))
+        cmdln.append(input_name)
+    else:
+        cmdln = [compressor, "-d", "-f", input_name]
+
+    _call_external(cmdln)
+
+    if compression:
+        output_name = input_name + ".xz"
+    else:
+        # suppose that file name is suffixed with ".xz"
+        output_name = os.path.splitext(input_name)[0]
+
+    return output_name
+
+def _do_zstd(input_name, compression=True, level=None, threads=None):
+    """ Compress/decompress the file with 'zstd' utility.
+
+    @input_name: the file name to compress/decompress
+    @compress: True for compressing, False for decompressing
+    @level: the compression level, None for the default
+    @threads: the number of threads, None or 0 for all CPUs
+    @retval: the path of the compressed/decompressed file
+    """
+    compressor = "zstd"
+
+    # unlike the other compressors zstd keeps the input file by default
+    if compression:
+        cmdln = [compressor, "-q", "-f", "--rm", "-T%d" % (threads or 0)]
+        cmdln.extend(_get_level_opts("zst", level))
+        cmdln.append(input_name)
+    else:
+        cmdln = [compressor, "-q", "-d", "-f", "--rm", input_name]
+
+    _call_external(cmdln)
+
+    if compression:
+        output_name = input_name + ".zst"
+    else:
+        # suppose that file name is suffixed with ".zst"
+        output_name = os.path.splitext(input_name)[0]
+
+    return output_name
+
 _COMPRESS_SUFFIXES = {
     ".lzo"     : [".lzo"],
     ".gz"      : [".gz"],
     ".bz2"     : [".bz2", ".bz"],
+    ".xz"      : [".xz"],
+    ".zst"     : [".zst"],
     ".tar.lzo" : [".tar.lzo", ".tzo"],
     ".tar.gz"  : [".tar.gz", ".tgz", ".taz"],
     ".tar.bz2" : [".tar.bz2", ".tbz", ".tbz2", ".tar.bz"],
+    ".tar.xz"  : [".tar.xz", ".txz"],
+    ".tar.zst" : [".tar.zst", ".tzst"],
 }
 
 _COMPRESS_FORMATS = {
     "gz" :  _do_gzip,
     "bz2":  _do_bzip2,
     "lzo":  _do_lzop,
+    "xz" :  _do_xz,
+    "zst":  _do_zstd,
 }
 
 def get_compress_formats():
@@ -195,11 +314,24 @@ def get_compress_suffixes():
 
     return suffixes
 
-def compress(file_path, compress_format):
+def get_compress_format(file_name):
+    """ Get the compression format of a compressed file or tarball
+
+    @file_name: the name of the file
+    @retval: the compression format, None if it isn't compressed
+    """
+    for key, suffixes in _COMPRESS_SUFFIXES.iteritems():
+        if filter(file_name.endswith, suffixes):
+            return key.rsplit(".", 1)[1]
+    return None
+
+def compress(file_path, compress_format, level=None, threads=None):
     """ Compress a given file
 
     @file_path: the path of the file to compress
     @compress_format: the compression format
+    @level: the compression level, None for the default of the format
+    @threads: the number of compressing threads, None or 0 for all CPUs
     @retval: the path of the compressed file
     """
     if not os.path.isfile(file_path):
@@ -209,7 +341,180 @@ def compress(file_path, compress_format):
         func = _COMPRESS_FORMATS[compress_format]
     except KeyError:
         raise ValueError, "unknown compress format '%s'" % compress_format
-    return func(file_path, True)
+    return func(file_path, True, level, threads)
+
+# the size of the chunks piped into the compressor by compress_sparse()
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# command lines compressing stdin to stdout, parallel implementations first
+_STREAM_COMPRESSORS = {
+    "gz" :  (["pigz", "-c"], ["gzip", "-c"]),
+    "bz2":  (["pbzip2", "-c"], ["bzip2", "-c"]),
+    "lzo":  (["lzop", "-c"], ),
+    "xz" :  (["xz", "-c"], ),
+    "zst":  (["zstd", "-q", "-c"], ),
+}
+
+# options to set the number of threads of a compressor, 0 means all CPUs
+_THREADS_OPTS = {
+    "pigz"  : lambda threads: threads and ["-p", str(threads)] or [],
+    "pbzip2": lambda threads: threads and ["-p%d" % threads] or [],
+    "xz"    : lambda threads: ["-T%d" % threads],
+    "zstd"  : lambda threads: ["-T%d" % threads],
+}
+
+def _get_stream_compressor(compress_format, level=None, threads=None):
+    """ Get the command line to compress stdin in 'compress_format'
+
+    @compress_format: the compression format
+    @level: the compression level, None for the default
+    @threads: the number of threads, None or 0 for all CPUs
+    @retval: the command line as a list, None if no compressor is available
+    """
+    try:
+        candidates = _STREAM_COMPRESSORS[compress_format]
+    except KeyError:
+        raise ValueError, "unknown compress format '%s'" % compress_format
+
+    for cmdln in candidates:
+        if which(cmdln[0]) is not None:
+            cmdln = cmdln + _get_level_opts(compress_format, level)
+            if cmdln[0] in _THREADS_OPTS:
+                cmdln.extend(_THREADS_OPTS[cmdln[0]](threads or 0))
+            return cmdln
+    return None
+
+def _get_block_ranges(file_obj):
+    """ Split 'file_obj' into ranges of mapped blocks and holes
+
+    @file_obj: the file object to split
+    @retval: a tuple (block size, image size, generator of (first, last,
+             mapped) block ranges), None if holes can't be detected
+    """
+    import logging
+    from mic.utils import Filemap
+
+    log = logging.getLogger(__name__)
+    if not log.handlers:
+        log.addHandler(logging.NullHandler())
+
+    try:
+        fmap = Filemap.filemap(file_obj, log)
+    except (Filemap.Error, Filemap.ErrorNotSupp):
+        return None
+
+    def _iter_ranges():
+        pos = 0
+        for first, last in fmap.get_mapped_ranges(0, fmap.blocks_cnt):
+            if first > pos:
+                yield (pos, first - 1, False)
+            yield (first, last, True)
+            pos = last + 1
+        if pos < fmap.blocks_cnt:
+            yield (pos, fmap.blocks_cnt - 1, False)
+
+    return (fmap.block_size, fmap.image_size, _iter_ranges())
+
+def compress_sparse(file_path, compress_format, chksum_type=None,
+                    remove=True, level=None, threads=None):
+    """ Compress a given file in one pass, without reading its holes
+
+    Only the mapped extents of the file are read, the holes are piped into
+    the compressor as zeroes, so the result is the same as of compress().
+    If holes can't be detected the whole file is read and no checksums
+    are calculated.
+
+    @file_path: the path of the file to compress
+    @compress_format: the compression format
+    @chksum_type: the hash type to calculate for each range of mapped
+                  blocks from the same read, None for no checksums
+    @remove: remove the original file after compressing
+    @level: the compression level, None for the default of the format
+    @threads: the number of compressing threads, None or 0 for all CPUs
+    @retval: a tuple (path of the compressed file, list of (first, last,
+             checksum) mapped block ranges or None)
+    """
+    if not os.path.isfile(file_path):
+        raise OSError, "can't compress a file not existed: '%s'" % file_path
+
+    cmdln = _get_stream_compressor(compress_format, level, threads)
+    if cmdln is None:
+        raise OSError, "no compressor found for '%s'" % compress_format
+
+    output_name = file_path + "." + compress_format
+    f_in = open(file_path, "rb")
+    try:
+        ranges = _get_block_ranges(f_in)
+        if ranges is None:
+            # read the whole file as one range, the block map is unknown
+            image_size = os.path.getsize(file_path)
+            block_size, ranges = max(image_size, 1), [(0, 0, True)]
+            chksum_type = None
+        else:
+            block_size, image_size, ranges = ranges
+        msger.info("Running command: " + " ".join(cmdln) + " < " + file_path)
+
+        f_out = open(output_name, "wb")
+        try:
+            proc = subprocess.Popen(cmdln, stdin=subprocess.PIPE,
+                                    stdout=f_out)
+        finally:
+            f_out.close()
+
+        chksums = None
+        if chksum_type:
+            chksums = []
+        zeroes = None
+        try:
+            for first, last, mapped in ranges:
+                start = first * block_size
+                length = min((last + 1) * block_size, image_size) - start
+                if mapped:
+                    f_in.seek(start)
+                    if chksum_type:
+                        hash_obj = hashlib.new(chksum_type)
+                elif zeroes is None:
+                    zeroes = '\0' * STREAM_CHUNK_SIZE
+
+                while length > 0:
+                    chunk_size = min(length, STREAM_CHUNK_SIZE)
+                    if mapped:
+                        chunk = f_in.read(chunk_size)
+                        if not chunk:
+                            raise OSError, "unexpected end of file: '%s'" \
+                                           % file_path
+                        chunk_size = len(chunk)
+                        if chksum_type:
+                            hash_obj.update(chunk)
+                    elif chunk_size == STREAM_CHUNK_SIZE:
+                        chunk = zeroes
+                    else:
+                        chunk = zeroes[:chunk_size]
+
+                    proc.stdin.write(chunk)
+                    length -= chunk_size
+
+                if mapped and chksum_type:
+                    chksums.append((first, last, hash_obj.hexdigest()))
+
+            proc.stdin.close()
+        except:
+            proc.stdin.close()
+            proc.wait()
+            os.unlink(output_name)
+            raise
+
+        if proc.wait() != 0:
+            os.unlink(output_name)
+            raise OSError, "failed to compress '%s' with %s" \
+                           % (file_path, cmdln[0])
+    finally:
+        f_in.close()
+
+    if remove:
+        os.unlink(file_path)
+
+    return (output_name, chksums)
 
 def decompress(file_path, decompress_format=None):
     """ Decompess a give file
@@ -298,12 +603,15 @@ def _imp_tarfile(archive_name, target_name):
     tar.close()
     return archive_name
 
-def _make_tarball(archive_name, target_name, compressor=None):
+def _make_tarball(archive_name, target_name, compressor=None, level=None,
+                  threads=None):
     """ Create a tarball from all the files under 'target_name' or itself.
 
     @archive_name: the name of the archived file to create
     @target_name: the directory or the file name to archive
     @compressor: callback function to compress the tarball
+    @level: the compression level, None for the default
+    @threads: the number of compressing threads, None or 0 for all CPUs
     @retval: indicate the compressing result
     """
     archive_dir = os.path.dirname(archive_name)
@@ -315,7 +623,7 @@ def _make_tarball(archive_name, target_name, compressor=None):
         _imp_tarfile(tarball_name, target_name)
 
     if compressor:
-        tarball_name = compressor(tarball_name, True)
+        tarball_name = compressor(tarball_name, True, level, threads)
 
     shutil.move(tarball_name, archive_name)
 
@@ -362,6 +670,8 @@ _ARCHIVE_SUFFIXES = {
     "lzotar": [".tzo", ".tar.lzo"],
     "gztar" : [".tgz", ".taz", ".tar.gz"],
     "bztar" : [".tbz", ".tbz2", ".tar.bz", ".tar.bz2"],
+    "xztar" : [".txz", ".tar.xz"],
+    "zsttar": [".tzst", ".tar.zst"],
 }
 
 _ARCHIVE_FORMATS = {
@@ -370,6 +680,8 @@ _ARCHIVE_FORMATS = {
     "lzotar": ( _make_tarball, {"compressor" : _do_lzop} ),
     "gztar" : ( _make_tarball, {"compressor" : _do_gzip} ),
     "bztar" : ( _make_tarball, {"compressor" : _do_bzip2} ),
+    "xztar" : ( _make_tarball, {"compressor" : _do_xz} ),
+    "zsttar": ( _make_tarball, {"compressor" : _do_zstd} ),
 }
 
 def get_archive_formats():
@@ -392,11 +704,13 @@ def get_archive_suffixes():
 
     return suffixes
 
-def make_archive(archive_name, target_name):
+def make_archive(archive_name, target_name, level=None, threads=None):
     """ Create an archive file (eg. tar or zip).
 
     @archive_name: the name of the archived file
     @target_name: the directory or the file to archive
+    @level: the compression level of compressed tarballs
+    @threads: the number of compressing threads, None or 0 for all CPUs
     @retval: the archiving result
     """
     if not os.path.exists(target_name):
@@ -421,6 +735,9 @@ def make_archive(archive_name, target_name):
     if not os.path.exists(archive_dir):
         os.makedirs(archive_dir)
 
+    if kwargs.get("compressor"):
+        kwargs = dict(kwargs, level=level, threads=threads)
+
     return func(archive_name, target_name, **kwargs)
 
 def extract_archive(archive_name, target_name):
@@ -20,7 +20,7 @@ import ConfigParser
 
 from mic import msger
 from mic import kickstart
-from mic.utils import misc, runner, proxy, errors
+from mic.utils import misc, runner, proxy, errors, fs_related
 
 
 DEFAULT_GSITECONF = '/etc/mic/mic.conf'
@@ -75,6 +75,22 @@ class ConfigMgr(object):
                     "extrarepos": {},
                     "ignore_ksrepo": False,
                     "strict_mode": False,
+                    "download_threads": 4,
+                    "metadata_ttl": 0,
+                    "refresh_metadata": False,
+                    "compress_level": None,
+                    "compress_threads": 0,
+                    "pkgcache_max_size": 0,
+                    "rootfs_cache": True,
+                    "rootfs_cache_max_size": 8192,
+                    "rootfs_cache_max_age": 7,
+                    "squashfs_compressor": None,
+                    "squashfs_block_size": None,
+                    "squashfs_processors": None,
+                    "squashfs_mem": None,
+                    "squashfs_cache": True,
+                    "squashfs_cache_max_size": 4096,
+                    "profile": False,
                 },
                 'chroot': {
                     "saveto": None,
@@ -182,6 +198,71 @@ class ConfigMgr(object):
 
         proxy.set_proxies(self.create['proxy'], self.create['no_proxy'])
 
+        try:
+            self.create['download_threads'] = \
+                    int(self.create['download_threads'])
+        except ValueError:
+            raise errors.ConfigError("%s: download_threads should be an "
+                                     "integer" % siteconf)
+
+        try:
+            self.create['metadata_ttl'] = int(self.create['metadata_ttl'])
+        except ValueError:
+            raise errors.ConfigError("%s: metadata_ttl should be an integer"
+                                     % siteconf)
+
+        try:
+            if self.create['compress_level'] not in (None, ''):
+                self.create['compress_level'] = \
+                        int(self.create['compress_level'])
+            else:
+                self.create['compress_level'] = None
+            self.create['compress_threads'] = \
+                    int(self.create['compress_threads'])
+        except ValueError:
+            raise errors.ConfigError("%s: compress_level and compress_threads "
+                                     "should be integers" % siteconf)
+
+        try:
+            self.create['pkgcache_max_size'] = \
+                    int(self.create['pkgcache_max_size'])
+        except ValueError:
+            raise errors.ConfigError("%s: pkgcache_max_size should be an "
+                                     "integer" % siteconf)
+
+        try:
+            self.create['rootfs_cache_max_size'] = \
+                    int(self.create['rootfs_cache_max_size'])
+            self.create['rootfs_cache_max_age'] = \
+                    int(self.create['rootfs_cache_max_age'])
+        except ValueError:
+            raise errors.ConfigError("%s: rootfs_cache_max_size and "
+                                     "rootfs_cache_max_age should be integers"
+                                     % siteconf)
+
+        try:
+            self.create['squashfs_cache_max_size'] = \
+                    int(self.create['squashfs_cache_max_size'])
+            if self.create['squashfs_processors'] not in (None, ''):
+                self.create['squashfs_processors'] = \
+                        int(self.create['squashfs_processors'])
+            else:
+                self.create['squashfs_processors'] = None
+        except ValueError:
+            raise errors.ConfigError("%s: squashfs_cache_max_size and "
+                                     "squashfs_processors should be integers"
+                                     % siteconf)
+
+        for name in ('squashfs_compressor', 'squashfs_block_size',
+                     'squashfs_mem'):
+            if self.create[name] == '':
+                self.create[name] = None
+        if self.create['squashfs_compressor'] not in \
+                (None,) + fs_related.SQUASHFS_COMPRESSORS:
+            raise errors.ConfigError("%s: squashfs_compressor should be one "
+                                     "of %s" % (siteconf,
+                                     ", ".join(fs_related.SQUASHFS_COMPRESSORS)))
+
         # bootstrap option handling
         self.set_runtime(self.create['runtime'])
         if isinstance(self.bootstrap['packages'], basestring):
@@ -236,9 +317,14 @@ class ConfigMgr(object):
                 repourl = "/%s" % repourl.lstrip('/')
                 self.create['localrepos'].append(repourl)
 
+        ttl = self.create['metadata_ttl']
+        if self.create['refresh_metadata']:
+            ttl = 0
         self.create['repomd'] = misc.get_metadata_from_repos(
-                                                    ksrepos,
-                                                    self.create['cachedir'])
+                                            ksrepos,
+                                            self.create['cachedir'],
+                                            self.create['download_threads'],
+                                            ttl)
         msger.raw(" DONE")
 
         target_archlist, archlist = misc.get_arch(self.create['repomd'])
@@ -19,7 +19,7 @@ import os, sys, re
 import pwd
 from optparse import SUPPRESS_HELP
 
-from mic import msger
+from mic import msger, archive
 from mic.utils import cmdln, errors, rpmmisc
 from mic.conf import configmgr
 from mic.plugin import pluginmgr
@@ -129,6 +129,36 @@ class Creator(cmdln.Cmdln):
         optparser.add_option('', '--ignore-ksrepo', action='store_true',
                              dest='ignore_ksrepo', default=False,
                              help=SUPPRESS_HELP)
+        optparser.add_option('', '--download-threads', type='int',
+                             dest='download_threads', default=None,
+                             help='Number of packages and repo metadata '
+                                  'files to download concurrently')
+        optparser.add_option('', '--compress-level', type='int',
+                             dest='compress_level', default=None,
+                             help='Compression level of compressed images '
+                                  'and archives')
+        optparser.add_option('', '--compress-threads', type='int',
+                             dest='compress_threads', default=None,
+                             help='Number of threads to compress images '
+                                  'and archives, 0 means all CPUs')
+        optparser.add_option('', '--no-rootfs-cache', action='store_false',
+                             dest='rootfs_cache', default=True,
+                             help='Install the packages even if an install '
+                                  'root of the same packages is cached')
+        optparser.add_option('', '--no-squashfs-cache', action='store_false',
+                             dest='squashfs_cache', default=True,
+                             help='Squash the image of live images even if '
+                                  'the squashfs image of the same image is '
+                                  'cached')
+        optparser.add_option('', '--refresh-metadata', action='store_true',
+                             dest='refresh_metadata', default=False,
+                             help='Check the metadata of the repos and '
+                                  'rebuild their caches, even if cached '
+                                  'recently')
+        optparser.add_option('', '--profile', action='store_true',
+                             dest='profile', default=False,
+                             help='Profile the phases of the creation, and '
+                                  'save a timing report next to the manifest')
         optparser.add_option('', '--strict-mode', action='store_true',
                              dest='strict_mode', default=False,
                              help='Abort creation of image, if there are some errors'
@@ -232,6 +262,28 @@ class Creator(cmdln.Cmdln):
 
         if self.options.strict_mode:
           configmgr.create['strict_mode'] = self.options.strict_mode
+        if self.options.download_threads is not None:
+            if self.options.download_threads < 1:
+                raise errors.Usage('Invalid download threads: %d, it should '
+                                   'be a positive integer' \
+                                   % self.options.download_threads)
+            configmgr.create['download_threads'] = self.options.download_threads
+        if self.options.compress_level is not None:
+            configmgr.create['compress_level'] = self.options.compress_level
+        if self.options.compress_threads is not None:
+            if self.options.compress_threads < 0:
+                raise errors.Usage('Invalid compress threads: %d, it should '
+                                   'not be negative' \
+                                   % self.options.compress_threads)
+            configmgr.create['compress_threads'] = self.options.compress_threads
+        if self.options.profile:
+            configmgr.create['profile'] = True
+        if not self.options.rootfs_cache:
+            configmgr.create['rootfs_cache'] = False
+        if not self.options.squashfs_cache:
+            configmgr.create['squashfs_cache'] = False
+        if self.options.refresh_metadata:
+            configmgr.create['refresh_metadata'] = True
         if self.options.arch is not None:
             supported_arch = sorted(rpmmisc.archPolicies.keys(), reverse=True)
             if self.options.arch in supported_arch:
@@ -251,6 +303,15 @@ class Creator(cmdln.Cmdln):
         if self.options.pack_to is not None:
             configmgr.create['pack_to'] = self.options.pack_to
 
+        if configmgr.create['pack_to']:
+            pack_format = archive.get_compress_format(configmgr.create['pack_to'])
+            if pack_format:
+                try:
+                    archive.check_compress_level(pack_format,
+                                                 configmgr.create['compress_level'])
+                except ValueError, err:
+                    raise errors.Usage(str(err))
+
         if self.options.copy_kernel:
             configmgr.create['copy_kernel'] = self.options.copy_kernel
 
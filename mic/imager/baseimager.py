@@ -34,7 +34,8 @@ import rpm
 from mic import kickstart
 from mic import msger, __version__ as VERSION
 from mic.utils.errors import CreatorError, Abort
-from mic.utils import misc, grabber, runner, fs_related as fs
+from mic.utils import misc, grabber, runner, sparsecopy, profiler, rootfscache
+from mic.utils import fs_related as fs
 from mic.chroot import kill_proc_inchroot
 from mic.archive import get_archive_suffixes
 
@@ -85,6 +86,21 @@ class BaseImageCreator(object):
         self.strict_mode = False
         self._local_pkgs_path = None
         self.pack_to = None
+        self.compress_level = None
+        self.compress_threads = 0
+        self.download_threads = 0
+        self.profile = False
+        self.rootfs_cache = True
+        self.rootfs_cache_max_size = 0
+        self.rootfs_cache_max_age = 0
+        self.pkgcache_max_size = 0
+        self.refresh_metadata = False
+        self.squashfs_compressor = None
+        self.squashfs_block_size = None
+        self.squashfs_processors = None
+        self.squashfs_mem = None
+        self.squashfs_cache = True
+        self.squashfs_cache_max_size = 0
         self.repourl = {}
 
         # If the kernel is save to the destdir when copy_kernel cmd is called.
@@ -114,12 +130,12 @@ class BaseImageCreator(object):
             if self.pack_to:
                 if '@NAME@' in self.pack_to:
                     self.pack_to = self.pack_to.replace('@NAME@', self.name)
-                (tar, ext) = os.path.splitext(self.pack_to)
-                if ext in (".gz", ".bz2", ".lzo", ".bz") and tar.endswith(".tar"):
-                    ext = ".tar" + ext
-                if ext not in get_archive_suffixes():
+                if not filter(self.pack_to.endswith, get_archive_suffixes()):
                     self.pack_to += ".tar"
 
+        if self.profile and not profiler.get_profiler():
+            profiler.start()
+
         self._dep_checks = ["ls", "bash", "cp", "echo", "modprobe"]
 
         # Output image file names
@@ -1040,16 +1056,28 @@ class BaseImageCreator(object):
             if 'debuginfo' in self.install_pkgs:
                 pkg_manager.install_debuginfo = True
 
-        for repo in kickstart.get_repos(self.ks, repo_urls, self.ignore_ksrepo):
-            (name, baseurl, mirrorlist, inc, exc,
-             proxy, proxy_username, proxy_password, debuginfo,
-             source, gpgkey, disable, ssl_verify, nocache,
-             cost, priority) = repo
-
-            ssl_verify = get_ssl_verify(ssl_verify)
-            yr = pkg_manager.addRepository(name, baseurl, mirrorlist, proxy,
-                        proxy_username, proxy_password, inc, exc, ssl_verify,
-                        nocache, cost, priority)
+        if self.download_threads:
+            pkg_manager.download_threads = self.download_threads
+        if self.pkgcache_max_size:
+            pkg_manager.pkgcache_max_size = self.pkgcache_max_size
+        if hasattr(pkg_manager, 'repo_metadata') and \
+           getattr(self, 'repomd', None):
+            pkg_manager.repo_metadata = self.repomd
+        if self.refresh_metadata and hasattr(pkg_manager, 'refresh_metadata'):
+            pkg_manager.refresh_metadata = True
+
+        with profiler.phase("metadata"):
+            for repo in kickstart.get_repos(self.ks, repo_urls,
+                                            self.ignore_ksrepo):
+                (name, baseurl, mirrorlist, inc, exc,
+                 proxy, proxy_username, proxy_password, debuginfo,
+                 source, gpgkey, disable, ssl_verify, nocache,
+                 cost, priority) = repo
+
+                ssl_verify = get_ssl_verify(ssl_verify)
+                yr = pkg_manager.addRepository(name, baseurl, mirrorlist,
+                            proxy, proxy_username, proxy_password, inc, exc,
+                            ssl_verify, nocache, cost, priority)
 
         if kickstart.exclude_docs(self.ks):
             rpm.addMacro("_excludedocs", "1")
@@ -1058,13 +1086,25 @@ class BaseImageCreator(object):
         if kickstart.inst_langs(self.ks) != None:
             rpm.addMacro("_install_langs", kickstart.inst_langs(self.ks))
 
+        if self.rootfs_cache and hasattr(pkg_manager, 'rootfs_cache'):
+            cache = rootfscache.RootfsCache(self.cachedir,
+                        self.rootfs_cache_max_size * 1024 * 1024,
+                        self.rootfs_cache_max_age * 24 * 3600,
+                        {'pkgmgr': pkg_manager.name,
+                         'arch': self.target_arch,
+                         '_excludedocs': kickstart.exclude_docs(self.ks),
+                         '_install_langs': kickstart.inst_langs(self.ks)})
+            if cache.available():
+                pkg_manager.rootfs_cache = cache
+
         try:
-            self.__preinstall_packages(pkg_manager)
-            self.__select_packages(pkg_manager)
-            self.__select_groups(pkg_manager)
-            self.__deselect_packages(pkg_manager)
-            self.__localinst_packages(pkg_manager)
-            self.__check_packages(pkg_manager)
+            with profiler.phase("select"):
+                self.__preinstall_packages(pkg_manager)
+                self.__select_packages(pkg_manager)
+                self.__select_groups(pkg_manager)
+                self.__deselect_packages(pkg_manager)
+                self.__localinst_packages(pkg_manager)
+                self.__check_packages(pkg_manager)
 
             BOOT_SAFEGUARD = 256L * 1024 * 1024 # 256M
             checksize = self._root_fs_avail
@@ -1100,6 +1140,29 @@ class BaseImageCreator(object):
     def postinstall(self):
         self.copy_attachment()
 
+    def populate(self, source):
+        """Populate the install root from the one of another image creator.
+
+        This method replaces install() and configure() when several images
+        are created from the same kickstart: 'source' is a creator which
+        installed and configured the system already, and is still mounted.
+        Its install root is copied into this one, which must be mounted,
+        then only the boot configuration specific to this image is created.
+
+        """
+        rootfscache.copy_rootfs(source._instroot, self._instroot)
+
+        self._required_pkgs = source._required_pkgs
+        self._excluded_pkgs = source._excluded_pkgs
+        self._pkgs_content = source._pkgs_content
+        self._pkgs_license = source._pkgs_license
+        self._pkgs_vcsinfo = source._pkgs_vcsinfo
+        self._attachment = source._attachment
+
+        self.postinstall()
+        with profiler.phase("bootconfig"):
+            self._create_bootconfig()
+
     def __run_post_scripts(self):
         msger.info("Running scripts ...")
         if os.path.exists(self._instroot + "/tmp"):
@@ -1183,8 +1246,10 @@ class BaseImageCreator(object):
             msger.warning("Failed to apply configuration to image")
             raise
 
-        self._create_bootconfig()
-        self.__run_post_scripts()
+        with profiler.phase("bootconfig"):
+            self._create_bootconfig()
+        with profiler.phase("post_scripts"):
+            self.__run_post_scripts()
 
     def launch_shell(self, launch):
         """Launch a shell in the install root.
@@ -1218,7 +1283,8 @@ class BaseImageCreator(object):
                    this defaults to the current directory.
 
         """
-        self._stage_final_image()
+        with profiler.phase("stage"):
+            self._stage_final_image()
 
         if not os.path.exists(destdir):
             fs.makedirs(destdir)
@@ -1238,11 +1304,28 @@ class BaseImageCreator(object):
         runner.quiet('sync')
 
         misc.check_space_pre_cp(self._outdir, destdir)
-        for f in os.listdir(self._outdir):
-            shutil.move(os.path.join(self._outdir, f),
-                        os.path.join(destdir, f))
-            self.outimage.append(os.path.join(destdir, f))
-            self.do_genchecksum(os.path.join(destdir, f))
+        moved = []
+        with profiler.phase("move"):
+            for f in os.listdir(self._outdir):
+                sparsecopy.move_file(os.path.join(self._outdir, f),
+                                     os.path.join(destdir, f))
+                self.outimage.append(os.path.join(destdir, f))
+                moved.append(os.path.join(destdir, f))
+
+        # hash all the images in one pass and in parallel, the results are
+        # reused by do_genchecksum and release_output
+        hash_names = []
+        if self._genchecksum:
+            hash_names.append('md5')
+        if getattr(self, 'release', None) is not None:
+            hash_names = ['md5', 'sha1', 'sha256']
+        with profiler.phase("checksum"):
+            if hash_names:
+                misc.calc_files_hashes([f for f in moved if os.path.isfile(f)],
+                                       hash_names)
+
+            for f in moved:
+                self.do_genchecksum(f)
 
     def print_outimage_info(self):
         msg = "The new image can be found here:\n"
@@ -1330,31 +1413,26 @@ class BaseImageCreator(object):
             outimages.append(_rpath(newf))
 
         # generate MD5SUMS SHA1SUMS SHA256SUMS
-        def generate_hashsum(hash_name, hash_method):
-            with open(_rpath(hash_name), "w") as wf:
-                for f in os.listdir(destdir):
-                    if f.endswith('SUMS'):
-                        continue
-
-                    if os.path.isdir(os.path.join(destdir, f)):
-                        continue
+        files = [f for f in os.listdir(destdir) if not f.endswith('SUMS') \
+                 and not os.path.isdir(os.path.join(destdir, f))]
+        hash_dict = {
+                     'MD5SUMS'    : 'md5',
+                     'SHA1SUMS'   : 'sha1',
+                     'SHA256SUMS' : 'sha256'
+                    }
+        hash_names = hash_dict.values()
+        hash_values = misc.calc_files_hashes(map(_rpath, files), hash_names)
 
-                    hash_value = hash_method(_rpath(f))
+        for k, v in hash_dict.items():
+            with open(_rpath(k), "w") as wf:
+                for f in files:
+                    hash_value = hash_values[_rpath(f)][hash_names.index(v)]
                     # There needs to be two spaces between the sum and
                     # filepath to match the syntax with md5sum,sha1sum,
                     # sha256sum. This way also *sum -c *SUMS can be used.
                     wf.write("%s  %s\n" % (hash_value, f))
 
-            outimages.append("%s/%s" % (destdir, hash_name))
-
-        hash_dict = {
-                     'MD5SUMS'    : misc.get_md5sum,
-                     'SHA1SUMS'   : misc.get_sha1sum,
-                     'SHA256SUMS' : misc.get_sha256sum
-                    }
-
-        for k, v in hash_dict.items():
-            generate_hashsum(k, v)
+            outimages.append("%s/%s" % (destdir, k))
 
         # Filter out the nonexist file
         for fp in outimages[:]:
@@ -1409,6 +1487,9 @@ class BaseImageCreator(object):
         if hasattr(self, 'logfile') and self.logfile:
             manifest_dict.update({'log_file': self.logfile})
 
+        if profiler.get_profiler():
+            manifest_dict.update({'profile': self._get_profile_name()})
+
         if self.image_files:
             if self.pack_to:
                 self.image_files.update({'pack': get_pack_suffix()})
@@ -1419,3 +1500,39 @@ class BaseImageCreator(object):
         with open(manifest_file_path, 'w') as fest_file:
             json.dump(manifest_dict, fest_file, indent=4)
         self.outimage.append(manifest_file_path)
+
+    def _get_profile_name(self):
+        return "%s.profile.json" % self.name
+
+    def _get_profile_extra(self):
+        """ Return a dict of image specific figures added to the profile
+        report, the hook where subclasses may add theirs """
+        return {}
+
+    def save_profile(self):
+        """ Write the report of the profiler, if --profile is given, next
+        to the manifest file """
+        prof = profiler.get_profiler()
+        if not prof:
+            return
+
+        if not os.path.exists(self.destdir):
+            os.makedirs(self.destdir)
+
+        profile_path = os.path.join(self.destdir, self._get_profile_name())
+        msger.info('Saving profile report %s ...' % profile_path)
+        report = prof.save(profile_path, name=self.name, mic_version=VERSION,
+                           format=self.img_format,
+                           **self._get_profile_extra())
+
+        msg = "Time spent in each phase:"
+        for phase in report['total']['phases']:
+            msg += "\n  %-16s %9.1fs wall %9.1fs cpu %5d commands" \
+                   % (phase['name'], phase['wall'],
+                      phase['cpu_user'] + phase['cpu_sys'] + \
+                      phase['children_cpu_user'] + phase['children_cpu_sys'],
+                      phase['commands'])
+        msger.verbose(msg)
+
+        if profile_path not in self.outimage:
+            self.outimage.append(profile_path)
@@ -20,8 +20,9 @@ import glob
 import shutil
 
 from mic import kickstart, msger
-from mic.utils import fs_related, rpmmisc, runner, misc
+from mic.utils import fs_related, rpmmisc, runner, misc, sparsecopy, profiler
 from mic.utils.errors import CreatorError
+from mic.utils.squashfscache import SquashfsCache
 from mic.imager.loop import LoopImageCreator
 from mic.imager.baseimager import BaseImageCreator
 from mic.archive import packing
@@ -84,6 +85,9 @@ class LiveImageCreatorBase(LoopImageCreator):
 
         self.__isodir = None
 
+        #The figures of the last squashing, for the profile report.
+        self._squashfs_stats = None
+
         self.__modules = ["=ata",
                           "sym53c8xx",
                           "aic7xxx",
@@ -163,6 +167,55 @@ class LiveImageCreatorBase(LoopImageCreator):
 
         return False
 
+    def _get_squashfs_options(self):
+        """Return the dict of the mksquashfs settings, the ones of the
+        kickstart file override the ones of the configuration."""
+        options = {"compressor": self.squashfs_compressor,
+                   "block_size": self.squashfs_block_size,
+                   "processors": self.squashfs_processors,
+                   "mem": self.squashfs_mem}
+        if self.ks:
+            for name, value in kickstart.get_squashfs_options(self.ks).items():
+                if value is not None:
+                    options[name] = value
+        return options
+
+    def _mksquashfs(self, in_img, out_img):
+        """Squash in_img into out_img, or reuse the squashfs image of the
+        same data if it is cached."""
+        options = self._get_squashfs_options()
+
+        cache = key = None
+        if self.squashfs_cache and self.cachedir:
+            cache = SquashfsCache(self.cachedir,
+                                  self.squashfs_cache_max_size * 1024 * 1024,
+                                  self.rootfs_cache_max_age * 24 * 3600)
+            with profiler.phase("squashfs_key"):
+                key = cache.get_key(in_img, options)
+            if cache.restore(key, out_img):
+                self._squashfs_stats = {
+                        "input": fs_related.get_allocated_size(in_img),
+                        "output": os.path.getsize(out_img),
+                        "seconds": 0,
+                        "cached": True}
+                self._squashfs_stats.update(options)
+                return
+
+        with profiler.phase("mksquashfs"):
+            stats = fs_related.mksquashfs(in_img, out_img, options)
+        stats["cached"] = False
+        stats.update(options)
+        self._squashfs_stats = stats
+
+        if cache:
+            cache.save(key, out_img)
+
+    def _get_profile_extra(self):
+        extra = LoopImageCreator._get_profile_extra(self)
+        if self._squashfs_stats:
+            extra["squashfs"] = self._squashfs_stats
+        return extra
+
     def __restore_file(self,path):
         try:
             os.unlink(path)
@@ -291,7 +344,8 @@ class LiveImageCreatorBase(LoopImageCreator):
                                                   minimal_size)
 
             if self.skip_compression:
-                shutil.move(self._image, self.__isodir + "/LiveOS/ext3fs.img")
+                sparsecopy.move_file(self._image,
+                                     self.__isodir + "/LiveOS/ext3fs.img")
             else:
                 fs_related.makedirs(os.path.join(
                                         os.path.dirname(self._image),
@@ -299,15 +353,17 @@ class LiveImageCreatorBase(LoopImageCreator):
                 shutil.move(self._image,
                             os.path.join(os.path.dirname(self._image),
                                          "LiveOS", "ext3fs.img"))
-                fs_related.mksquashfs(os.path.dirname(self._image),
-                           self.__isodir + "/LiveOS/squashfs.img")
+                self._mksquashfs(os.path.dirname(self._image),
+                                 self.__isodir + "/LiveOS/squashfs.img")
 
             self.__create_iso(self.__isodir)
 
             if self.pack_to:
                 isoimg = os.path.join(self._outdir, self.name + ".iso")
                 packimg = os.path.join(self._outdir, self.pack_to)
-                packing(packimg, isoimg)
+                with profiler.phase("pack"):
+                    packing(packimg, isoimg, self.compress_level,
+                            self.compress_threads)
                 os.unlink(isoimg)
                 self.image_files.update({'image_files': [self.pack_to]})
             else:
@@ -20,7 +20,7 @@ import shutil
 import re
 
 from mic import msger
-from mic.utils import misc, fs_related, runner
+from mic.utils import misc, fs_related, runner, sparsecopy, profiler
 from mic.utils.errors import CreatorError, MountError
 from mic.utils.partitionedfs import PartitionedMount
 from mic.imager.livecd import LiveCDImageCreator
@@ -32,7 +32,7 @@ class LiveUSBImageCreator(LiveCDImageCreator):
     def __init__(self, *args):
         LiveCDImageCreator.__init__(self, *args)
 
-        self._dep_checks.extend(["kpartx", "parted"])
+        self._dep_checks.extend(["losetup"])
 
         # remove dependency of genisoimage in parent class
         if "genisoimage" in self._dep_checks:
@@ -88,15 +88,15 @@ class LiveUSBImageCreator(LiveCDImageCreator):
             fs_related.makedirs(usbmnt + "/LiveOS")
 
             if os.path.exists(isodir + "/LiveOS/squashfs.img"):
-                shutil.copyfile(isodir + "/LiveOS/squashfs.img",
-                                usbmnt + "/LiveOS/squashfs.img")
+                sparsecopy.copy_file(isodir + "/LiveOS/squashfs.img",
+                                     usbmnt + "/LiveOS/squashfs.img")
             else:
-                fs_related.mksquashfs(os.path.dirname(self._image),
-                                      usbmnt + "/LiveOS/squashfs.img")
+                self._mksquashfs(os.path.dirname(self._image),
+                                 usbmnt + "/LiveOS/squashfs.img")
 
             if os.path.exists(isodir + "/LiveOS/osmin.img"):
-                shutil.copyfile(isodir + "/LiveOS/osmin.img",
-                                usbmnt + "/LiveOS/osmin.img")
+                sparsecopy.copy_file(isodir + "/LiveOS/osmin.img",
+                                     usbmnt + "/LiveOS/osmin.img")
 
             if fstype == "vfat" or fstype == "msdos":
                 uuid = usbloop.partitions[0]['mount'].uuid
@@ -250,7 +250,7 @@ class LiveUSBImageCreator(LiveCDImageCreator):
             usbloop.unmount()
             usbloop.cleanup()
 
-        # Need to do this after image is unmounted and device mapper is closed
+        # Need to do this after image is unmounted and partitions are unmapped
         msger.info("set MBR")
         mbrfile = "/usr/lib/syslinux/mbr.bin"
         if not os.path.exists(mbrfile):
@@ -284,8 +284,8 @@ class LiveUSBImageCreator(LiveCDImageCreator):
                                                   minimal_size)
 
             if self.skip_compression:
-                shutil.move(self._image,
-                            isodir + "/LiveOS/ext3fs.img")
+                sparsecopy.move_file(self._image,
+                                     isodir + "/LiveOS/ext3fs.img")
             else:
                 fs_related.makedirs(os.path.join(
                                         os.path.dirname(self._image),
@@ -293,8 +293,8 @@ class LiveUSBImageCreator(LiveCDImageCreator):
                 shutil.move(self._image,
                             os.path.join(os.path.dirname(self._image),
                                          "LiveOS", "ext3fs.img"))
-                fs_related.mksquashfs(os.path.dirname(self._image),
-                           isodir + "/LiveOS/squashfs.img")
+                self._mksquashfs(os.path.dirname(self._image),
+                                 isodir + "/LiveOS/squashfs.img")
 
                 self._create_usbimg(isodir)
 
@@ -302,7 +302,9 @@ class LiveUSBImageCreator(LiveCDImageCreator):
                     self.image_files.update({'image_files': self.pack_to})
                     usbimg = os.path.join(self._outdir, self.name + ".usbimg")
                     packimg = os.path.join(self._outdir, self.pack_to)
-                    packing(packimg, usbimg)
+                    with profiler.phase("pack"):
+                        packing(packimg, usbimg, self.compress_level,
+                                self.compress_threads)
                     os.unlink(usbimg)
                 else:
                     self.image_files.update({'image_files': self.name + ".usbimg"})
@@ -21,9 +21,10 @@ import shutil
 
 from mic import kickstart, msger
 from mic.utils.errors import CreatorError, MountError
-from mic.utils import misc, runner, fs_related as fs
+from mic.utils import misc, runner, sparsecopy, profiler
+from mic.utils import fs_related as fs
 from mic.imager.baseimager import BaseImageCreator
-from mic.archive import packing, compressing
+from mic.archive import packing, compress_sparse
 
 
 # The maximum string length supported for LoopImageCreator.fslabel
@@ -98,12 +99,17 @@ class LoopImageCreator(BaseImageCreator):
 
     When specifying multiple partitions in kickstart file, each partition
     will be created as a separated loop image.
+
+    With build_from_dir, the system is installed into a plain directory
+    instead, and each image is created from it by mkfs, at its minimal size
+    if it's shrunk.
     """
     img_format = 'loop'
 
     def __init__(self, creatoropts=None, pkgmgr=None,
                  compress_image=None,
-                 shrink_image=False):
+                 shrink_image=False,
+                 build_from_dir=False):
         """Initialize a LoopImageCreator instance.
 
         This method takes the same arguments as ImageCreator.__init__()
@@ -116,6 +122,7 @@ class LoopImageCreator(BaseImageCreator):
 
         self.compress_image = compress_image
         self.shrink_image = shrink_image
+        self.build_from_dir = build_from_dir
 
         self.__fslabel = None
         self.fslabel = self.name
@@ -291,17 +298,39 @@ class LoopImageCreator(BaseImageCreator):
                 be used (or 4GiB if not specified in the kickstart).
         """
         minsize = 0
-        for item in self._instloops:
-            if item['name'] == self._img_name:
-                minsize = item['loop'].resparse(size)
+        if self.build_from_dir:
+            with profiler.phase("mkfs"):
+                return self.__build_images(size)
+
+        with profiler.phase("resparse"):
+            for item in self._instloops:
+                if item['name'] == self._img_name:
+                    minsize = item['loop'].resparse(size)
+                else:
+                    item['loop'].resparse(size)
+
+        return minsize
+
+    def __build_images(self, size=None):
+        """Create the images from the trees of their mount points, nested
+        mount points first: their trees are moved aside once built so that
+        they aren't part of the images of the parent mount points."""
+        minsize = 0
+        parkdir = self._mkdtemp("built-")
+        for item in sorted(self._instloops, key=lambda item: item['mountpoint'],
+                           reverse=True):
+            if item['mountpoint'] == '/':
+                imgsize = item['loop'].build(size)
             else:
-                item['loop'].resparse(size)
+                imgsize = item['loop'].build(size, parkdir)
+            if item['name'] == self._img_name:
+                minsize = imgsize
 
         return minsize
 
     def _base_on(self, base_on=None):
         if base_on and self._image != base_on:
-            shutil.copyfile(base_on, self._image)
+            sparsecopy.copy_file(base_on, self._image)
 
     def _check_imgdir(self):
         if self._imgdir is None:
@@ -313,6 +342,10 @@ class LoopImageCreator(BaseImageCreator):
     #
     def _mount_instroot(self, base_on=None):
 
+        if base_on and self.build_from_dir:
+            raise CreatorError("Can't build an image from a directory based "
+                               "on another image")
+
         if base_on and os.path.isfile(base_on):
             self._imgdir = os.path.dirname(base_on)
             imgname = os.path.basename(base_on)
@@ -340,23 +373,43 @@ class LoopImageCreator(BaseImageCreator):
             size = loop['size'] * 1024L * 1024L
             imgname = loop['name']
 
-            if fstype in ("ext2", "ext3", "ext4"):
-                MyDiskMount = fs.ExtDiskMount
-            elif fstype == "btrfs":
-                MyDiskMount = fs.BtrfsDiskMount
-            elif fstype in ("vfat", "msdos"):
-                MyDiskMount = fs.VfatDiskMount
+            if self.build_from_dir:
+                if fstype in ("ext2", "ext3", "ext4"):
+                    MyDirMount = fs.ExtDirMount
+                elif fstype in ("vfat", "msdos"):
+                    MyDirMount = fs.VfatDirMount
+                else:
+                    raise MountError('Cannot create %s images from a '
+                                     'directory' % fstype)
+
+                loop['loop'] = MyDirMount(fs.FileDisk(
+                                              os.path.join(self._imgdir,
+                                                           imgname),
+                                              size),
+                                          mp,
+                                          fstype,
+                                          self._blocksize,
+                                          loop['label'],
+                                          fsuuid = loop['uuid'])
             else:
-                raise MountError('Cannot support fstype: %s' % fstype)
-
-            loop['loop'] = MyDiskMount(fs.SparseLoopbackDisk(
-                                           os.path.join(self._imgdir, imgname),
-                                           size),
-                                       mp,
-                                       fstype,
-                                       self._blocksize,
-                                       loop['label'],
-                                       fsuuid = loop['uuid'])
+                if fstype in ("ext2", "ext3", "ext4"):
+                    MyDiskMount = fs.ExtDiskMount
+                elif fstype == "btrfs":
+                    MyDiskMount = fs.BtrfsDiskMount
+                elif fstype in ("vfat", "msdos"):
+                    MyDiskMount = fs.VfatDiskMount
+                else:
+                    raise MountError('Cannot support fstype: %s' % fstype)
+
+                loop['loop'] = MyDiskMount(fs.SparseLoopbackDisk(
+                                               os.path.join(self._imgdir,
+                                                            imgname),
+                                               size),
+                                           mp,
+                                           fstype,
+                                           self._blocksize,
+                                           loop['label'],
+                                           fsuuid = loop['uuid'])
 
             if fstype in ("ext2", "ext3", "ext4"):
                 loop['loop'].extopts = loop['extopts']
@@ -395,7 +448,10 @@ class LoopImageCreator(BaseImageCreator):
             self.image_files.setdefault('partitions', {}).update(
                     {item['mountpoint']: item['label']})
             if self.compress_image:
-                compressing(imgfile, self.compress_image)
+                with profiler.phase("compress"):
+                    compress_sparse(imgfile, self.compress_image,
+                                    level=self.compress_level,
+                                    threads=self.compress_threads)
                 self.image_files.setdefault('image_files', []).append(
                                 '.'.join([item['name'], self.compress_image]))
             else:
@@ -403,12 +459,14 @@ class LoopImageCreator(BaseImageCreator):
 
         if not self.pack_to:
             for item in os.listdir(self._imgdir):
-                shutil.move(os.path.join(self._imgdir, item),
-                            os.path.join(self._outdir, item))
+                sparsecopy.move_file(os.path.join(self._imgdir, item),
+                                     os.path.join(self._outdir, item))
         else:
             msger.info("Pack all loop images together to %s" % self.pack_to)
             dstfile = os.path.join(self._outdir, self.pack_to)
-            packing(dstfile, self._imgdir)
+            with profiler.phase("pack"):
+                packing(dstfile, self._imgdir, self.compress_level,
+                        self.compress_threads)
             self.image_files['image_files'] = [self.pack_to]
 
 
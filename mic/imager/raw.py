@@ -17,14 +17,14 @@
 
 import os
 import stat
-import shutil
+import multiprocessing
 
 from mic import kickstart, msger
-from mic.utils import fs_related, runner, misc
+from mic.utils import fs_related, runner, misc, sparsecopy, profiler
 from mic.utils.partitionedfs import PartitionedMount
 from mic.utils.errors import CreatorError, MountError
 from mic.imager.baseimager import BaseImageCreator
-from mic.archive import packing, compressing
+from mic.archive import packing, compress_sparse
 
 class RawImageCreator(BaseImageCreator):
     """Installs a system into a file containing a partitioned disk image.
@@ -33,10 +33,14 @@ class RawImageCreator(BaseImageCreator):
     is formatted with a partition table, each partition loopback mounted
     and the system installed into an virtual disk. The disk image can
     subsequently be booted in a virtual machine or accessed with kpartx
+
+    With build_from_dir, the system is installed into a plain directory
+    instead, and the file system of each partition is created from it right
+    into the disk file, without any loop device.
     """
     img_format = 'raw'
 
-    def __init__(self, creatoropts=None, pkgmgr=None, compress_image=None, generate_bmap=None, fstab_entry="uuid"):
+    def __init__(self, creatoropts=None, pkgmgr=None, compress_image=None, generate_bmap=None, fstab_entry="uuid", build_from_dir=False):
         """Initialize a ApplianceImageCreator instance.
 
             This method takes the same arguments as ImageCreator.__init__()
@@ -57,15 +61,25 @@ class RawImageCreator(BaseImageCreator):
         self.appliance_release = None
         self.compress_image = compress_image
         self.bmap_needed = generate_bmap
+        self.build_from_dir = build_from_dir
+        # disks whose bmap is generated while compressing them
+        self._bmap_deferred = []
         self._need_extlinux = not kickstart.use_installerfw(self.ks, "bootloader")
+        if self.build_from_dir and self._need_extlinux:
+            raise CreatorError("extlinux can only be installed into a mounted "
+                               "file system, please use the bootloader of "
+                               "the installer framework or don't build the "
+                               "image from a directory")
         #self.getsource = False
         #self.listpkg = False
 
-        self._dep_checks.extend(["sync", "kpartx", "parted"])
+        self._dep_checks.append("sync")
+        if not self.build_from_dir:
+            self._dep_checks.append("losetup")
         if self._need_extlinux:
             self._dep_checks.extend(["extlinux"])
 
-    def configure(self, repodata = None):
+    def __setuid_xorg(self):
         import subprocess
         def chroot():
             os.chroot(self._instroot)
@@ -75,8 +89,14 @@ class RawImageCreator(BaseImageCreator):
             subprocess.call(["/bin/chmod", "u+s", "/usr/bin/Xorg"],
                             preexec_fn = chroot)
 
+    def configure(self, repodata = None):
+        self.__setuid_xorg()
         BaseImageCreator.configure(self, repodata)
 
+    def populate(self, source):
+        BaseImageCreator.populate(self, source)
+        self.__setuid_xorg()
+
     def _get_fstab(self):
         s = ""
         for mp in self.__instloop.mount_order:
@@ -184,7 +204,8 @@ class RawImageCreator(BaseImageCreator):
     #
     def _mount_instroot(self, base_on = None):
         parts = self._get_parts()
-        self.__instloop = PartitionedMount(self._instroot)
+        self.__instloop = PartitionedMount(self._instroot,
+                                           from_dir = self.build_from_dir)
 
         for p in parts:
             self.__instloop.add_partition(int(p.size),
@@ -206,8 +227,11 @@ class RawImageCreator(BaseImageCreator):
             msger.debug("Adding disk %s as %s with size %s bytes" \
                         % (disk_name, full_path, disk['min_size']))
 
-            disk_obj = fs_related.SparseLoopbackDisk(full_path,
-                                                     disk['min_size'])
+            if self.build_from_dir:
+                disk_obj = fs_related.FileDisk(full_path, disk['min_size'])
+            else:
+                disk_obj = fs_related.SparseLoopbackDisk(full_path,
+                                                         disk['min_size'])
             self.__disks[disk_name] = disk_obj
             self.__instloop.add_disk(disk_name, disk_obj)
 
@@ -219,7 +243,7 @@ class RawImageCreator(BaseImageCreator):
         This method calls the base class' 'mount()' method and then creates
         block device nodes corresponding to the image's partitions in the image
         itself. Namely, the image has /dev/loopX device corresponding to the
-        entire image, and per-partition /dev/mapper/* devices.
+        entire image, and per-partition /dev/loopY devices.
 
         We copy these files to image's "/dev" directory in order to enable
         scripts which run in the image chroot environment to access own raw
@@ -246,13 +270,16 @@ class RawImageCreator(BaseImageCreator):
 
         BaseImageCreator.mount(self, base_on, cachedir)
 
+        if self.build_from_dir:
+            # there is no device to copy
+            return
+
         # Copy the disk loop devices
         for name in self.__disks.keys():
             loopdev = self.__disks[name].device
             copy_devnode(loopdev, self._instroot + loopdev)
 
-        # Copy per-partition dm nodes
-        os.mkdir(self._instroot + "/dev/mapper", os.stat("/dev/mapper").st_mode)
+        # Copy per-partition device nodes
         for p in self.__instloop.partitions:
             copy_devnode(p['mapper_device'],
                          self._instroot + p['mapper_device'])
@@ -261,7 +288,7 @@ class RawImageCreator(BaseImageCreator):
 
     def unmount(self):
         """
-        Remove loop/dm device nodes which we created in 'mount()' and call the
+        Remove loop device nodes which we created in 'mount()' and call the
         base class' 'unmount()' method.
         """
 
@@ -275,10 +302,6 @@ class RawImageCreator(BaseImageCreator):
                 if os.path.exists(path):
                     os.unlink(path)
 
-        path = self._instroot + "/dev/mapper"
-        if os.path.exists(path):
-            shutil.rmtree(path, ignore_errors=True)
-
         for name in self.__disks.keys():
             if self.__disks[name].device:
                 path = self._instroot + self.__disks[name].device
@@ -426,7 +449,8 @@ class RawImageCreator(BaseImageCreator):
                 msger.warning("%s" % err)
 
     def _resparse(self, size = None):
-        return self.__instloop.resparse(size)
+        with profiler.phase("resparse"):
+            return self.__instloop.resparse(size)
 
     def _get_post_scripts_env(self, in_chroot):
         env = BaseImageCreator._get_post_scripts_env(self, in_chroot)
@@ -464,7 +488,8 @@ class RawImageCreator(BaseImageCreator):
                 if imgfile.endswith('.raw') or imgfile.endswith('bin'):
                     imgpath = os.path.join(self.__imgdir, imgfile)
                     msger.info("Compressing image %s" % imgfile)
-                    compressing(imgpath, self.compress_image)
+                    with profiler.phase("compress"):
+                        self._compress_image(imgpath)
                 if imgfile.endswith('.raw') and not self.pack_to:
                     for disk in self.__disks.keys():
                         if imgfile.find(disk) != -1:
@@ -477,7 +502,9 @@ class RawImageCreator(BaseImageCreator):
         if self.pack_to:
             dst = os.path.join(self._outdir, self.pack_to)
             msger.info("Pack all raw images to %s" % dst)
-            packing(dst, self.__imgdir)
+            with profiler.phase("pack"):
+                packing(dst, self.__imgdir, self.compress_level,
+                        self.compress_threads)
             self.image_files.update({'image_files': self.pack_to})
         else:
             msger.debug("moving disks to stage location")
@@ -485,7 +512,7 @@ class RawImageCreator(BaseImageCreator):
                 src = os.path.join(self.__imgdir, imgfile)
                 dst = os.path.join(self._outdir, imgfile)
                 msger.debug("moving %s to %s" % (src,dst))
-                shutil.move(src,dst)
+                sparsecopy.move_file(src, dst)
 
         self._write_image_xml()
 
@@ -578,23 +605,69 @@ class RawImageCreator(BaseImageCreator):
         if self.bmap_needed is None:
             return
 
-        from mic.utils import BmapCreate
+        if self.build_from_dir:
+            # the file systems are not in the disk images yet
+            self._resparse()
+
         msger.info("Generating the map file(s)")
 
         for name in self.__disks.keys():
-            image = self._full_path(self.__imgdir, name, self.__disk_format)
             bmap_file = self._full_path(self._outdir, name, "bmap")
             self.image_files.setdefault(name, {}).update({'bmap': \
                                             os.path.basename(bmap_file)})
 
-            msger.debug("Generating block map file '%s'" % bmap_file)
+            if self.compress_image:
+                # the checksums are calculated when the image is compressed
+                msger.debug("Deferring block map file '%s'" % bmap_file)
+                self._bmap_deferred.append(name)
+                continue
 
-            try:
-                creator = BmapCreate.BmapCreate(image, bmap_file)
-                creator.generate()
-                del creator
-            except BmapCreate.Error as err:
-                raise CreatorError("Failed to create bmap file: %s" % str(err))
+            self._generate_bmap_file(name)
+
+    def _generate_bmap_file(self, name, chksums=None):
+        """ Generate the block map file for the disk 'name', using the
+        'chksums' calculated by compress_sparse() if given. """
+
+        from mic.utils import BmapCreate
+
+        image = self._full_path(self.__imgdir, name, self.__disk_format)
+        bmap_file = self._full_path(self._outdir, name, "bmap")
+        msger.debug("Generating block map file '%s'" % bmap_file)
+
+        try:
+            creator = BmapCreate.BmapCreate(image, bmap_file)
+            with profiler.phase("bmap"):
+                creator.generate(workers=multiprocessing.cpu_count(),
+                                 chksums=chksums)
+            msger.debug("Hashed %s in %d ranges in %.1f seconds"
+                        % (misc.human_size(creator.hashed_bytes),
+                           creator.ranges_cnt, creator.elapsed))
+            del creator
+        except BmapCreate.Error as err:
+            raise CreatorError("Failed to create bmap file: %s" % str(err))
+
+    def _compress_image(self, imgpath):
+        """ Compress 'imgpath' in one streaming pass, and generate its
+        deferred block map file from the same read. """
+
+        name = None
+        for disk in self._bmap_deferred:
+            if imgpath == self._full_path(self.__imgdir, disk,
+                                          self.__disk_format):
+                name = disk
+                break
+
+        if name is None:
+            compress_sparse(imgpath, self.compress_image,
+                            level=self.compress_level,
+                            threads=self.compress_threads)
+            return
+
+        _, chksums = compress_sparse(imgpath, self.compress_image, "sha256",
+                                     remove=False, level=self.compress_level,
+                                     threads=self.compress_threads)
+        self._generate_bmap_file(name, chksums)
+        os.unlink(imgpath)
 
     def create_manifest(self):
         if self.compress_image:
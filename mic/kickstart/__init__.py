@@ -32,8 +32,9 @@ from pykickstart.handlers.control import commandMap
 from pykickstart.handlers.control import dataMap
 
 from mic import msger
-from mic.utils import errors, misc, runner, fs_related as fs
-from custom_commands import desktop, micrepo, micboot, partition, installerfw
+from mic.utils import errors, runner, repoindex, fs_related as fs
+from custom_commands import desktop, micrepo, micboot, partition, installerfw, \
+                            squashfs
 from mic.utils.safeurl import SafeURL
 
 
@@ -104,6 +105,7 @@ def read_kickstart(path):
     commandMap[using_version]["part"] = partition.Mic_Partition
     commandMap[using_version]["partition"] = partition.Mic_Partition
     commandMap[using_version]["installerfw_plugins"] = installerfw.Mic_installerfw
+    commandMap[using_version]["squashfs"] = squashfs.Mic_Squashfs
     dataMap[using_version]["RepoData"] = micrepo.Mic_RepoData
     dataMap[using_version]["PartData"] = partition.Mic_PartData
     superclass = ksversion.returnClassForVersion(version=using_version)
@@ -718,6 +720,17 @@ def get_default_kernel(ks, default = None):
         return default
     return ks.handler.bootloader.default
 
+def get_squashfs_options(ks):
+    """ Returns a dict of the squashfs settings of the kickstart file, the
+    ones not set are None """
+    options = {}
+    for name in ("compressor", "block_size", "processors", "mem"):
+        if hasattr(ks.handler, "squashfs"):
+            options[name] = getattr(ks.handler.squashfs, name, None)
+        else:
+            options[name] = None
+    return options
+
 RepoType = collections.namedtuple("Repo",
                "name, baseurl, mirrorlist, includepkgs, excludepkgs, proxy, \
                proxy_username, proxy_password, debuginfo, \
@@ -859,26 +872,25 @@ def resolve_groups(creatoropts, repometadata):
         # But we also must handle such cases, use zypp but repo only has comps,
         # use yum but repo only has patterns, use zypp but use_comps is true,
         # use yum but use_comps is false.
-        groupfile = None
+        kind = None
         if iszypp and repo["comps"]:
-            groupfile = repo["comps"]
-            get_pkglist_handler = misc.get_pkglist_in_comps
+            kind = "comps"
         if not iszypp and repo["patterns"]:
-            groupfile = repo["patterns"]
-            get_pkglist_handler = misc.get_pkglist_in_patterns
-
-        if groupfile:
-            i = 0
-            while True:
-                if i >= len(ks.handler.packages.groupList):
-                    break
-                pkglist = get_pkglist_handler(
-                                        ks.handler.packages.groupList[i].name,
-                                        groupfile)
-                if pkglist:
-                    del ks.handler.packages.groupList[i]
-                    for pkg in pkglist:
-                        if pkg not in ks.handler.packages.packageList:
-                            ks.handler.packages.packageList.append(pkg)
-                else:
-                    i = i + 1
+            kind = "patterns"
+
+        if kind:
+            index = repoindex.get_group_index(repo, kind)
+            packages = ks.handler.packages
+            known = set(packages.packageList)
+            groups = []
+            for group in packages.groupList:
+                pkglist = index.get(group.name)
+                if not pkglist:
+                    groups.append(group)
+                    continue
+
+                for pkg in pkglist:
+                    if pkg not in known:
+                        known.add(pkg)
+                        packages.packageList.append(pkg)
+            packages.groupList[:] = groups
@@ -2,6 +2,7 @@ from desktop import Mic_Desktop
 from micrepo import Mic_Repo, Mic_RepoData
 from partition import Mic_Partition
 from installerfw import Mic_installerfw
+from squashfs import Mic_Squashfs
 
 __all__ = (
     "Mic_Desktop",
@@ -9,4 +10,5 @@ __all__ = (
     "Mic_RepoData",
     "Mic_Partition",
     "Mic_installerfw",
+    "Mic_Squashfs",
 )
@@ -0,0 +1,81 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2014 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc., 59
+# Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+from pykickstart.base import *
+from pykickstart.errors import *
+from pykickstart.options import *
+from mic.utils.fs_related import SQUASHFS_COMPRESSORS
+
+class Mic_Squashfs(KickstartCommand):
+    """ This class implements the "squashfs" KS command, which sets how the
+    squashfs image of the live images is compressed: the compressor, the
+    block size, and the number of processors and the memory mksquashfs
+    may use, e.g. "squashfs --compressor=xz --block-size=1M". The settings
+    not given are the ones of the configuration. """
+
+    removedKeywords = KickstartCommand.removedKeywords
+    removedAttrs = KickstartCommand.removedAttrs
+
+    def __init__(self, *args, **kwargs):
+        KickstartCommand.__init__(self, *args, **kwargs)
+        self.op = self._getParser()
+        self.compressor = kwargs.get("compressor", None)
+        self.block_size = kwargs.get("block_size", None)
+        self.processors = kwargs.get("processors", None)
+        self.mem = kwargs.get("mem", None)
+
+    def __str__(self):
+        retval = ""
+
+        if self.compressor:
+            retval += " --compressor=%s" % self.compressor
+        if self.block_size:
+            retval += " --block-size=%s" % self.block_size
+        if self.processors:
+            retval += " --processors=%d" % self.processors
+        if self.mem:
+            retval += " --mem=%s" % self.mem
+
+        if retval:
+            retval = "# Squashfs settings\nsquashfs%s\n" % retval
+
+        return retval
+
+    def _getParser(self):
+        op = KSOptionParser()
+        op.add_option("--compressor", dest="compressor", type="choice",
+                      choices=SQUASHFS_COMPRESSORS)
+        op.add_option("--block-size", dest="block_size", type="string")
+        op.add_option("--processors", dest="processors", type="int")
+        op.add_option("--mem", dest="mem", type="string")
+        return op
+
+    def parse(self, args):
+        (opts, extra) = self.op.parse_args(args=args, lineno=self.lineno)
+
+        if extra:
+            msg = "Unexpected arguments to \"%s\" command: %s" % \
+                  (self.currentCmd, " ".join(extra))
+            raise KickstartValueError, formatErrorMsg(self.lineno, msg = msg)
+
+        if opts.processors is not None and opts.processors < 1:
+            msg = "Invalid number of processors: %d" % opts.processors
+            raise KickstartValueError, formatErrorMsg(self.lineno, msg = msg)
+
+        self._setToSelf(self.op, opts)
+
+        return self
@@ -42,8 +42,12 @@ This module uses the FIBMAP ioctl to detect holes.
 #   *  Too few public methods - R0903
 # pylint: disable=R0902,R0903
 
+import os
+import mmap
+import time
 import hashlib
 import logging
+from multiprocessing.pool import ThreadPool
 from mic.utils.misc import human_size
 from mic.utils import Filemap
 
@@ -61,6 +65,10 @@ from mic.utils import Filemap
 #   3.0, and was only fixed in bmap-tools v3.1.
 SUPPORTED_BMAP_VERSION = "2.0"
 
+# The size of the window which is mapped at once when checksums are
+# calculated by worker threads
+_MMAP_WINDOW_SIZE = 64 * 1024 * 1024
+
 _BMAP_START_TEMPLATE = \
 """<?xml version="1.0" ?>
 <!-- This file contains the block map for an image file, which is basically
@@ -147,6 +155,11 @@ class BmapCreate(object):
         self._mapped_count_pos2 = None
         self._chksum_pos = None
 
+        # Statistics of the last 'generate()' call
+        self.ranges_cnt = None
+        self.hashed_bytes = None
+        self.elapsed = None
+
         self._f_image_needs_close = False
         self._f_bmap_needs_close = False
 
@@ -310,12 +323,73 @@ class BmapCreate(object):
 
         return hash_obj.hexdigest()
 
-    def generate(self, include_checksums=True):
+    def _calculate_chksum_mmap(self, blocks_range):
+        """
+        Same as '_calculate_chksum()', but suitable for worker threads: the
+        range is read through an independent file descriptor by mapping it
+        in windows of '_MMAP_WINDOW_SIZE' bytes. Returns the range together
+        with the checksum.
+        """
+
+        first, last = blocks_range
+        start = first * self.block_size
+        end = min((last + 1) * self.block_size, self.image_size)
+        hash_obj = hashlib.new(self._cs_type)
+
+        # Block boundaries are page-aligned, so are the mmap offsets
+        fd = os.open(self._image_path, os.O_RDONLY)
+        try:
+            while start < end:
+                length = min(end - start, _MMAP_WINDOW_SIZE)
+                mapping = mmap.mmap(fd, length, mmap.MAP_SHARED,
+                                    mmap.PROT_READ, offset=start)
+                try:
+                    hash_obj.update(mapping)
+                finally:
+                    mapping.close()
+                start += length
+        finally:
+            os.close(fd)
+
+        return first, last, hash_obj.hexdigest()
+
+    def _get_chksums(self, ranges, workers):
+        """
+        A generator which yields (first, last, checksum) tuples for the
+        mapped 'ranges' in order, calculating the checksums in a pool of
+        'workers' threads.
+        """
+
+        if workers <= 1 or self.block_size % mmap.ALLOCATIONGRANULARITY:
+            for first, last in ranges:
+                yield first, last, self._calculate_chksum(first, last)
+            return
+
+        pool = ThreadPool(workers)
+        try:
+            # hashlib releases the GIL, so the threads do run in parallel
+            for result in pool.imap(self._calculate_chksum_mmap, ranges, 16):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def generate(self, include_checksums=True, workers=1, chksums=None):
         """
         Generate bmap for the image file. If 'include_checksums' is 'True',
-        also generate checksums for block ranges.
+        also generate checksums for block ranges, in 'workers' threads.
+
+        If 'chksums' is given, it is the list of (first, last, checksum)
+        tuples for the mapped block ranges of the image, already calculated
+        while reading it for something else (e.g. compressing), and the
+        image is not read again.
+
+        The 'ranges_cnt', 'hashed_bytes' and 'elapsed' attributes are set
+        to the statistics of the run.
         """
 
+        start_time = time.time()
+
         # Save image file position in order to restore it at the end
         image_pos = self._f_image.tell()
 
@@ -324,10 +398,27 @@ class BmapCreate(object):
         # Generate the block map and write it to the XML block map
         # file as we go.
         self.mapped_cnt = 0
-        for first, last in self.filemap.get_mapped_ranges(0, self.blocks_cnt):
-            self.mapped_cnt += last - first + 1
+        self.ranges_cnt = 0
+        self.hashed_bytes = 0
+
+        if chksums is not None:
+            ranges = chksums
+            if not include_checksums:
+                ranges = ((first, last, None) for first, last, _ in ranges)
+        else:
+            ranges = self.filemap.get_mapped_ranges(0, self.blocks_cnt)
             if include_checksums:
-                chksum = self._calculate_chksum(first, last)
+                ranges = self._get_chksums(ranges, workers)
+            else:
+                ranges = ((first, last, None) for first, last in ranges)
+
+        for first, last, chksum in ranges:
+            self.mapped_cnt += last - first + 1
+            self.ranges_cnt += 1
+            if chksum:
+                self.hashed_bytes += min((last + 1) * self.block_size,
+                                         self.image_size) \
+                                     - first * self.block_size
                 chksum = " chksum=\"%s\"" % chksum
             else:
                 chksum = ""
@@ -352,3 +443,8 @@ class BmapCreate(object):
                         % (self._bmap_path, err))
 
         self._f_image.seek(image_pos)
+
+        self.elapsed = time.time() - start_time
+        self._log.debug("bmap: %d ranges, %s hashed in %.1f seconds"
+                        % (self.ranges_cnt, human_size(self.hashed_bytes),
+                           self.elapsed))
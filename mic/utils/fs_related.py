@@ -69,17 +69,61 @@ def makedirs(dirname):
         if err.errno != errno.EEXIST:
             raise
 
-def mksquashfs(in_img, out_img):
+# the compressors of mksquashfs
+SQUASHFS_COMPRESSORS = ("gzip", "lzo", "lz4", "xz", "zstd")
+
+def get_allocated_size(path):
+    """ The bytes allocated to the files under 'path', without the holes """
+    if not os.path.isdir(path):
+        return os.lstat(path).st_blocks * 512
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.lstat(os.path.join(root, name)).st_blocks * 512
+    return size
+
+def mksquashfs(in_img, out_img, options = None):
+    """ Squash 'in_img' into 'out_img'. 'options' is a dict of the
+    'compressor', 'block_size', 'processors' and 'mem' settings of
+    mksquashfs, its defaults are used for the ones not set. Returns a dict
+    of the sizes of the input data and of the output in bytes, and of the
+    time it took in seconds. """
     fullpathmksquashfs = find_binary_path("mksquashfs")
     args = [fullpathmksquashfs, in_img, out_img]
 
+    options = options or {}
+    if options.get('compressor'):
+        args.extend(["-comp", options['compressor']])
+    if options.get('block_size'):
+        args.extend(["-b", str(options['block_size'])])
+    if options.get('processors'):
+        args.extend(["-processors", str(options['processors'])])
+    if options.get('mem'):
+        args.extend(["-mem", str(options['mem'])])
+
     if not sys.stdout.isatty():
         args.append("-no-progress")
 
+    start = time.time()
     ret = runner.show(args)
     if ret != 0:
         raise SquashfsError("'%s' exited with error (%d)" % (' '.join(args), ret))
 
+    stats = {'input': get_allocated_size(in_img),
+             'output': os.path.getsize(out_img),
+             'seconds': round(time.time() - start, 3)}
+    msger.info("Squashed %.1fM into %.1fM (%.1f%%) in %.1fs, %.1fM/s" %
+               (stats['input'] / 1024.0 / 1024, stats['output'] / 1024.0 / 1024,
+                stats['output'] * 100.0 / max(stats['input'], 1),
+                stats['seconds'],
+                stats['input'] / 1024.0 / 1024 / max(stats['seconds'], 0.001)))
+    return stats
+
+# the maximal number of resize2fs runs to search for the minimal size of
+# a filesystem, when resize2fs can't estimate it
+MAX_RESIZE_PROBES = 16
+
 def resize2fs(fs, size):
     resize2fs = find_binary_path("resize2fs")
     if size == 0:
@@ -357,6 +401,7 @@ class DiskMount(Mount):
         self.rmmountdir = rmmountdir
 
         self.mounted = False
+        self.formatted = False
         self.rmdir   = False
         if fstype:
             self.mkfscmd = find_binary_path("mkfs." + self.fstype)
@@ -487,8 +532,16 @@ class ExtDiskMount(DiskMount):
         else:
             self.__format_filesystem()
 
-    def mount(self, options = None):
+    def format(self):
+        """ Create the disk and the file system ahead of mount() """
         self.__create()
+        self.formatted = True
+
+    def mount(self, options = None):
+        # a remount creates (e.g. resizes) the file system again
+        if not self.formatted:
+            self.__create()
+        self.formatted = False
         DiskMount.mount(self, options)
 
     def __fsck(self):
@@ -499,24 +552,65 @@ class ExtDiskMount(DiskMount):
         return int(self.__parse_field(runner.outs([self.dumpe2fs, '-h', self.disk.lofile]),
                                       "Block count")) * self.blocksize
 
+    def __get_minimal_size_estimate(self):
+        """ Ask resize2fs for the minimal size of the filesystem, in bytes,
+        None if it can't estimate it. """
+        rc, out = runner.runtool([find_binary_path("resize2fs"), "-P",
+                                  self.disk.lofile], catch=3)
+        if rc != 0:
+            return None
+
+        try:
+            blocks = self.__parse_field(out,
+                            "Estimated minimum size of the filesystem")
+            return int(blocks) * self.blocksize
+        except (KeyError, ValueError):
+            return None
+
     def __resize_to_minimal(self):
         msger.info("Resizing filesystem to minimal ...")
         self.__fsck()
 
+        start = time.time()
+        resizes = 0
+
+        top = self.__get_size_from_filesystem()
+        bot = 0
+
+        # Resizing to the estimate of resize2fs normally just works, so it
+        # takes a single resize
+        estimate = self.__get_minimal_size_estimate()
+        if estimate is not None and estimate < top:
+            resizes += 1
+            if not resize2fs(self.disk.lofile, estimate):
+                msger.debug("Resized %s to minimal %d bytes with 1 resize2fs "
+                            "run in %.1f seconds" % (self.disk.lofile,
+                            estimate, time.time() - start))
+                return estimate
+            bot = estimate
+
         #
-        # Use a binary search to find the minimal size
-        # we can resize the image to
+        # Otherwise use a binary search in filesystem blocks to find the
+        # minimal size we can resize the image to, but give up refining
+        # it after MAX_RESIZE_PROBES attempts
         #
-        bot = 0
-        top = self.__get_size_from_filesystem()
-        while top != (bot + 1):
+        bot /= self.blocksize
+        top /= self.blocksize
+        while top > (bot + 1) and resizes < MAX_RESIZE_PROBES:
             t = bot + ((top - bot) / 2)
 
-            if not resize2fs(self.disk.lofile, t):
+            resizes += 1
+            if not resize2fs(self.disk.lofile, t * self.blocksize):
                 top = t
             else:
                 bot = t
-        return top
+
+        # every successful probe lowers 'top', so the filesystem is
+        # already resized to it
+        msger.debug("Resized %s to minimal %d bytes with %d resize2fs runs in "
+                    "%.1f seconds" % (self.disk.lofile, top * self.blocksize,
+                                      resizes, time.time() - start))
+        return top * self.blocksize
 
     def resparse(self, size = None):
         self.cleanup()
@@ -584,8 +678,16 @@ class VfatDiskMount(DiskMount):
         else:
             self.__format_filesystem()
 
-    def mount(self, options = None):
+    def format(self):
+        """ Create the disk and the file system ahead of mount() """
         self.__create()
+        self.formatted = True
+
+    def mount(self, options = None):
+        # a remount creates (e.g. resizes) the file system again
+        if not self.formatted:
+            self.__create()
+        self.formatted = False
         DiskMount.mount(self, options)
 
     def __fsck(self):
@@ -687,8 +789,16 @@ class BtrfsDiskMount(DiskMount):
         else:
             self.__format_filesystem()
 
-    def mount(self, options = None):
+    def format(self):
+        """ Create the disk and the file system ahead of mount() """
         self.__create()
+        self.formatted = True
+
+    def mount(self, options = None):
+        # a remount creates (e.g. resizes) the file system again
+        if not self.formatted:
+            self.__create()
+        self.formatted = False
         DiskMount.mount(self, options)
 
     def __fsck(self):
@@ -710,6 +820,277 @@ class BtrfsDiskMount(DiskMount):
         self.__resize_filesystem(size)
         return minsize
 
+# the max number of mkfs runs to create a file system of the minimal size
+# from a directory, each one growing the estimate by MKFS_GROWTH percents
+MKFS_MAX_ATTEMPTS = 8
+MKFS_GROWTH = 10
+
+# the ext[234] layout parameters mke2fs uses by default
+EXT_INODE_SIZE = 256
+EXT_BLOCKS_PER_GROUP = 32768
+
+def get_ext_journal_blocks(blocks):
+    """ The number of blocks of the journal mke2fs creates in an ext3/4
+    filesystem of 'blocks' blocks """
+    if blocks < 2048:
+        return 0
+    if blocks < 32768:
+        return 1024
+    if blocks < 256 * 1024:
+        return 4096
+    if blocks < 512 * 1024:
+        return 8192
+    if blocks < 4096 * 1024:
+        return 16384
+    if blocks < 8192 * 1024:
+        return 32768
+    if blocks < 16384 * 1024:
+        return 65536
+    if blocks < 32768 * 1024:
+        return 131072
+    return 262144
+
+def get_tree_usage(path, blocksize):
+    """ Returns (blocks, inodes), the number of 'blocksize' bytes blocks
+    and of inodes the tree 'path' uses in a file system, the holes of the
+    files are not counted and the hard linked files are counted once """
+    blocks = inodes = 1
+    seen = set()
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            st = os.lstat(os.path.join(root, name))
+            if not stat.S_ISDIR(st.st_mode) and st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+
+            inodes += 1
+            if stat.S_ISREG(st.st_mode):
+                blocks += min((st.st_size + blocksize - 1) / blocksize,
+                              (st.st_blocks * 512 + blocksize - 1) / blocksize)
+            elif stat.S_ISDIR(st.st_mode):
+                blocks += max(1, (st.st_size + blocksize - 1) / blocksize)
+            elif stat.S_ISLNK(st.st_mode) and st.st_size >= 60:
+                # the shorter targets fit in the inode
+                blocks += 1
+
+    return (blocks, inodes)
+
+class FileDisk(Disk):
+    """A Disk backed by a region of a file, which is never attached to a
+    loop device: mkfs writes the file system into the file directly.
+    """
+    def __init__(self, lofile, size, offset = 0):
+        Disk.__init__(self, size)
+        self.lofile = lofile
+        self.offset = offset
+
+    def fixed(self):
+        return True
+
+    def exists(self):
+        return os.path.exists(self.lofile)
+
+    def create(self):
+        """ Create the file as a sparse file, large enough for the region """
+        makedirs(os.path.dirname(self.lofile))
+        fd = os.open(self.lofile, os.O_WRONLY | os.O_CREAT, 0644)
+        try:
+            if os.fstat(fd).st_size < self.offset + self.size:
+                os.ftruncate(fd, self.offset + self.size)
+        finally:
+            os.close(fd)
+
+    def recreate(self, size):
+        """ Drop the content of the file, which holds this region only, and
+        make it 'size' bytes big """
+        if self.offset:
+            raise MountError("Can't resize the region at %d of %s" %
+                             (self.offset, self.lofile))
+
+        msger.debug("Recreating sparse file %s of %d bytes" %
+                    (self.lofile, size))
+        self._size = size
+        fd = os.open(self.lofile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+
+class DirDiskMount(Mount):
+    """A Mount object for a file system created from the tree of its mount
+    directory: nothing is mounted, the system is installed into a plain
+    directory and build() writes it into a FileDisk with mkfs. It takes
+    no loop device, and the file system is created at its minimal size
+    right away instead of being shrunk by resizes.
+
+    Subclasses provide the file system specific methods:
+    _estimate_size(blocks, inodes) returning the size in bytes of a file
+    system holding 'blocks' blocks of data in 'inodes' inodes, and
+    _mkfs(size) creating the file system of 'size' bytes from the tree
+    and returning (rc, errout).
+    """
+    def __init__(self, disk, mountdir, fstype, blocksize, fslabel,
+                 fsopts = None, fsuuid = None):
+        Mount.__init__(self, mountdir)
+        self.disk = disk
+        self.fstype = fstype
+        self.blocksize = blocksize
+        self.fslabel = fslabel.replace("/", "")
+        self.fsopts = fsopts
+        self.uuid = fsuuid
+        self.mkfscmd = find_binary_path("mkfs." + self.fstype)
+
+    def mount(self, options = None):
+        makedirs(self.mountdir)
+
+    def build(self, size = None, parkdir = None):
+        """ Create the file system from the tree of the mount directory.
+        'size' is the size of the file system in bytes, the size of the
+        disk if None, the minimal size if 0. The tree is moved into
+        'parkdir' if given, leaving the mount directory empty so that it
+        isn't part of the file system of a parent mount point. Returns the
+        size of the file system. """
+        if size is None:
+            size = self.disk.size
+
+        minimal = not size
+        if minimal:
+            size = self._estimate_size(*get_tree_usage(self.mountdir,
+                                                       self.blocksize))
+
+        start = time.time()
+        for attempt in range(MKFS_MAX_ATTEMPTS):
+            if minimal:
+                self.disk.recreate(size)
+            else:
+                self.disk.create()
+
+            rc, errout = self._mkfs(size)
+            if rc == 0:
+                break
+            if not minimal or attempt == MKFS_MAX_ATTEMPTS - 1:
+                raise MountError("Error creating %s filesystem from %s on "
+                                 "%s:\n%s" % (self.fstype, self.mountdir,
+                                              self.disk.lofile, errout))
+
+            msger.debug("%d bytes are too few for %s, retrying bigger" %
+                        (size, self.mountdir))
+            size += size * MKFS_GROWTH / 100
+            size -= size % self.blocksize
+
+        msger.info("Created %s filesystem of %.1fM from %s in %.1fs" %
+                   (self.fstype, size / 1024.0 / 1024, self.mountdir,
+                    time.time() - start))
+
+        if parkdir:
+            os.rename(self.mountdir, os.path.join(parkdir,
+                      self.mountdir.strip("/").replace("/", "-")))
+            os.mkdir(self.mountdir, 0755)
+        return size
+
+class ExtDirMount(DirDiskMount):
+    """A DirDiskMount object creating ext[234] filesystems with mke2fs -d."""
+    def __init__(self, disk, mountdir, fstype, blocksize, fslabel,
+                 fsopts = None, fsuuid = None):
+        DirDiskMount.__init__(self, disk, mountdir, fstype, blocksize,
+                              fslabel, fsopts, fsuuid or str(uuid.uuid4()))
+        self.extopts = None
+        self.inodes = None
+        self.tune2fs = find_binary_path("tune2fs")
+
+    def _estimate_size(self, blocks, inodes):
+        # room for a few more files and directories
+        self.inodes = inodes + inodes / 16 + 16
+        blocks += (self.inodes * EXT_INODE_SIZE + self.blocksize - 1) / \
+                  self.blocksize
+        if self.fstype != "ext2":
+            blocks += get_ext_journal_blocks(blocks)
+
+        # the bitmaps, the group descriptors and the reserved blocks
+        blocks += blocks / 50 + 256
+        blocks += (blocks / EXT_BLOCKS_PER_GROUP + 1) * 64
+        return blocks * self.blocksize
+
+    def _get_device(self):
+        """ The path of the disk for the e2fsprogs """
+        if self.disk.offset:
+            return "%s?offset=%d" % (self.disk.lofile, self.disk.offset)
+        return self.disk.lofile
+
+    def _mkfs(self, size):
+        cmdlist = [self.mkfscmd, "-F", "-L", self.fslabel, "-m", "1", "-b",
+                   str(self.blocksize), "-U", self.uuid]
+        if self.inodes:
+            cmdlist.extend(["-N", str(self.inodes)])
+
+        extopts = []
+        if self.extopts:
+            extopts = self.extopts.split()
+        if self.disk.offset:
+            offset = "offset=%d" % self.disk.offset
+            if "-E" in extopts[:-1]:
+                index = extopts.index("-E") + 1
+                extopts[index] += "," + offset
+            else:
+                extopts.extend(["-E", offset])
+        cmdlist.extend(extopts)
+        cmdlist.extend(["-d", self.mountdir, self.disk.lofile,
+                        str(size / self.blocksize)])
+
+        msger.verbose("Creating %s filesystem from %s on %s" %
+                      (self.fstype, self.mountdir, self._get_device()))
+        rc, errout = runner.runtool(cmdlist, catch=2)
+        if rc == 0 and not self.extopts:
+            msger.debug("Tuning filesystem on %s" % self._get_device())
+            runner.show([self.tune2fs, "-c0", "-i0", "-Odir_index",
+                         "-ouser_xattr,acl", self._get_device()])
+        return (rc, errout)
+
+class VfatDirMount(DirDiskMount):
+    """A DirDiskMount object creating vfat/msdos filesystems with mkfs and
+    copying the tree into them with mtools."""
+    def __init__(self, disk, mountdir, fstype, blocksize, fslabel,
+                 fsopts = None, fsuuid = None):
+        rand1 = random.randint(0, 2**16 - 1)
+        rand2 = random.randint(0, 2**16 - 1)
+        DirDiskMount.__init__(self, disk, mountdir, fstype, blocksize,
+                              fslabel, fsopts,
+                              fsuuid or "%04X-%04X" % (rand1, rand2))
+        self.mcopy = find_binary_path("mcopy")
+
+    def _estimate_size(self, blocks, inodes):
+        # the long names take a few more directory entries, and each
+        # cluster takes 4 bytes in both FATs
+        blocks += inodes * 32 * 3 / self.blocksize + 1
+        size = blocks * self.blocksize + blocks * 8 + 1024 * 1024
+        size += size / 20
+        return size - size % self.blocksize + self.blocksize
+
+    def _mkfs(self, size):
+        cmdlist = [self.mkfscmd, "-n", self.fslabel,
+                   "-i", self.uuid.replace("-", "")]
+        if self.disk.offset:
+            cmdlist.extend(["--offset", str(self.disk.offset / 512)])
+        cmdlist.extend([self.disk.lofile, str(size / 1024)])
+
+        msger.verbose("Creating %s filesystem from %s on %s" %
+                      (self.fstype, self.mountdir, self.disk.lofile))
+        rc, errout = runner.runtool(cmdlist, catch=2)
+        if rc != 0:
+            return (rc, errout)
+
+        entries = [os.path.join(self.mountdir, name)
+                   for name in sorted(os.listdir(self.mountdir))]
+        if not entries:
+            return (rc, errout)
+
+        # mtools would refuse the geometry of an image file
+        image = "%s@@%d" % (self.disk.lofile, self.disk.offset)
+        return runner.runtool(["env", "MTOOLS_SKIP_CHECK=1", self.mcopy,
+                               "-s", "-p", "-m", "-Q", "-i", image] +
+                              entries + ["::/"], catch=2)
+
 class DeviceMapperSnapshot(object):
     def __init__(self, imgloop, cowloop):
         self.imgloop = imgloop
@@ -833,12 +1214,61 @@ def load_module(module):
         msger.info("Loading %s..." % module)
         runner.quiet(['modprobe', module])
 
+# the max seconds to wait for a loop device to show up or to be detached
+LOOP_WAIT_TIMEOUT = 5
+# the seconds between two checks while waiting for a loop device
+LOOP_POLL_INTERVAL = 0.01
+
+def _get_sysfs_dir(device):
+    """ The sysfs directory of the block device 'device', None if sysfs
+    doesn't expose it """
+    path = os.path.join("/sys/block",
+                        os.path.basename(os.path.realpath(device)))
+    if not os.path.isdir(path):
+        return None
+    return path
+
+def loop_is_attached(device):
+    """ Check in sysfs if the loop device 'device' is attached to a file or
+    a device, None if sysfs can't tell """
+    path = _get_sysfs_dir(device)
+    if path is None:
+        return None
+    return os.path.exists(os.path.join(path, "loop", "backing_file"))
+
+def get_holders(device):
+    """ The names of the devices stacked on the block device 'device' (e.g.
+    the device-mapper partitions of kpartx), None if sysfs can't tell """
+    path = _get_sysfs_dir(device)
+    if path is None or not os.path.isdir(os.path.join(path, "holders")):
+        return None
+    return os.listdir(os.path.join(path, "holders"))
+
+def wait_until(check, timeout = LOOP_WAIT_TIMEOUT):
+    """ Poll 'check()' until it's true or the deadline 'timeout' seconds
+    away is passed, returns the last result of 'check()' """
+    deadline = time.time() + timeout
+    while True:
+        result = check()
+        if result or time.time() >= deadline:
+            return result
+        time.sleep(LOOP_POLL_INTERVAL)
+
+def wait_for_device(device, timeout = LOOP_WAIT_TIMEOUT):
+    """ Wait until the block device node 'device' exists, e.g. when it's
+    created by udev, returns False if it doesn't show up in time """
+    def exists():
+        try:
+            return stat.S_ISBLK(os.stat(device).st_mode)
+        except OSError:
+            return False
+    return wait_until(exists, timeout)
+
 class LoopDevice(object):
     def __init__(self, loopid=None):
         self.device = None
         self.loopid = loopid
         self.created = False
-        self.kpartxcmd = find_binary_path("kpartx")
         self.losetupcmd = find_binary_path("losetup")
 
     def register(self, device):
@@ -863,7 +1293,12 @@ class LoopDevice(object):
         return maxid
 
     def _kpseek(self, device):
-        rc, out = runner.runtool([self.kpartxcmd, '-l', '-v', device])
+        holders = get_holders(device)
+        if holders is not None:
+            return len(holders) > 0
+
+        rc, out = runner.runtool([find_binary_path("kpartx"), '-l', '-v',
+                                  device])
         if rc != 0:
             raise MountError("Can't query dm snapshot on %s" % device)
         for line in out.splitlines():
@@ -872,6 +1307,10 @@ class LoopDevice(object):
         return False
 
     def _loseek(self, device):
+        attached = loop_is_attached(device)
+        if attached is not None:
+            return attached
+
         import re
         rc, out = runner.runtool([self.losetupcmd, '-a'])
         if rc != 0:
@@ -916,10 +1355,15 @@ class LoopDevice(object):
 
 
         if self._kpseek(self.device):
-            runner.quiet([self.kpartxcmd, "-d", self.device])
+            try:
+                runner.quiet([find_binary_path("kpartx"), "-d", self.device])
+            except CreatorError:
+                msger.warning("Can't remove the partition mappings of %s"
+                              % self.device)
         if self._loseek(self.device):
             runner.quiet([self.losetupcmd, "-d", self.device])
-        # FIXME: should sleep a while between two loseek
+            # a busy loop device is detached when its last user closes it
+            wait_until(lambda: not self._loseek(self.device))
         if self._loseek(self.device):
             msger.warning("Can't cleanup loop device %s" % self.device)
         elif self.loopid:
@@ -928,7 +1372,9 @@ class LoopDevice(object):
 DEVICE_PIDFILE_DIR = "/var/tmp/mic/device"
 DEVICE_LOCKFILE = "/var/lock/__mic_loopdev.lock"
 
-def get_loop_device(losetupcmd, lofile):
+def get_loop_device(losetupcmd, lofile, options = None):
+    """ Attach a free loop device to 'lofile' and return it, 'options' is a
+    list of extra options of losetup, e.g. an offset """
     global DEVICE_PIDFILE_DIR
     global DEVICE_LOCKFILE
 
@@ -953,9 +1399,11 @@ def get_loop_device(losetupcmd, lofile):
             loopdev = devinst.device
 
         # setup a loop device for image file
-        rc = runner.show([losetupcmd, loopdev, lofile])
+        rc = runner.show([losetupcmd] + (options or []) + [loopdev, lofile])
         if rc != 0:
             raise MountError("Failed to setup loop device for '%s'" % lofile)
+        if not wait_for_device(loopdev):
+            raise MountError("Loop device %s didn't show up" % loopdev)
 
         devinst.reg_atexit()
 
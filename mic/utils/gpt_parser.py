@@ -16,8 +16,10 @@
 # Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
 """ This module implements a simple GPT partitions parser which can read the
-GPT header and the GPT partition table. """
+GPT header and the GPT partition table, and a writer which creates a whole
+msdos or GPT partition table in one pass. """
 
+import os
 import struct
 import uuid
 import binascii
@@ -29,6 +31,34 @@ _GPT_ENTRY_FORMAT = "<16s16sQQQ72s"
 _GPT_ENTRY_SIZE = struct.calcsize(_GPT_ENTRY_FORMAT)
 _SUPPORTED_GPT_REVISION = '\x00\x00\x01\x00'
 
+# The number of entries of the GPT partition tables written, which take 32
+# sectors, as created by parted
+GPT_ENTRIES = 128
+# The name parted gives to the GPT partitions created by mic
+GPT_PART_NAME = "primary"
+# The "legacy BIOS bootable" attribute of GPT partitions
+GPT_LEGACY_BOOT = 1 << 2
+
+# GPT partition type UUIDs of the file-systems
+GPT_TYPE_LINUX = "0FC63DAF-8483-4772-8E79-3D69D8477DE4"
+GPT_TYPE_SWAP = "0657FD6D-A4AB-43C4-84E5-0933C84B4F4F"
+GPT_TYPE_BASIC_DATA = "EBD0A0A2-B9E5-4433-87C0-68B6B72699C7"
+
+_MBR_ENTRY_FORMAT = "<B3sB3sII"
+_MBR_ENTRY_SIZE = struct.calcsize(_MBR_ENTRY_FORMAT)
+_MBR_PTABLE_OFFS = 446
+_MBR_SIGNATURE_OFFS = 440
+_MBR_SIGNATURE = '\x55\xAA'
+_MBR_BOOTABLE = 0x80
+
+# MBR partition types of the file-systems
+MBR_TYPE_LINUX = 0x83
+MBR_TYPE_SWAP = 0x82
+MBR_TYPE_FAT16 = 0x0E
+MBR_TYPE_FAT32 = 0x0C
+MBR_TYPE_EXTENDED = 0x0F
+MBR_TYPE_GPT = 0xEE
+
 def _stringify_uuid(binary_uuid):
     """ A small helper function to transform a binary UUID into a string
     format. """
@@ -329,3 +359,250 @@ class GptParser:
         # Change the backup partition table
         header = self.read_header(False)
         self._change_partition(header, entry)
+
+def _lba_to_chs(lba):
+    """ Convert 'lba' to the packed CHS address of a MBR partition entry,
+    with the usual 255 heads and 63 sectors per track geometry, or to the
+    max CHS address for the LBAs out of its range. """
+
+    heads, sectors = 255, 63
+    cyl = lba / (heads * sectors)
+    if cyl > 1023:
+        return '\xFE\xFF\xFF'
+
+    head = (lba / sectors) % heads
+    sector = lba % sectors + 1
+    return struct.pack("<BBB", head, sector | ((cyl >> 2) & 0xC0), cyl & 0xFF)
+
+def _pack_mbr_entry(status, ptype, start, size):
+    """ Pack a MBR partition entry of 'size' sectors starting at LBA
+    'start'. """
+
+    if not size:
+        return '\0' * _MBR_ENTRY_SIZE
+
+    return struct.pack(_MBR_ENTRY_FORMAT, status, _lba_to_chs(start), ptype,
+                       _lba_to_chs(start + size - 1), start, size)
+
+def _pack_mbr(entries, disk_signature = 0):
+    """ Pack a MBR or EBR sector containing the 'entries' list of raw
+    partition entries, without boot code. """
+
+    sector = '\0' * _MBR_SIGNATURE_OFFS
+    sector += struct.pack("<I", disk_signature) + '\0\0'
+    sector += "".join(entries)
+    sector += '\0' * (_MBR_ENTRY_SIZE * (4 - len(entries)))
+    return sector + _MBR_SIGNATURE
+
+def _get_mbr_type(fstype):
+    if fstype == "swap":
+        return MBR_TYPE_SWAP
+    elif fstype == "vfat":
+        return MBR_TYPE_FAT32
+    elif fstype == "msdos":
+        return MBR_TYPE_FAT16
+    return MBR_TYPE_LINUX
+
+def _get_gpt_type(fstype):
+    if fstype == "swap":
+        return GPT_TYPE_SWAP
+    elif fstype in ("vfat", "msdos"):
+        return GPT_TYPE_BASIC_DATA
+    return GPT_TYPE_LINUX
+
+class PartitionTableWriter:
+    """ Partition table writer. Creates a whole msdos partition table (the
+    MBR and the EBR chain of the logical partitions) or GPT partition table
+    (the protective MBR and the primary and backup GPT headers and tables),
+    replacing whatever partition table the disk has. """
+
+    def __init__(self, disk_path, sector_size = 512):
+        """ The class constructor which accepts the following parameters:
+            * disk_path - full path to the disk image or device node
+            * sector_size - size of a disk sector in bytes """
+
+        self.sector_size = sector_size
+        self.disk_path = disk_path
+
+    def _get_disk_sectors(self):
+        try:
+            fd = os.open(self.disk_path, os.O_RDONLY)
+            try:
+                return os.lseek(fd, 0, os.SEEK_END) / self.sector_size
+            finally:
+                os.close(fd)
+        except OSError as err:
+            raise MountError("Cannot get the size of '%s': %s" % \
+                             (self.disk_path, err))
+
+    def _sector(self, data):
+        """ Pad 'data' to a whole number of sectors. """
+
+        rem = len(data) % self.sector_size
+        if rem:
+            data += '\0' * (self.sector_size - rem)
+        return data
+
+    def build_msdos(self, partitions, disk_signature = None):
+        """ Return the list of (LBA, data) to write for the msdos partition
+        table of the 'partitions' list, each partition is a dictionary with
+        the following elements, as laid out by 'PartitionedMount':
+
+        'num'    : the partition number, 1 to 4 for primary partitions and
+                   from 5 for logical partitions
+        'type'   : "primary" or "logical"
+        'start'  : the first LBA of the partition
+        'size'   : the size of the partition in sectors
+        'fstype' : the file-system type of the partition
+        'boot'   : a boolean, if 'True', the partition is bootable
+
+        The logical partitions have to be in order, and a free sector has to
+        precede each one of them, where its EBR is written. The extended
+        partition spans from the EBR of the first logical partition to the
+        end of the last one. """
+
+        if disk_signature is None:
+            disk_signature = struct.unpack("<I", os.urandom(4))[0]
+
+        primaries = [p for p in partitions if p['type'] != 'logical']
+        logicals = sorted([p for p in partitions if p['type'] == 'logical'],
+                          key = lambda p: p['num'])
+
+        slots = [None] * 4
+        for p in primaries:
+            if not 1 <= p['num'] <= 4 or slots[p['num'] - 1]:
+                raise MountError("Bad primary partition number %d" % p['num'])
+            status = p['boot'] and _MBR_BOOTABLE or 0
+            slots[p['num'] - 1] = _pack_mbr_entry(status,
+                                                  _get_mbr_type(p['fstype']),
+                                                  p['start'], p['size'])
+
+        writes = []
+        if logicals:
+            ext_start = logicals[0]['start'] - 1
+            ext_size = logicals[-1]['start'] + logicals[-1]['size'] - ext_start
+            ext_num = len([slot for slot in slots if slot]) + 1
+            if ext_num > 4:
+                raise MountError("No room for the extended partition in the "
+                                 "MBR of '%s'" % self.disk_path)
+            slots[ext_num - 1] = _pack_mbr_entry(0, MBR_TYPE_EXTENDED,
+                                                 ext_start, ext_size)
+
+            for index, p in enumerate(logicals):
+                ebr = p['start'] - 1
+                if index and ebr < logicals[index - 1]['start'] + \
+                                   logicals[index - 1]['size']:
+                    raise MountError("No room for the EBR of partition %d"
+                                     % p['num'])
+
+                # the logical partition, relative to its EBR
+                status = p['boot'] and _MBR_BOOTABLE or 0
+                entries = [_pack_mbr_entry(status, _get_mbr_type(p['fstype']),
+                                           p['start'] - ebr, p['size'])]
+                if index + 1 < len(logicals):
+                    # the link to the next EBR, relative to the extended
+                    # partition, up to the end of the next logical partition
+                    nxt = logicals[index + 1]
+                    entries.append(_pack_mbr_entry(0, MBR_TYPE_EXTENDED,
+                                                   nxt['start'] - 1 - ext_start,
+                                                   nxt['size'] + 1))
+                writes.append((ebr, _pack_mbr(entries)))
+
+        slots = [slot or '\0' * _MBR_ENTRY_SIZE for slot in slots]
+        writes.insert(0, (0, _pack_mbr(slots, disk_signature)))
+        return writes
+
+    def build_gpt(self, partitions, disk_sectors, disk_uuid = None):
+        """ Return the list of (LBA, data) to write for the GPT partition
+        table of the 'partitions' list on a disk of 'disk_sectors' sectors.
+        The partitions are dictionaries with the same elements as for
+        'build_msdos()' and the following ones:
+
+        'part_type' : the partition type UUID, None for the type matching
+                      'fstype'
+        'partuuid'  : the partition UUID, None to generate it, in which case
+                      it is set in the dictionary
+
+        The "legacy_boot" attribute is set for the bootable partitions. """
+
+        last_lba = disk_sectors - 1
+        ptable_sectors = GPT_ENTRIES * _GPT_ENTRY_SIZE / self.sector_size
+        first_usable = 2 + ptable_sectors
+        last_usable = last_lba - 1 - ptable_sectors
+        if last_usable < first_usable:
+            raise MountError("Disk '%s' is too small for a GPT partition " \
+                             "table" % self.disk_path)
+
+        if disk_uuid is None:
+            disk_uuid = str(uuid.uuid4()).upper()
+
+        entries = ['\0' * _GPT_ENTRY_SIZE] * GPT_ENTRIES
+        for p in partitions:
+            if not 1 <= p['num'] <= GPT_ENTRIES:
+                raise MountError("Bad GPT partition number %d" % p['num'])
+            end = p['start'] + p['size'] - 1
+            if p['start'] < first_usable or end > last_usable:
+                raise MountError("Partition %d (sectors %d-%d) is out of " \
+                                 "the usable sectors %d-%d of '%s'" % \
+                                 (p['num'], p['start'], end, first_usable,
+                                  last_usable, self.disk_path))
+
+            if not p.get('partuuid'):
+                p['partuuid'] = str(uuid.uuid4()).upper()
+            flags = p['boot'] and GPT_LEGACY_BOOT or 0
+            entries[p['num'] - 1] = struct.pack(_GPT_ENTRY_FORMAT,
+                uuid.UUID(p.get('part_type') or \
+                          _get_gpt_type(p['fstype'])).bytes_le,
+                uuid.UUID(p['partuuid']).bytes_le,
+                p['start'], end, flags,
+                GPT_PART_NAME.encode('UTF-16LE'))
+
+        raw_ptable = "".join(entries)
+        ptable_crc = binascii.crc32(raw_ptable) & 0xFFFFFFFF
+
+        def pack_header(hdr_lba, backup_lba, ptable_lba):
+            raw_hdr = ['EFI PART', _SUPPORTED_GPT_REVISION, _GPT_HEADER_SIZE,
+                       0, 0, hdr_lba, backup_lba, first_usable, last_usable,
+                       uuid.UUID(disk_uuid).bytes_le, ptable_lba,
+                       GPT_ENTRIES, _GPT_ENTRY_SIZE, ptable_crc]
+            raw_hdr[3] = _calc_header_crc(raw_hdr)
+            return self._sector(struct.pack(_GPT_HEADER_FORMAT, *raw_hdr))
+
+        # the protective MBR covers the whole disk, or as much as it can
+        pmbr = _pack_mbr([_pack_mbr_entry(0, MBR_TYPE_GPT, 1,
+                                          min(last_lba, 0xFFFFFFFF))])
+
+        return [(0, pmbr),
+                (1, pack_header(1, last_lba, 2)),
+                (2, raw_ptable),
+                (last_usable + 1, raw_ptable),
+                (last_lba, pack_header(last_lba, 1, last_usable + 1))]
+
+    def write(self, ptable_format, partitions):
+        """ Write the "msdos" or "gpt" partition table of the 'partitions'
+        list, see 'build_msdos()' and 'build_gpt()', to the disk. """
+
+        if ptable_format == "msdos":
+            writes = self.build_msdos(partitions)
+        elif ptable_format == "gpt":
+            writes = self.build_gpt(partitions, self._get_disk_sectors())
+        else:
+            raise MountError("Unknown partition table format '%s'" % \
+                             ptable_format)
+
+        try:
+            fd = os.open(self.disk_path, os.O_WRONLY)
+        except OSError as err:
+            raise MountError("Cannot open '%s' for writing the partition " \
+                             "table: %s" % (self.disk_path, err))
+        try:
+            try:
+                for lba, data in writes:
+                    os.lseek(fd, lba * self.sector_size, os.SEEK_SET)
+                    os.write(fd, self._sector(data))
+                os.fsync(fd)
+            except OSError as err:
+                raise MountError("Cannot write the partition table to " \
+                                 "'%s': %s" % (self.disk_path, err))
+        finally:
+            os.close(fd)
@@ -2,9 +2,14 @@
 
 import os
 import sys
+import time
 import fcntl
+import signal
 import struct
 import termios
+import urlparse
+import threading
+import multiprocessing
 
 from mic import msger
 from mic.utils import runner
@@ -14,7 +19,203 @@ from mic.utils.safeurl import SafeURL
 from urlgrabber import grabber
 from urlgrabber import __version__ as grabber_version
 
-def myurlgrab(url, filename, proxies, progress_obj = None):
+try:
+    import pycurl
+except ImportError:
+    pycurl = None
+
+# the max number of unused sessions a process keeps, and the seconds it
+# keeps each of them
+MAX_IDLE_SESSIONS = 8
+SESSION_IDLE_TIMEOUT = 60
+
+# the seconds to connect, and to wait for data before giving up
+CONNECT_TIMEOUT = 30
+LOW_SPEED_TIME = 300
+
+class URLSession(object):
+    """ A curl handle downloading from one host through one proxy, whose
+    connection is kept alive between downloads """
+
+    def __init__(self, key, proxy = None):
+        self.key = key
+        self.curl = pycurl.Curl()
+        self.last_used = time.time()
+        # the headers of the last response, keyed by their lowercase name
+        self.headers = {}
+
+        curl = self.curl
+        curl.setopt(pycurl.HEADERFUNCTION, self._header)
+        curl.setopt(pycurl.FOLLOWLOCATION, 1)
+        curl.setopt(pycurl.MAXREDIRS, 10)
+        curl.setopt(pycurl.FAILONERROR, 1)
+        curl.setopt(pycurl.NOSIGNAL, 1)
+        curl.setopt(pycurl.SSL_VERIFYPEER, 0)
+        curl.setopt(pycurl.SSL_VERIFYHOST, 0)
+        curl.setopt(pycurl.CONNECTTIMEOUT, CONNECT_TIMEOUT)
+        curl.setopt(pycurl.LOW_SPEED_LIMIT, 1)
+        curl.setopt(pycurl.LOW_SPEED_TIME, LOW_SPEED_TIME)
+        if proxy:
+            curl.setopt(pycurl.PROXY, proxy)
+
+    def _header(self, line):
+        if line.startswith("HTTP/"):
+            # a new response, e.g. after a redirection
+            self.headers = {}
+        elif ":" in line:
+            name, value = line.split(":", 1)
+            self.headers[name.strip().lower()] = value.strip()
+
+    def grab(self, url, fobj, http_headers = ()):
+        """ Download 'url' into the file object 'fobj'. Returns whether a
+        new connection was opened for it. """
+        curl = self.curl
+        self.headers = {}
+        curl.setopt(pycurl.URL, url)
+        curl.setopt(pycurl.WRITEFUNCTION, fobj.write)
+        curl.setopt(pycurl.HTTPHEADER,
+                    ["%s: %s" % header for header in http_headers])
+        try:
+            curl.perform()
+        finally:
+            self.last_used = time.time()
+        return curl.getinfo(pycurl.NUM_CONNECTS) > 0
+
+    def close(self):
+        self.curl.close()
+
+class URLSessionPool(object):
+    """ The sessions of a process, keyed by the scheme, host and port of
+    the urls and by their proxy. A session is used by one download at a
+    time; at most 'max_idle' unused sessions are kept, for 'idle_timeout'
+    seconds. """
+
+    def __init__(self, max_idle = MAX_IDLE_SESSIONS,
+                 idle_timeout = SESSION_IDLE_TIMEOUT):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        # key -> unused sessions, the most recently used last
+        self.idle = {}
+        self.stats = {"downloads": 0, "connections": 0, "reused": 0,
+                      "evicted": 0}
+
+    def _idle_sessions(self):
+        for sessions in self.idle.values():
+            for session in sessions:
+                yield session
+
+    def _evict(self, session):
+        self.idle[session.key].remove(session)
+        if not self.idle[session.key]:
+            del self.idle[session.key]
+        session.close()
+        self.stats["evicted"] += 1
+
+    def _prune(self):
+        now = time.time()
+        for session in list(self._idle_sessions()):
+            if now - session.last_used > self.idle_timeout:
+                self._evict(session)
+
+        idle = sorted(self._idle_sessions(),
+                      key = lambda session: session.last_used)
+        for session in idle[:max(len(idle) - self.max_idle, 0)]:
+            self._evict(session)
+
+    def acquire(self, url, proxy = None):
+        """ Returns a session to download 'url' through 'proxy' """
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc.rpartition("@")[2], proxy)
+        with self.lock:
+            self._prune()
+            sessions = self.idle.get(key)
+            if sessions:
+                session = sessions.pop()
+                if not sessions:
+                    del self.idle[key]
+                return session
+        return URLSession(key, proxy)
+
+    def release(self, session, reusable = True):
+        """ Give back a session, which is closed unless 'reusable' """
+        if not reusable:
+            session.close()
+            return
+
+        with self.lock:
+            self.idle.setdefault(session.key, []).append(session)
+            self._prune()
+
+    def record(self, new_connection):
+        with self.lock:
+            self.stats["downloads"] += 1
+            if new_connection:
+                self.stats["connections"] += 1
+            else:
+                self.stats["reused"] += 1
+
+    def merge_stats(self, stats_list):
+        """ Add the counters of the sessions of other processes """
+        with self.lock:
+            for stats in stats_list:
+                for name, value in stats.items():
+                    self.stats[name] += value
+
+    def close_all(self):
+        """ Close all the unused sessions """
+        with self.lock:
+            for session in list(self._idle_sessions()):
+                self._evict(session)
+
+_session_pool = URLSessionPool()
+
+def get_session_stats():
+    """ Returns the counters of the downloads of the sessions of this
+    process: the number of downloads, of the new connections and of the
+    reused ones they made, and of the sessions evicted """
+    with _session_pool.lock:
+        return dict(_session_pool.stats)
+
+def _session_grab(url, filename, proxies, progress_obj, http_headers,
+                  response_headers = None):
+    """ Download 'url' to 'filename' with a session of the pool, the
+    headers of the response are added to the 'response_headers' dict """
+    proxy = None
+    if proxies:
+        proxy = proxies.get(urlparse.urlsplit(url).scheme)
+
+    session = _session_pool.acquire(url, proxy)
+    reusable = False
+    progress_obj.start(filename, url)
+    try:
+        with open(filename, "wb") as fobj:
+            new_connection = session.grab(url, fobj, http_headers)
+        _session_pool.record(new_connection)
+        if response_headers is not None:
+            response_headers.update(session.headers)
+        reusable = True
+    except (pycurl.error, IOError), err:
+        if os.path.exists(filename):
+            os.unlink(filename)
+        if isinstance(err, pycurl.error):
+            # a failure of the server leaves the connection usable
+            reusable = err.args[0] == pycurl.E_HTTP_RETURNED_ERROR
+            err = "[Errno %d] %s" % (err.args[0], err.args[1])
+        raise CreatorError(_grab_error_msg(url, err))
+    finally:
+        _session_pool.release(session, reusable)
+        progress_obj.end()
+
+    return filename
+
+def myurlgrab(url, filename, proxies, progress_obj = None,
+              http_headers = None, response_headers = None):
+    """ Download 'url' to 'filename', 'http_headers' is a sequence of
+    (name, value) of extra headers of the HTTP request. The connections
+    to the servers are kept alive in a pool of sessions of the process,
+    when pycurl is available; the headers of the response are then added
+    to the 'response_headers' dict, keyed by their lowercase name. """
     g = grabber.URLGrabber()
     if progress_obj is None:
         progress_obj = TextProgress()
@@ -29,6 +230,14 @@ def myurlgrab(url, filename, proxies, progress_obj = None):
             # untouch repometadata in source path
             runner.show(['cp', '-f', filepath, filename])
 
+    elif pycurl and url.split(":", 1)[0] in ("http", "https", "ftp"):
+        # cast url to str here, sometimes it can be unicode,
+        # but pycurl only accept str
+        filename = _session_grab(str(url), filename, proxies, progress_obj,
+                                 (('Pragma', 'no-cache'),) + \
+                                 tuple(http_headers or ()),
+                                 response_headers)
+
     else:
         try:
             # cast url to str here, sometimes it can be unicode,
@@ -38,21 +247,227 @@ def myurlgrab(url, filename, proxies, progress_obj = None):
                                  ssl_verify_host=False,
                                  ssl_verify_peer=False,
                                  proxies=proxies,
-                                 http_headers=(('Pragma', 'no-cache'),),
+                                 http_headers=(('Pragma', 'no-cache'),) + \
+                                              tuple(http_headers or ()),
                                  quote=0,
                                  progress_obj=progress_obj)
         except grabber.URLGrabError, err:
-            tmp = SafeURL(url)
+            raise CreatorError(_grab_error_msg(url, err))
+
+    return filename
+
+def _grab_error_msg(url, err):
+    tmp = SafeURL(url)
+    msg = str(err)
+
+    if msg.find(url) < 0:
+        msg += ' on %s' % tmp
+    else:
+        msg = msg.replace(url, tmp)
+    return msg
+
+def myurlopen(url, proxies, http_headers = None):
+    """ Open 'url' for reading, the file object returned reads the data
+    while it is downloaded """
+    if url.startswith("file:/"):
+        filepath = "/%s" % url.replace("file:", "").lstrip('/')
+        if not os.path.exists(filepath):
+            raise CreatorError("URLGrabber error: can't find file %s" % url)
+        return open(filepath, "rb")
+
+    g = grabber.URLGrabber()
+    try:
+        return g.urlopen(url=str(url),
+                         ssl_verify_host=False,
+                         ssl_verify_peer=False,
+                         proxies=proxies,
+                         http_headers=(('Pragma', 'no-cache'),) + \
+                                      tuple(http_headers or ()),
+                         quote=0)
+    except grabber.URLGrabError, err:
+        raise CreatorError(_grab_error_msg(url, err))
+
+def _save_last_modified(filename, last_modified):
+    """ Store the Last-Modified header of the response of 'filename' next
+    to it, in 'filename.last-modified', or remove it if there is none """
+    path = filename + ".last-modified"
+    if last_modified:
+        with open(path, "w") as fobj:
+            fobj.write(last_modified)
+    elif os.path.exists(path):
+        os.unlink(path)
+
+def _fetch(url, filename, proxies, options, progress_obj):
+    """ Download a multi_urlgrab job, the 'stream' function of its options
+    is given the file object of 'url' to store it to 'filename' """
+    if 'stream' not in options:
+        headers = {}
+        filename = myurlgrab(url, filename, proxies, progress_obj,
+                             options.get('http_headers'), headers)
+        if options.get('last_modified'):
+            _save_last_modified(filename, headers.get('last-modified'))
+        return filename
+
+    func, args = options['stream']
+    fobj = myurlopen(url, proxies, options.get('http_headers'))
+    try:
+        return func(fobj, filename, *args)
+    except grabber.URLGrabError, err:
+        raise CreatorError(_grab_error_msg(url, err))
+    finally:
+        fobj.close()
+
+# max concurrent downloads from one host in multi_urlgrab
+MAX_HOST_CONNECTIONS = 4
+
+# host -> semaphore, inherited by the download workers
+_host_slots = {}
+
+def _init_grab_worker(host_slots):
+    global _host_slots, _session_pool
+    _host_slots = host_slots
+    # the counters of the worker are reported to the parent process
+    _session_pool = URLSessionPool()
+    # let the parent process handle Ctrl-C and terminate the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _split_job(job):
+    """ Returns (url, filename, proxies, options) of a multi_urlgrab job """
+    if len(job) == 3:
+        return tuple(job) + ({},)
+    return tuple(job)
+
+def _get_worker_stats():
+    return (os.getpid(), get_session_stats())
+
+def _grab_worker(job):
+    """ Download one file in a worker process, retry with exponential
+    backoff. Errors are returned as message since CreatorError can't be
+    pickled back to the parent process. """
+
+    index, url, filename, proxies, options, retries, backoff = job
+    if options.get('optional'):
+        retries = 0
+    slot = _host_slots.get(urlparse.urlsplit(url).hostname)
+    msg = None
+    for attempt in range(retries + 1):
+        if slot:
+            slot.acquire()
+        try:
+            path = _fetch(url, filename, proxies, options, NullProgress())
+            return (index, path, None, _get_worker_stats())
+        except CreatorError, err:
             msg = str(err)
+        finally:
+            if slot:
+                slot.release()
 
-            if msg.find(url) < 0:
-                msg += ' on %s' % tmp
-            else:
-                msg = msg.replace(url, tmp)
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt)
 
-            raise CreatorError(msg)
+    if options.get('optional'):
+        return (index, None, None, _get_worker_stats())
+    return (index, None, msg, _get_worker_stats())
 
-    return filename
+def multi_urlgrab(jobs, workers, progress_obj = None, retries = 2,
+                  backoff = 1, host_limit = MAX_HOST_CONNECTIONS):
+    """ Download files concurrently with a bounded pool of worker processes.
+
+    jobs -- a list of (url, filename, proxies[, options]) tuples, the same
+            arguments as myurlgrab takes; 'options' is a dict whose
+            'http_headers' are passed to myurlgrab, and which marks the
+            file as 'optional': it is tried once, and None is returned
+            instead of its file name if it fails. With 'last_modified',
+            the Last-Modified header of the response, if any, is stored
+            in 'filename.last-modified'. Its 'stream' is a
+            (function, args) tuple: the file is then not downloaded by
+            myurlgrab, but stored by function(fobj, filename, *args), fobj
+            being the file object of the url, and the name it returns is
+            the result of the job
+    workers -- the number of concurrent downloads
+    host_limit -- the max number of concurrent downloads from one host
+
+    Failed downloads are retried 'retries' times, waiting 'backoff', then
+    twice as long and so on between attempts. The first download which
+    still fails aborts all the others and raises CreatorError; files which
+    weren't completely downloaded are removed. Returns the list of
+    downloaded file names in the order of 'jobs'.
+
+    Worker processes are used instead of threads since pycurl handles in
+    urlgrabber are shared within a process.
+    """
+
+    if progress_obj is None:
+        progress_obj = TextProgress(len(jobs))
+
+    jobs = [_split_job(job) for job in jobs]
+
+    if workers <= 1 or len(jobs) <= 1:
+        results = []
+        for url, filename, proxies, options in jobs:
+            try:
+                if 'stream' in options:
+                    progress_obj.start(filename, url)
+                results.append(_fetch(url, filename, proxies, options,
+                                      progress_obj))
+                if 'stream' in options:
+                    progress_obj.end()
+            except CreatorError:
+                if not options.get('optional'):
+                    raise
+                results.append(None)
+        return results
+
+    host_slots = {}
+    for job in jobs:
+        host = urlparse.urlsplit(job[0]).hostname
+        if host and host not in host_slots:
+            host_slots[host] = multiprocessing.Semaphore(host_limit)
+
+    tasks = [(index, url, filename, proxies, options, retries, backoff)
+             for index, (url, filename, proxies, options) in enumerate(jobs)]
+    results = [None] * len(jobs)
+    pending = set(range(len(jobs)))
+
+    # the connections of the sessions would be shared with the workers
+    _session_pool.close_all()
+    # the latest counters of the sessions of each worker
+    worker_stats = {}
+
+    pool = multiprocessing.Pool(min(workers, len(jobs)),
+                                _init_grab_worker, (host_slots,))
+    try:
+        for index, filename, msg, (pid, stats) in \
+                pool.imap_unordered(_grab_worker, tasks):
+            worker_stats[pid] = stats
+            if msg is not None:
+                raise CreatorError(msg)
+
+            pending.discard(index)
+            results[index] = filename
+            progress_obj.start(filename, jobs[index][0])
+            progress_obj.end()
+
+        pool.close()
+    except:
+        pool.terminate()
+        for index in pending:
+            filename = jobs[index][1]
+            # stream functions store their files atomically
+            if not jobs[index][0].startswith("file:/") \
+               and 'stream' not in jobs[index][3] \
+               and os.path.exists(filename):
+                os.unlink(filename)
+        raise
+    finally:
+        pool.join()
+        _session_pool.merge_stats(worker_stats.values())
+
+    stats = get_session_stats()
+    msger.verbose("Downloads: %d, new connections: %d, reused: %d"
+                  % (stats["downloads"], stats["connections"],
+                     stats["reused"]))
+    return results
 
 def terminal_width(fd=1):
     """ Get the real terminal width """
@@ -66,6 +481,17 @@ def terminal_width(fd=1):
 def truncate_url(url, width):
     return os.path.basename(url)[0:width]
 
+class NullProgress(object):
+    """ Progress object which reports nothing """
+    def start(self, *args, **kwargs):
+        pass
+
+    def update(self, *args):
+        pass
+
+    def end(self, *args):
+        pass
+
 class TextProgress(object):
     # make the class as singleton
     _instance = None
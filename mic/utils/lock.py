@@ -5,23 +5,45 @@
 # Software Foundation; either version 2 of the License, or any later version.
 
 import os
+import time
 import errno
 
 class LockfileError(Exception):
     """ Lockfile Exception"""
     pass
 
+def _pid_alive(pid):
+    """ Whether the process 'pid' is running """
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
+def _read_owner(fpath):
+    """ Returns the pid of the owner of the lock file 'fpath', None if it
+    can't be read, e.g. it is being written """
+    try:
+        with open(fpath) as fobj:
+            return int(fobj.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
 class SimpleLockfile(object):
-    """ Simple implementation of lockfile """
+    """ Simple implementation of lockfile, which holds the pid of its
+    owner """
     def __init__(self, fpath):
         self.fpath = fpath
         self.lockf = None
+        self.locked = False
 
     def acquire(self):
         """ acquire the lock """
         try:
             self.lockf = os.open(self.fpath,
                                  os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            self.locked = True
+            os.write(self.lockf, "%d\n" % os.getpid())
         except OSError as err:
             if err.errno == errno.EEXIST:
                 raise LockfileError("File %s is locked already" % self.fpath)
@@ -29,9 +51,54 @@ class SimpleLockfile(object):
         finally:
             if self.lockf:
                 os.close(self.lockf)
+                self.lockf = None
+
+    def _break(self, pid):
+        """ break the lock left over by the dead process 'pid' """
+        tmppath = "%s.%d.broken" % (self.fpath, os.getpid())
+        try:
+            os.rename(self.fpath, tmppath)
+        except OSError:
+            return
+        if _read_owner(tmppath) != pid:
+            # it was broken and taken by another process meanwhile, put it
+            # back unless the lock was taken again since
+            try:
+                os.link(tmppath, self.fpath)
+            except OSError:
+                pass
+        os.remove(tmppath)
+
+    def wait_acquire(self, timeout, stale=None, interval=0.1):
+        """ acquire the lock, waiting up to 'timeout' seconds for the holder
+        to release it; the lock file of a holder which isn't running, or
+        older than 'stale' seconds, is taken as left over and broken """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return self.acquire()
+            except LockfileError:
+                pid = _read_owner(self.fpath)
+                if pid is not None and not _pid_alive(pid):
+                    self._break(pid)
+                    continue
+                if stale is not None:
+                    try:
+                        if time.time() - os.stat(self.fpath).st_mtime > stale:
+                            os.remove(self.fpath)
+                            continue
+                    except OSError:
+                        continue
+                if time.time() >= deadline:
+                    raise
+                time.sleep(interval)
 
     def release(self):
         """ release the lock """
+        if not self.locked:
+            return
+
+        self.locked = False
         try:
             os.remove(self.fpath)
         except OSError as err:
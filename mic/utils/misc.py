@@ -27,26 +27,39 @@ import hashlib
 import subprocess
 import platform
 import traceback
+import threading
+import zlib
+import bz2
 
 
-try:
-    import sqlite3 as sqlite
-except ImportError:
-    import sqlite
-
 try:
     from xml.etree import cElementTree
 except ImportError:
     import cElementTree
 xmlparse = cElementTree.parse
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 from mic import msger
 from mic.utils.errors import CreatorError, SquashfsError
 from mic.utils.fs_related import find_binary_path, makedirs
-from mic.utils.grabber import myurlgrab
+from mic.utils.grabber import myurlgrab, multi_urlgrab
 from mic.utils.proxy import get_proxy_for
 from mic.utils import runner
 from mic.utils import rpmmisc
+from mic.utils import repoindex
+from mic.utils import pkgstore
 from mic.utils.safeurl import SafeURL
 
 
@@ -222,6 +235,45 @@ def check_space_pre_cp(src, dst):
         raise CreatorError("space on %s(%s) is not enough for about %s files"
                            % (dst, human_size(freesize), human_size(srcsize)))
 
+# read size used for hashing, a multiple of any file-system block size
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# (st_dev, st_ino, st_size, st_mtime) -> {hash name: hex digest}
+_hashes_cache = {}
+
+def _iter_file_ranges(file_obj, start, end):
+    """ Split the area of 'file_obj' from 'start' to 'end' into ranges of
+    mapped data and holes. Yields (offset, length, mapped) tuples; the whole
+    area is reported as mapped if the file-system can't tell holes. """
+
+    from mic.utils import Filemap
+    import logging
+
+    log = logging.getLogger(__name__)
+    if not log.handlers:
+        log.addHandler(logging.NullHandler())
+
+    try:
+        fmap = Filemap.filemap(file_obj, log)
+    except (Filemap.Error, Filemap.ErrorNotSupp):
+        yield (start, end - start, True)
+        return
+
+    pos = start
+    first = start / fmap.block_size
+    last = (end - 1) / fmap.block_size
+    for first_blk, last_blk in fmap.get_mapped_ranges(first, last - first + 1):
+        range_start = max(first_blk * fmap.block_size, start)
+        range_end = min((last_blk + 1) * fmap.block_size, end)
+        if range_start > pos:
+            yield (pos, range_start - pos, False)
+        if range_end > range_start:
+            yield (range_start, range_end - range_start, True)
+        pos = max(pos, range_end)
+
+    if pos < end:
+        yield (pos, end - pos, False)
+
 def calc_hashes(file_path, hash_names, start = 0, end = None):
     """ Calculate hashes for a file. The 'file_path' argument is the file
     to calculate hash functions for, 'start' and 'end' are the starting and
@@ -229,28 +281,46 @@ def calc_hashes(file_path, hash_names, start = 0, end = None):
     argument is a list of hash names to calculate. Returns the the list
     of calculated hash values in the hexadecimal form in the same order
     as 'hash_names'.
+
+    The file is read once for all the hashes, holes of sparse files are
+    not read but hashed as zeroes.
     """
     if end == None:
         end = os.path.getsize(file_path)
 
-    chunk_size = 65536
-    to_read = end - start
-    read = 0
-
     hashes = []
     for hash_name in hash_names:
         hashes.append(hashlib.new(hash_name))
 
+    zeroes = None
     with open(file_path, "rb") as f:
-        f.seek(start)
+        if end > start:
+            ranges = _iter_file_ranges(f, start, end)
+        else:
+            ranges = []
+
+        for offset, length, mapped in ranges:
+            if mapped:
+                f.seek(offset)
+            elif zeroes is None:
+                zeroes = '\0' * HASH_CHUNK_SIZE
+
+            while length > 0:
+                chunk_size = min(length, HASH_CHUNK_SIZE)
+                if mapped:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        raise CreatorError("Unexpected end of file: %s"
+                                           % file_path)
+                    chunk_size = len(chunk)
+                elif chunk_size == HASH_CHUNK_SIZE:
+                    chunk = zeroes
+                else:
+                    chunk = zeroes[:chunk_size]
 
-        while read < to_read:
-            if read + chunk_size > to_read:
-                chunk_size = to_read - read
-            chunk = f.read(chunk_size)
-            for hash_obj in hashes:
-                hash_obj.update(chunk)
-            read += chunk_size
+                for hash_obj in hashes:
+                    hash_obj.update(chunk)
+                length -= chunk_size
 
     result = []
     for hash_obj in hashes:
@@ -258,14 +328,56 @@ def calc_hashes(file_path, hash_names, start = 0, end = None):
 
     return result
 
+def calc_files_hashes(file_paths, hash_names, workers = None):
+    """ Calculate hashes 'hash_names' for each file of 'file_paths' with
+    calc_hashes, several files at a time. Returns a dict mapping each file
+    path to the list of hash values in the order of 'hash_names'.
+
+    Results are remembered for files which are not modified (or renamed
+    only) since, so that they are not read again.
+    """
+
+    def _key(fpath):
+        st = os.stat(fpath)
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+    def _calc(fpath):
+        key = _key(fpath)
+        cached = _hashes_cache.get(key, {})
+        if all(name in cached for name in hash_names):
+            return [cached[name] for name in hash_names]
+
+        values = calc_hashes(fpath, hash_names)
+        _hashes_cache.setdefault(key, {}).update(zip(hash_names, values))
+        return values
+
+    file_paths = list(file_paths)
+    if workers is None:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+
+    if workers > 1 and len(file_paths) > 1:
+        # hashlib and file reads release the GIL, threads are good enough
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(workers, len(file_paths)))
+        try:
+            results = pool.map(_calc, file_paths)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_calc, file_paths)
+
+    return dict(zip(file_paths, results))
+
 def get_md5sum(fpath):
-    return calc_hashes(fpath, ('md5', ))[0]
+    return calc_files_hashes([fpath], ('md5', ))[fpath][0]
 
 def get_sha1sum(fpath):
-    return calc_hashes(fpath, ('sha1', ))[0]
+    return calc_files_hashes([fpath], ('sha1', ))[fpath][0]
 
 def get_sha256sum(fpath):
-    return calc_hashes(fpath, ('sha256', ))[0]
+    return calc_files_hashes([fpath], ('sha256', ))[fpath][0]
 
 def normalize_ksfile(ksconf, release, arch):
     '''
@@ -495,42 +607,410 @@ def get_repostrs_from_ks(ks):
 
     return kickstart_repos
 
-def _get_uncompressed_data_from_url(url, filename, proxies):
-    filename = myurlgrab(url.full, filename, proxies)
-    suffix = None
-    if filename.endswith(".gz"):
-        suffix = ".gz"
-        runner.quiet(['gunzip', "-f", filename])
-    elif filename.endswith(".bz2"):
-        suffix = ".bz2"
-        runner.quiet(['bunzip2', "-f", filename])
-    if suffix:
-        filename = filename.replace(suffix, "")
-    return filename
+# the suffixes of the compressed metadata files
+METADATA_SUFFIXES = (".gz", ".bz2", ".xz", ".zst")
+
+# the commands uncompressing the metadata files to stdout, when python has
+# no module to do it
+METADATA_DECOMPRESS_COMMANDS = {".xz": ["xz", "-d", "-c"],
+                                ".zst": ["zstd", "-d", "-c", "-q"]}
+
+METADATA_CHUNK_SIZE = 256 * 1024
+
+# the errors the decompressors raise on corrupt data
+_DECOMPRESS_ERRORS = (zlib.error, IOError, EOFError)
+if lzma:
+    _DECOMPRESS_ERRORS += (lzma.LZMAError, )
+if zstandard:
+    _DECOMPRESS_ERRORS += (zstandard.ZstdError, )
+
+# the types of the repo metadata the package managers don't download
+RAW_SKIPPED_TYPES = ("filelists", "other")
+
+def _get_decompressor(suffix):
+    """ Returns a new decompressor object of the data compressed with
+    'suffix', None if there's no python module for it """
+    if suffix == ".gz":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif suffix == ".bz2":
+        return bz2.BZ2Decompressor()
+    elif suffix == ".xz" and lzma:
+        return lzma.LZMADecompressor()
+    elif suffix == ".zst" and zstandard:
+        dec = zstandard.ZstdDecompressor().decompressobj()
+        # older versions drop the frames following the first one
+        if hasattr(dec, "unused_data"):
+            return dec
+    return None
 
-def _get_metadata_from_repo(baseurl, proxies, cachedir, reponame, filename,
-                            sumtype=None, checksum=None):
-    url = baseurl.join(filename)
-    filename_tmp = str("%s/%s/%s" % (cachedir, reponame, os.path.basename(filename)))
-    if os.path.splitext(filename_tmp)[1] in (".gz", ".bz2"):
-        filename = os.path.splitext(filename_tmp)[0]
-    else:
-        filename = filename_tmp
-    if sumtype and checksum and os.path.exists(filename):
+def _iter_chunks(fobj):
+    return iter(lambda: fobj.read(METADATA_CHUNK_SIZE), "")
+
+def _iter_command_output(cmd, fobj):
+    """ Yield the output of 'cmd' fed with the data read from 'fobj' """
+    try:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+    except OSError, err:
+        raise CreatorError("Can't run %s: %s" % (cmd[0], err))
+
+    def _feed():
         try:
-            sumcmd = find_binary_path("%ssum" % sumtype)
-        except:
-            file_checksum = None
-        else:
-            file_checksum = runner.outs([sumcmd, filename]).split()[0]
+            for chunk in _iter_chunks(fobj):
+                proc.stdin.write(chunk)
+        except IOError:
+            pass
+        finally:
+            proc.stdin.close()
+
+    feeder = threading.Thread(target=_feed)
+    feeder.daemon = True
+    feeder.start()
+    for chunk in _iter_chunks(proc.stdout):
+        yield chunk
+    feeder.join()
+    if proc.wait() != 0:
+        raise CreatorError("'%s' exited with error (%d)"
+                           % (" ".join(cmd), proc.returncode))
+
+def _iter_uncompressed(fobj, suffix):
+    """ Yield the uncompressed data of the file object 'fobj' compressed
+    with 'suffix', which may be made of several concatenated streams """
+    if suffix not in METADATA_SUFFIXES:
+        for chunk in _iter_chunks(fobj):
+            yield chunk
+        return
 
-        if file_checksum and file_checksum == checksum:
-            return filename
+    dec = _get_decompressor(suffix)
+    if dec is None:
+        for chunk in _iter_command_output(
+                        METADATA_DECOMPRESS_COMMANDS[suffix], fobj):
+            yield chunk
+        return
+
+    for chunk in _iter_chunks(fobj):
+        while chunk:
+            if getattr(dec, "eof", False):
+                # the previous stream ended with the previous chunk
+                dec = _get_decompressor(suffix)
+            try:
+                data = dec.decompress(chunk)
+            except EOFError:
+                # the previous stream ended with the previous chunk
+                dec = _get_decompressor(suffix)
+                continue
+            yield data
+            chunk = getattr(dec, "unused_data", "")
+            if chunk:
+                dec = _get_decompressor(suffix)
+    if hasattr(dec, "flush"):
+        data = dec.flush()
+        if data:
+            yield data
+
+def _new_hash(sumtype):
+    """ Returns a new hash object of the checksum type 'sumtype' of the
+    repo metadata, None if it isn't supported """
+    if sumtype == "sha":
+        sumtype = "sha1"
+    try:
+        return hashlib.new(sumtype)
+    except ValueError:
+        return None
+
+def _read_metadata_checksum(filename):
+    """ Returns the (sumtype, checksum) of the data of 'filename' recorded
+    when it was stored, (None, None) if there's none """
+    try:
+        with open(filename + ".checksum") as fobj:
+            sumtype, checksum, size = fobj.read().split()
+        if int(size) == os.path.getsize(filename):
+            return (sumtype, checksum)
+    except (IOError, OSError, ValueError):
+        pass
+    return (None, None)
+
+def _write_metadata_checksum(filename, sumtype, checksum):
+    tmpname = "%s.checksum.%d" % (filename, os.getpid())
+    with open(tmpname, "w") as fobj:
+        fobj.write("%s %s %d\n" % (sumtype, checksum,
+                                   os.path.getsize(filename)))
+    os.rename(tmpname, filename + ".checksum")
+
+class _TeeReader(object):
+    """ File object reading 'fobj', which writes and hashes the data read
+    on the way """
+
+    def __init__(self, fobj, out, hash_obj):
+        self.fobj = fobj
+        self.out = out
+        self.hash_obj = hash_obj
+
+    def read(self, size=-1):
+        data = self.fobj.read(size)
+        self.out.write(data)
+        if self.hash_obj:
+            self.hash_obj.update(data)
+        return data
+
+def _verify_checksum(filename, hash_obj, checksum):
+    if hash_obj and checksum and hash_obj.hexdigest() != checksum:
+        raise CreatorError("Checksum of %s doesn't match: %s, expected %s"
+                           % (os.path.basename(filename),
+                              hash_obj.hexdigest(), checksum))
+
+def _replace_metadata(tmpname, filename, sumtype, hash_obj):
+    """ Move the verified 'tmpname' to 'filename', and record its
+    checksum """
+    if os.path.exists(filename + ".checksum"):
+        os.unlink(filename + ".checksum")
+    os.rename(tmpname, filename)
+    if hash_obj:
+        _write_metadata_checksum(filename, sumtype, hash_obj.hexdigest())
+
+def _stream_metadata(fobj, filename, suffix, sumtype=None, checksum=None,
+                     rawname=None, raw_sumtype=None, raw_checksum=None):
+    """ Store the data of a metadata file compressed with 'suffix', read
+    from 'fobj' while it is downloaded, uncompressed into 'filename'.
+    Its checksum, computed on the way, is verified against 'checksum' and
+    recorded next to it. The compressed data is stored the same way into
+    'rawname' if given, for the package managers. Returns 'filename'. """
+    hash_obj = None
+    if sumtype:
+        hash_obj = _new_hash(sumtype)
+
+    raw_hash = raw_out = None
+    if rawname and suffix:
+        if raw_sumtype:
+            raw_hash = _new_hash(raw_sumtype)
+        raw_tmpname = "%s.%d.tmp" % (rawname, os.getpid())
+        raw_out = open(raw_tmpname, "wb")
+        fobj = _TeeReader(fobj, raw_out, raw_hash)
+
+    tmpname = "%s.%d.tmp" % (filename, os.getpid())
+    try:
+        with open(tmpname, "wb") as out:
+            try:
+                for data in _iter_uncompressed(fobj, suffix):
+                    if hash_obj:
+                        hash_obj.update(data)
+                    out.write(data)
+            except _DECOMPRESS_ERRORS, err:
+                raise CreatorError("Failed to uncompress %s: %s"
+                                   % (os.path.basename(filename), err))
+
+        _verify_checksum(filename, hash_obj, checksum)
+        if raw_out:
+            raw_out.close()
+            _verify_checksum(rawname, raw_hash, raw_checksum)
+            _replace_metadata(raw_tmpname, rawname, raw_sumtype, raw_hash)
+        _replace_metadata(tmpname, filename, sumtype, hash_obj)
+    finally:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        if raw_out:
+            raw_out.close()
+            if os.path.exists(raw_tmpname):
+                os.unlink(raw_tmpname)
 
-    return _get_uncompressed_data_from_url(url,filename_tmp,proxies)
+    return filename
 
-def get_metadata_from_repos(repos, cachedir):
-    my_repo_metadata = []
+def _get_metadata_path(cachedir, reponame, href):
+    """ Returns (filename, suffix) of a metadata file of a repo: the path
+    of its uncompressed data, and the suffix it is compressed with """
+    filename = str("%s/%s/%s" % (cachedir, reponame, os.path.basename(href)))
+    suffix = os.path.splitext(filename)[1]
+    if suffix in METADATA_SUFFIXES:
+        return (os.path.splitext(filename)[0], suffix)
+    return (filename, "")
+
+def _get_raw_metadata_path(cachedir, reponame, href):
+    """ Returns the path of a metadata file of a repo, as downloaded """
+    return str("%s/%s/%s" % (cachedir, reponame, os.path.basename(href)))
+
+def _is_metadata_cached(filename, sumtype, checksum):
+    """ Whether the data of 'filename' is cached with the checksum
+    'checksum', as recorded when it was stored """
+    if not sumtype or not checksum or not os.path.exists(filename):
+        return False
+
+    recorded = _read_metadata_checksum(filename)
+    if recorded[0] is None:
+        # stored by an older version, hash it once
+        hash_obj = _new_hash(sumtype)
+        if not hash_obj:
+            return False
+        with open(filename, "rb") as fobj:
+            for chunk in _iter_chunks(fobj):
+                hash_obj.update(chunk)
+        recorded = (sumtype, hash_obj.hexdigest())
+        if recorded[1] == checksum:
+            _write_metadata_checksum(filename, sumtype, checksum)
+
+    return recorded == (sumtype, checksum)
+
+def _get_repomd_job(baseurl, proxies, repomd, ttl):
+    """ Returns the multi_urlgrab job updating the cached 'repomd' of a
+    repo, None if it was updated less than 'ttl' seconds ago. The file is
+    downloaded next to it, only if it was modified since the Last-Modified
+    time the server sent for it, as the clocks may differ. """
+    headers = []
+    if os.path.exists(repomd):
+        if ttl and time.time() - os.path.getmtime(repomd) < ttl:
+            msger.debug("Using cached %s" % repomd)
+            return None
+        if os.path.exists(repomd + ".last-modified"):
+            with open(repomd + ".last-modified") as fobj:
+                headers.append(("If-Modified-Since", fobj.read().strip()))
+
+    url = baseurl.join("repodata/repomd.xml")
+    return (url.full, repomd + ".new", proxies,
+            {'http_headers': headers, 'last_modified': True})
+
+def _update_repomd(repomd, filename):
+    """ Replace the cached 'repomd' with the downloaded 'filename', or keep
+    it if the server answered it is not modified, i.e. sent nothing """
+    if os.path.exists(filename) and os.path.getsize(filename):
+        os.rename(filename, repomd)
+        if os.path.exists(filename + ".last-modified"):
+            os.rename(filename + ".last-modified", repomd + ".last-modified")
+        elif os.path.exists(repomd + ".last-modified"):
+            os.unlink(repomd + ".last-modified")
+        return
+
+    for path in (filename, filename + ".last-modified"):
+        if os.path.exists(path):
+            os.unlink(path)
+    if not os.path.exists(repomd):
+        raise CreatorError("Empty repomd.xml: %s" % filename)
+    msger.debug("Not modified: %s" % repomd)
+    # restart its time to live
+    os.utime(repomd, None)
+
+def get_repomd_data(repomd):
+    """ Returns the list of the data listed in 'repomd', as dicts of their
+    'type' and 'href', and of the 'sumtype' and 'checksum' of the file
+    and the 'open_sumtype' and 'open_checksum' of its uncompressed data """
+    try:
+        root = xmlparse(repomd)
+    except SyntaxError:
+        raise CreatorError("repomd.xml syntax error.")
+
+    ns = root.getroot().tag
+    ns = ns[0:ns.rindex("}")+1]
+
+    data = []
+    for elm in root.getiterator("%sdata" % ns):
+        item = {"type": elm.attrib["type"],
+                "href": elm.find("%slocation" % ns).attrib['href'],
+                "sumtype": None,
+                "checksum": None}
+        checksum = elm.find("%schecksum" % ns)
+        if checksum is not None:
+            item["sumtype"] = checksum.attrib['type']
+            item["checksum"] = checksum.text
+        # uncompressed data has no open checksum
+        checksum = elm.find("%sopen-checksum" % ns)
+        if checksum is not None:
+            item["open_sumtype"] = checksum.attrib['type']
+            item["open_checksum"] = checksum.text
+        else:
+            item["open_sumtype"] = item["sumtype"]
+            item["open_checksum"] = item["checksum"]
+        data.append(item)
+
+    return data
+
+def _parse_repomd(repomd):
+    """ Returns the (filepaths, checksums, sumtypes) dicts of the primary,
+    patterns and comps data listed in 'repomd', keyed by data type, and
+    the dict of their data as returned by get_repomd_data """
+    data = get_repomd_data(repomd)
+
+    filepaths = {}
+    checksums = {}
+    sumtypes = {}
+    items = {}
+
+    for item, types in (("patterns", ("patterns",)),
+                        ("comps", ("group_gz", "group")),
+                        ("primary", ("primary_db", "primary"))):
+        for elm in data:
+            if elm["type"] in types:
+                filepaths[item] = elm["href"]
+                checksums[item] = elm["open_checksum"]
+                sumtypes[item] = elm["open_sumtype"]
+                items[item] = elm
+                break
+
+    return (filepaths, checksums, sumtypes, items)
+
+def _is_raw_metadata(data):
+    """ Whether the package managers need the file of 'data' listed in a
+    repomd.xml, libzypp and yum don't download the file lists, the change
+    logs or the sqlite databases unless they are asked """
+    return data["type"] not in RAW_SKIPPED_TYPES and \
+           not data["type"].endswith("_db")
+
+def find_repo_metadata(repometadata, name, baseurl):
+    """ Returns the metadata dict of the repo 'name' at 'baseurl' among
+    'repometadata', as returned by get_metadata_from_repos, or None """
+    baseurl = getattr(baseurl, "full", baseurl)
+    for repo in repometadata or []:
+        if repo["name"] == name and \
+           getattr(repo["baseurl"], "full", repo["baseurl"]) == baseurl:
+            return repo
+    return None
+
+def link_repo_metadata(repo, destdir):
+    """ Lay out the repomd.xml and the files it lists which package
+    managers need, as downloaded by get_metadata_from_repos for the
+    metadata dict 'repo', in 'destdir' as in the repo. The files are hard
+    linked, or copied across file-systems. Returns False, creating
+    nothing, unless all the files are there with the checksum listed in
+    the repomd.xml. """
+    files = [(repo["repomd"], "repodata/repomd.xml")]
+    for data in get_repomd_data(repo["repomd"]):
+        if not _is_raw_metadata(data):
+            continue
+        rawname = _get_raw_metadata_path(repo["cachedir"], repo["name"],
+                                         data["href"])
+        if not _is_metadata_cached(rawname, data["sumtype"],
+                                   data["checksum"]):
+            msger.debug("Prefetched %s of %s isn't available"
+                        % (data["href"], repo["name"]))
+            return False
+        files.append((rawname, data["href"]))
+    if repo.get("repokey"):
+        files.append((repo["repokey"], "repodata/repomd.xml.key"))
+
+    tmpdir = "%s.%d.tmp" % (destdir.rstrip("/"), os.getpid())
+    try:
+        for src, href in files:
+            dst = os.path.join(tmpdir, href)
+            makedirs(os.path.dirname(dst))
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+        if os.path.exists(destdir):
+            shutil.rmtree(destdir)
+        makedirs(os.path.dirname(destdir.rstrip("/")))
+        os.rename(tmpdir, destdir)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return True
+
+def get_metadata_from_repos(repos, cachedir, workers=1, ttl=0):
+    """ Retrieve the metadata of 'repos' into 'cachedir', with up to
+    'workers' concurrent downloads. The repomd.xml files are downloaded
+    first, with conditional requests, and those downloaded less than 'ttl'
+    seconds ago are not checked again; then the metadata they list which
+    isn't cached yet is downloaded. Returns the list of the metadata dicts,
+    in the order of 'repos'. """
+    repoinfo = []
+    jobs = []
     for repo in repos:
         reponame = repo.name
         baseurl = repo.baseurl
@@ -545,45 +1025,22 @@ def get_metadata_from_repos(repos, cachedir):
             proxies = {str(baseurl.split(":")[0]): str(proxy)}
 
         makedirs(os.path.join(cachedir, reponame))
-        url = baseurl.join("repodata/repomd.xml")
-        filename = os.path.join(cachedir, reponame, 'repomd.xml')
-        repomd = myurlgrab(url.full, filename, proxies)
-        try:
-            root = xmlparse(repomd)
-        except SyntaxError:
-            raise CreatorError("repomd.xml syntax error.")
-
-        ns = root.getroot().tag
-        ns = ns[0:ns.rindex("}")+1]
-
-        filepaths = {}
-        checksums = {}
-        sumtypes = {}
-
-        for elm in root.getiterator("%sdata" % ns):
-            if elm.attrib["type"] == "patterns":
-                filepaths['patterns'] = elm.find("%slocation" % ns).attrib['href']
-                checksums['patterns'] = elm.find("%sopen-checksum" % ns).text
-                sumtypes['patterns'] = elm.find("%sopen-checksum" % ns).attrib['type']
-                break
-
-        for elm in root.getiterator("%sdata" % ns):
-            if elm.attrib["type"] in ("group_gz", "group"):
-                filepaths['comps'] = elm.find("%slocation" % ns).attrib['href']
-                checksums['comps'] = elm.find("%sopen-checksum" % ns).text
-                sumtypes['comps'] = elm.find("%sopen-checksum" % ns).attrib['type']
-                break
-
-        primary_type = None
-        for elm in root.getiterator("%sdata" % ns):
-            if elm.attrib["type"] in ("primary_db", "primary"):
-                primary_type = elm.attrib["type"]
-                filepaths['primary'] = elm.find("%slocation" % ns).attrib['href']
-                checksums['primary'] = elm.find("%sopen-checksum" % ns).text
-                sumtypes['primary'] = elm.find("%sopen-checksum" % ns).attrib['type']
-                break
-
-        if not primary_type:
+        repomd = os.path.join(cachedir, reponame, 'repomd.xml')
+        job = _get_repomd_job(baseurl, proxies, repomd, ttl)
+        if job:
+            jobs.append((repomd, job))
+        repoinfo.append((reponame, baseurl, proxies, repomd))
+
+    downloaded = multi_urlgrab([job for _, job in jobs], workers)
+    for (repomd, job), filename in zip(jobs, downloaded):
+        _update_repomd(repomd, filename)
+
+    # the metadata of all the repos, downloaded together
+    metadata = []
+    jobs = []
+    for reponame, baseurl, proxies, repomd in repoinfo:
+        filepaths, checksums, sumtypes, items = _parse_repomd(repomd)
+        if 'primary' not in filepaths:
             continue
 
         for item in ("primary", "patterns", "comps"):
@@ -592,85 +1049,104 @@ def get_metadata_from_repos(repos, cachedir):
                 continue
             if not filepaths[item]:
                 continue
-            filepaths[item] = _get_metadata_from_repo(baseurl,
-                                                      proxies,
-                                                      cachedir,
-                                                      reponame,
-                                                      filepaths[item],
-                                                      sumtypes[item],
-                                                      checksums[item])
+            filepath, suffix = _get_metadata_path(cachedir, reponame,
+                                                  filepaths[item])
+            data = items[item]
+            stream = (suffix, sumtypes[item], checksums[item])
+            cached = _is_metadata_cached(filepath, sumtypes[item],
+                                         checksums[item])
+            if suffix:
+                # keep the downloaded file for the package managers too
+                rawname = _get_raw_metadata_path(cachedir, reponame,
+                                                 data["href"])
+                stream += (rawname, data["sumtype"], data["checksum"])
+                cached = cached and _is_metadata_cached(rawname,
+                                                        data["sumtype"],
+                                                        data["checksum"])
+            if not cached:
+                url = baseurl.join(filepaths[item])
+                jobs.append(((len(metadata), item),
+                             (url.full, filepath, proxies,
+                              {'stream': (_stream_metadata, stream)})))
+            filepaths[item] = filepath
+
+        # the other files the package managers download as is
+        hrefs = [items[item]["href"] for item in items]
+        for data in get_repomd_data(repomd):
+            if data["href"] in hrefs or not _is_raw_metadata(data):
+                continue
+            rawname = _get_raw_metadata_path(cachedir, reponame, data["href"])
+            if _is_metadata_cached(rawname, data["sumtype"], data["checksum"]):
+                continue
+            url = baseurl.join(data["href"])
+            stream = (_stream_metadata,
+                      ("", data["sumtype"], data["checksum"]))
+            # without it, the package managers download it themselves
+            jobs.append(((len(metadata), None),
+                         (url.full, rawname, proxies,
+                          {'stream': stream, 'optional': True})))
 
         """ Get repo key """
-        try:
-            repokey = _get_metadata_from_repo(baseurl,
-                                              proxies,
-                                              cachedir,
-                                              reponame,
-                                              "repodata/repomd.xml.key")
-        except CreatorError:
-            repokey = None
-            msger.debug("\ncan't get %s/%s" % (baseurl, "repodata/repomd.xml.key"))
-
-        my_repo_metadata.append({"name":reponame,
-                                 "baseurl":baseurl,
-                                 "repomd":repomd,
-                                 "primary":filepaths['primary'],
-                                 "cachedir":cachedir,
-                                 "proxies":proxies,
-                                 "patterns":filepaths['patterns'],
-                                 "comps":filepaths['comps'],
-                                 "repokey":repokey})
-
-    return my_repo_metadata
+        url = baseurl.join("repodata/repomd.xml.key")
+        filepath = _get_metadata_path(cachedir, reponame,
+                                      "repodata/repomd.xml.key")[0]
+        jobs.append(((len(metadata), "repokey"),
+                     (url.full, filepath, proxies, {'optional': True})))
+
+        metadata.append({"name":reponame,
+                         "baseurl":baseurl,
+                         "repomd":repomd,
+                         "primary":filepaths['primary'],
+                         "checksums":checksums,
+                         "cachedir":cachedir,
+                         "proxies":proxies,
+                         "patterns":filepaths['patterns'],
+                         "comps":filepaths['comps'],
+                         "repokey":None})
+
+    downloaded = multi_urlgrab([job for _, job in jobs], workers)
+    for ((index, item), job), filename in zip(jobs, downloaded):
+        if filename is None:
+            msger.debug("\ncan't get %s" % SafeURL(job[0]))
+            continue
+        if item:
+            metadata[index][item] = filename
+
+    return metadata
 
 def get_rpmver_in_repo(repometadata):
     for repo in repometadata:
-        if repo["primary"].endswith(".xml"):
-            root = xmlparse(repo["primary"])
-            ns = root.getroot().tag
-            ns = ns[0:ns.rindex("}")+1]
-
-            versionlist = []
-            for elm in root.getiterator("%spackage" % ns):
-                if elm.find("%sname" % ns).text == 'rpm':
-                    for node in elm.getchildren():
-                        if node.tag == "%sversion" % ns:
-                            versionlist.append(node.attrib['ver'])
-
-            if versionlist:
-                return reversed(
-                         sorted(
-                           versionlist,
-                           key = lambda ver: map(int, ver.split('.')))).next()
-
-        elif repo["primary"].endswith(".sqlite"):
-            con = sqlite.connect(repo["primary"])
-            for row in con.execute("select version from packages where "
-                                   "name=\"rpm\" ORDER by version DESC"):
-                con.close()
-                return row[0]
+        con = repoindex.connect(repo)
+        try:
+            if repo["primary"].endswith(".xml"):
+                versionlist = [row[0] for row in con.execute(
+                                   "select version from packages "
+                                   "where name=\"rpm\"")]
+                if versionlist:
+                    return reversed(
+                             sorted(
+                               versionlist,
+                               key = lambda ver: map(int, ver.split('.')))).next()
+            else:
+                for row in con.execute("select version from packages where "
+                                       "name=\"rpm\" ORDER by version DESC"):
+                    return row[0]
+        finally:
+            con.close()
 
     return None
 
 def get_arch(repometadata):
     archlist = []
     for repo in repometadata:
-        if repo["primary"].endswith(".xml"):
-            root = xmlparse(repo["primary"])
-            ns = root.getroot().tag
-            ns = ns[0:ns.rindex("}")+1]
-            for elm in root.getiterator("%spackage" % ns):
-                if elm.find("%sarch" % ns).text not in ("noarch", "src"):
-                    arch = elm.find("%sarch" % ns).text
-                    if arch not in archlist:
-                        archlist.append(arch)
-        elif repo["primary"].endswith(".sqlite"):
-            con = sqlite.connect(repo["primary"])
-            for row in con.execute("select arch from packages where arch not in (\"src\", \"noarch\")"):
-                if row[0] not in archlist:
-                    archlist.append(row[0])
+        con = repoindex.connect(repo)
+        for row in con.execute("select arch from packages where arch not in "
+                               "(\"src\", \"noarch\") group by arch "
+                               "order by min(rowid)"):
+            if row[0] not in archlist:
+                archlist.append(row[0])
 
-            con.close()
+        con.close()
 
     uniq_arch = []
     for i in range(len(archlist)):
@@ -707,51 +1183,31 @@ def get_package(pkg, repometadata, arch = None):
         arches.append('noarch')
 
     for repo in repometadata:
-        if repo["primary"].endswith(".xml"):
-            root = xmlparse(repo["primary"])
-            ns = root.getroot().tag
-            ns = ns[0:ns.rindex("}")+1]
-            for elm in root.getiterator("%spackage" % ns):
-                if elm.find("%sname" % ns).text == pkg:
-                    if elm.find("%sarch" % ns).text in arches:
-                        version = elm.find("%sversion" % ns)
-                        tmpver = "%s-%s" % (version.attrib['ver'], version.attrib['rel'])
-                        if tmpver > ver:
-                            ver = tmpver
-                            location = elm.find("%slocation" % ns)
-                            pkgpath = "%s" % location.attrib['href']
-                            target_repo = repo
-                        break
-        if repo["primary"].endswith(".sqlite"):
-            con = sqlite.connect(repo["primary"])
-            if arch:
-                sql = 'select version, release, location_href from packages ' \
-                      'where name = "%s" and arch IN ("%s")' % \
-                      (pkg, '","'.join(arches))
-                for row in con.execute(sql):
-                    tmpver = "%s-%s" % (row[0], row[1])
-                    if tmpver > ver:
-                        ver = tmpver
-                        pkgpath = "%s" % row[2]
-                        target_repo = repo
-                    break
-            else:
-                sql = 'select version, release, location_href from packages ' \
-                      'where name = "%s"' % pkg
-                for row in con.execute(sql):
-                    tmpver = "%s-%s" % (row[0], row[1])
-                    if tmpver > ver:
-                        ver = tmpver
-                        pkgpath = "%s" % row[2]
-                        target_repo = repo
-                    break
-            con.close()
+        con = repoindex.connect(repo)
+        if arches:
+            sql = 'select version, release, location_href, checksum_type, ' \
+                  'pkgId from packages where name = ? and arch IN (%s) ' \
+                  'order by rowid limit 1' % ','.join('?' * len(arches))
+            args = [pkg] + arches
+        else:
+            sql = 'select version, release, location_href, checksum_type, ' \
+                  'pkgId from packages where name = ? order by rowid limit 1'
+            args = [pkg]
+        for row in con.execute(sql, args):
+            tmpver = "%s-%s" % (row[0], row[1])
+            if tmpver > ver:
+                ver = tmpver
+                pkgpath = "%s" % row[2]
+                checksum = (row[3], row[4])
+                target_repo = repo
+        con.close()
     if target_repo:
         makedirs("%s/packages/%s" % (target_repo["cachedir"], target_repo["name"]))
         url = target_repo["baseurl"].join(pkgpath)
         filename = str("%s/packages/%s/%s" % (target_repo["cachedir"], target_repo["name"], os.path.basename(pkgpath)))
         if os.path.exists(filename):
-            ret = rpmmisc.checkRpmIntegrity('rpm', filename)
+            ledger = rpmmisc.getVerifyLedger(target_repo["cachedir"])
+            ret = rpmmisc.checkRpmIntegrity('rpm', filename, ledger)
             if ret == 0:
                 return filename
 
@@ -759,8 +1215,24 @@ def get_package(pkg, repometadata, arch = None):
                           (os.path.basename(filename), filename))
             os.unlink(filename)
 
-        pkg = myurlgrab(url.full, filename, target_repo["proxies"])
-        return pkg
+        if url.full.startswith("file:/"):
+            # local packages are used in place
+            return myurlgrab(url.full, filename, target_repo["proxies"])
+
+        store = pkgstore.PackageStore(target_repo["cachedir"])
+        if store.link(checksum[0], checksum[1], filename):
+            return filename
+
+        # download to a temporary name, not to leave a partial package
+        tmpname = pkgstore.get_tmpname(filename)
+        try:
+            myurlgrab(url.full, tmpname, target_repo["proxies"])
+            os.rename(tmpname, filename)
+        finally:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+        store.add(checksum[0], checksum[1], filename)
+        return filename
     else:
         return None
 
@@ -786,101 +1258,29 @@ def get_source_name(pkg, repometadata):
         return None
 
     for repo in repometadata:
-        if repo["primary"].endswith(".xml"):
-            root = xmlparse(repo["primary"])
-            ns = root.getroot().tag
-            ns = ns[0:ns.rindex("}")+1]
-            for elm in root.getiterator("%spackage" % ns):
-                if elm.find("%sname" % ns).text == pkg_name:
-                    if elm.find("%sarch" % ns).text != "src":
-                        version = elm.find("%sversion" % ns)
-                        tmpver = "%s-%s" % (version.attrib['ver'], version.attrib['rel'])
-                        if tmpver > ver:
-                            ver = tmpver
-                            fmt = elm.find("%sformat" % ns)
-                            if fmt:
-                                fns = fmt.getchildren()[0].tag
-                                fns = fns[0:fns.rindex("}")+1]
-                                pkgpath = fmt.find("%ssourcerpm" % fns).text
-                                target_repo = repo
-                        break
-
-        if repo["primary"].endswith(".sqlite"):
-            con = sqlite.connect(repo["primary"])
-            for row in con.execute("select version, release, rpm_sourcerpm from packages where name = \"%s\" and arch != \"src\"" % pkg_name):
-                tmpver = "%s-%s" % (row[0], row[1])
-                if tmpver > ver:
-                    pkgpath = "%s" % row[2]
-                    target_repo = repo
-                break
-            con.close()
+        con = repoindex.connect(repo)
+        for row in con.execute("select version, release, rpm_sourcerpm "
+                               "from packages where name = ? and "
+                               "arch != \"src\" order by rowid limit 1",
+                               (pkg_name,)):
+            tmpver = "%s-%s" % (row[0], row[1])
+            if tmpver > ver and row[2]:
+                ver = tmpver
+                pkgpath = "%s" % row[2]
+                target_repo = repo
+        con.close()
     if target_repo:
         return get_src_name(pkgpath)
     else:
         return None
 
 def get_pkglist_in_patterns(group, patterns):
-    found = False
-    pkglist = []
-    try:
-        root = xmlparse(patterns)
-    except SyntaxError:
-        raise SyntaxError("%s syntax error." % patterns)
-
-    for elm in list(root.getroot()):
-        ns = elm.tag
-        ns = ns[0:ns.rindex("}")+1]
-        name = elm.find("%sname" % ns)
-        summary = elm.find("%ssummary" % ns)
-        if name.text == group or summary.text == group:
-            found = True
-            break
-
-    if not found:
-        return pkglist
-
-    found = False
-    for requires in list(elm):
-        if requires.tag.endswith("requires"):
-            found = True
-            break
-
-    if not found:
-        return pkglist
-
-    for pkg in list(requires):
-        pkgname = pkg.attrib["name"]
-        if pkgname not in pkglist:
-            pkglist.append(pkgname)
-
-    return pkglist
+    index = repoindex.get_group_index({"patterns": patterns}, "patterns")
+    return list(index.get(group, []))
 
 def get_pkglist_in_comps(group, comps):
-    found = False
-    pkglist = []
-    try:
-        root = xmlparse(comps)
-    except SyntaxError:
-        raise SyntaxError("%s syntax error." % comps)
-
-    for elm in root.getiterator("group"):
-        id = elm.find("id")
-        name = elm.find("name")
-        if id.text == group or name.text == group:
-            packagelist = elm.find("packagelist")
-            found = True
-            break
-
-    if not found:
-        return pkglist
-
-    for require in elm.getiterator("packagereq"):
-        if require.tag.endswith("packagereq"):
-            pkgname = require.text
-        if pkgname not in pkglist:
-            pkglist.append(pkgname)
-
-    return pkglist
+    index = repoindex.get_group_index({"comps": comps}, "comps")
+    return list(index.get(group, []))
 
 def is_statically_linked(binary):
     return ", statically linked, " in runner.outs(['file', binary])
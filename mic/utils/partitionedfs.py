@@ -19,12 +19,15 @@
 # Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
 import os
+import time
+import tempfile
+from multiprocessing.pool import ThreadPool
 
 from mic import msger
-from mic.utils import runner
+from mic.utils import runner, profiler
 from mic.utils.errors import MountError, CreatorError
 from mic.utils.fs_related import *
-from mic.utils.gpt_parser import GptParser
+from mic.utils.gpt_parser import PartitionTableWriter
 
 # Overhead of the MBR partitioning scheme (just one sector)
 MBR_OVERHEAD = 1
@@ -42,7 +45,10 @@ def resolve_ref(ref):
         return real
 
 class PartitionedMount(Mount):
-    def __init__(self, mountdir, skipformat = False):
+    def __init__(self, mountdir, skipformat = False, from_dir = False):
+        """ If 'from_dir' is True, the disks are FileDisk objects and the
+        partitions are installed as plain directories, whose file systems
+        are only created by resparse(). """
         Mount.__init__(self, mountdir)
         self.disks = {}
         self.partitions = []
@@ -50,14 +56,14 @@ class PartitionedMount(Mount):
         self.mapped = False
         self.mount_order = []
         self.unmount_order = []
-        self.parted = find_binary_path("parted")
-        self.kpartx = find_binary_path("kpartx")
+        self.losetupcmd = find_binary_path("losetup")
         self.mkswap = find_binary_path("mkswap")
-        self.dmsetup = find_binary_path("dmsetup")
         self.btrfscmd = None
         self.mountcmd = find_binary_path("mount")
         self.umountcmd = find_binary_path("umount")
         self.skipformat = skipformat
+        self.from_dir = from_dir
+        self.dirs_built = False
         self.snapshot_created = self.skipformat
         # Size of a sector used in calculations
         self.sector_size = SECTOR_SIZE
@@ -76,7 +82,7 @@ class PartitionedMount(Mount):
 
         self.disks[disk_name] = \
                 { 'disk': None,     # Disk object
-                  'mapped': False,  # True if kpartx mapping exists
+                  'mapped': False,  # True if the partitions are mapped
                   'numpart': 0,     # Number of allocate partitions
                   'partitions': [], # Indexes to self.partitions
                   'offset': 0,      # Offset of next partition (in sectors)
@@ -109,7 +115,7 @@ class PartitionedMount(Mount):
 
         ks_pnum = len(self.partitions)
 
-        # Converting MB to sectors for parted
+        # Converting MB to sectors
         size = size * 1024 * 1024 / self.sector_size
 
         # We need to handle subvolumes for btrfs
@@ -128,7 +134,7 @@ class PartitionedMount(Mount):
                                     'fstype': fstype, # Filesystem type
                                     'fsopts': fsopts, # Filesystem mount options
                                     'disk_name': disk_name, # physical disk name holding partition
-                                    'device': None, # kpartx device node for partition
+                                    'device': None, # loop device node for partition
                                     'mapper_device': None, # mapper device node
                                     'mpath_device': None, # multipath device of device mapper
                                     'mount': None, # Mount object
@@ -155,7 +161,7 @@ class PartitionedMount(Mount):
                      'fsopts': fsopts, # Filesystem mount options
                      'label': label, # Partition label
                      'disk_name': disk_name, # physical disk name holding partition
-                     'device': None, # kpartx device node for partition
+                     'device': None, # loop device node for partition
                      'mapper_device': None, # mapper device node
                      'mpath_device': None, # multipath device of device mapper
                      'mount': None, # Mount object
@@ -271,36 +277,6 @@ class PartitionedMount(Mount):
 
             d['min_size'] *= self.sector_size
 
-    def __run_parted(self, args):
-        """ Run parted with arguments specified in the 'args' list. """
-
-        args.insert(0, self.parted)
-        msger.debug(args)
-
-        rc, out = runner.runtool(args, catch = 3)
-        out = out.strip()
-        msger.debug("'parted': exitcode: %d, output: %s" % (rc, out))
-        # We don't throw exception when return code is not 0, because
-        # parted always fails to reload part table with loop devices. This
-        # prevents us from distinguishing real errors based on return
-        # code.
-        return rc, out
-
-    def __create_partition(self, device, parttype, fstype, start, size):
-        """ Create a partition on an image described by the 'device' object. """
-
-        # Start is included to the size so we need to subtract one from the end.
-        end = start + size - 1
-        msger.debug("Added '%s' partition, sectors %d-%d, size %d sectors" %
-                    (parttype, start, end, size))
-
-        args = ["-s", device, "unit", "s", "mkpart", parttype]
-        if fstype:
-            args.extend([fstype])
-        args.extend(["%d" % start, "%d" % end])
-
-        return self.__run_parted(args)
-
     def __format_disks(self):
         self.layout_partitions()
 
@@ -308,36 +284,7 @@ class PartitionedMount(Mount):
             msger.debug("Skipping disk format, because skipformat flag is set.")
             return
 
-        for dev in self.disks.keys():
-            d = self.disks[dev]
-            msger.debug("Initializing partition table for %s" % \
-                        (d['disk'].device))
-            self.__run_parted(["-s", d['disk'].device, "mklabel",
-                               d['ptable_format']])
-
-        msger.debug("Creating partitions")
-
         for p in self.partitions:
-            d = self.disks[p['disk_name']]
-            if d['ptable_format'] == "msdos" and p['num'] == 5:
-                # The last sector of the 3rd partition was reserved for the EBR
-                # of the first _logical_ partition. This is why the extended
-                # partition should start one sector before the first logical
-                # partition.
-                self.__create_partition(d['disk'].device, "extended",
-                                        None, p['start'] - 1,
-                                        d['offset'] - p['start'])
-
-            if p['fstype'] == "swap":
-                parted_fs_type = "linux-swap"
-            elif p['fstype'] == "vfat":
-                parted_fs_type = "fat32"
-            elif p['fstype'] == "msdos":
-                parted_fs_type = "fat16"
-            else:
-                # Type for ext2/ext3/ext4/btrfs
-                parted_fs_type = "ext2"
-
             # Boot ROM of OMAP boards require vfat boot partition to have an
             # even number of sectors.
             if p['mountpoint'] == "/boot" and p['fstype'] in ["vfat", "msdos"] \
@@ -347,149 +294,53 @@ class PartitionedMount(Mount):
                             p['mountpoint'])
                 p['size'] -= 1
 
-            self.__create_partition(d['disk'].device, p['type'],
-                                    parted_fs_type, p['start'], p['size'])
-
-            if p['boot']:
-                if d['ptable_format'] == 'gpt':
-                    flag_name = "legacy_boot"
-                else:
-                    flag_name = "boot"
-                msger.debug("Set '%s' flag for partition '%s' on disk '%s'" % \
-                            (flag_name, p['num'], d['disk'].device))
-                cmd = ["-s", d['disk'].device,
-                       "set", "%d" % p['num'],
-                       flag_name, "on"]
-                exitcode, output = self.__run_parted(cmd)
-                if exitcode != 0:
-                    msger.warning(
-                        "partition '%s' is marked with --active, "
-                        "but flag '%s' can't be set: "
-                        "exitcode: %s, output: %s"
-                        % (p['mountpoint'], flag_name, exitcode, output))
-
-        # If the partition table format is "gpt", find out PARTUUIDs for all
-        # the partitions. And if users specified custom parition type UUIDs,
-        # set them.
-        for disk_name, disk in self.disks.items():
-            if disk['ptable_format'] != 'gpt':
+        # The whole partition table of each disk is written at once, and the
+        # PARTUUIDs of the GPT partitions are generated along.
+        for disk_name, d in self.disks.items():
+            # a FileDisk has no device, its file is written
+            device = d['disk'].device or d['disk'].lofile
+            msger.debug("Writing %s partition table to %s" % \
+                        (d['ptable_format'], device))
+            partitions = [self.partitions[n] for n in d['partitions']]
+            for p in partitions:
+                msger.debug("Added '%s' partition %d, sectors %d-%d, size %d "
+                            "sectors" % (p['type'], p['num'], p['start'],
+                                         p['start'] + p['size'] - 1,
+                                         p['size']))
+
+            writer = PartitionTableWriter(device, self.sector_size)
+            writer.write(d['ptable_format'], partitions)
+
+            if d['ptable_format'] != 'gpt':
                 continue
-
-            pnum = 0
-            gpt_parser = GptParser(disk['disk'].device, SECTOR_SIZE)
-            # Iterate over all GPT partitions on this disk
-            for entry in gpt_parser.get_partitions():
-                pnum += 1
-                # Find the matching partition in the 'self.partitions' list
-                for n in disk['partitions']:
-                    p = self.partitions[n]
-                    if p['num'] == pnum:
-                        # Found, fetch PARTUUID (partition's unique ID)
-                        p['partuuid'] = entry['part_uuid']
-                        msger.debug("PARTUUID for partition %d on disk '%s' " \
-                                    "(mount point '%s') is '%s'" % (pnum, \
-                                    disk_name, p['mountpoint'], p['partuuid']))
-                        if p['part_type']:
-                            entry['type_uuid'] = p['part_type']
-                            msger.debug("Change type of partition %d on disk " \
-                                        "'%s' (mount point '%s') to '%s'" % \
-                                        (pnum, disk_name, p['mountpoint'],
-                                         p['part_type']))
-                            gpt_parser.change_partition(entry)
-
-            del gpt_parser
+            for p in partitions:
+                msger.debug("PARTUUID for partition %d on disk '%s' " \
+                            "(mount point '%s') is '%s'" % (p['num'], \
+                            disk_name, p['mountpoint'], p['partuuid']))
 
     def __map_partitions(self):
-        """Load it if dm_snapshot isn't loaded. """
-        load_module("dm_snapshot")
+        """ Attach a loop device to each partition, at the offset of the
+        partition in its disk and limited to its size. The loop devices are
+        known as soon as losetup returns, unlike device-mapper nodes, and
+        are recorded in the partitions to detach them at cleanup. """
 
         for dev in self.disks.keys():
             d = self.disks[dev]
             if d['mapped']:
                 continue
 
-            msger.debug("Running kpartx on %s" % d['disk'].device )
-            rc, kpartx_output = runner.runtool([self.kpartx, "-l", "-v", d['disk'].device])
-            kpartx_output = kpartx_output.splitlines()
-
-            if rc != 0:
-                raise MountError("Failed to query partition mapping for '%s'" %
-                                 d['disk'].device)
-
-            # Strip trailing blank and mask verbose output
-            i = 0
-            while i < len(kpartx_output) and kpartx_output[i][0:4] != "loop":
-                i = i + 1
-            kpartx_output = kpartx_output[i:]
-
-            # Make sure kpartx reported the right count of partitions
-            if len(kpartx_output) != d['numpart']:
-                # If this disk has more than 3 partitions, then in case of MBR
-                # paritions there is an extended parition. Different versions
-                # of kpartx behave differently WRT the extended partition -
-                # some map it, some ignore it. This is why we do the below hack
-                # - if kpartx reported one more partition and the partition
-                # table type is "msdos" and the amount of partitions is more
-                # than 3, we just assume kpartx mapped the extended parition
-                # and we remove it.
-                if len(kpartx_output) == d['numpart'] + 1 \
-                   and d['ptable_format'] == 'msdos' and len(kpartx_output) > 3:
-                    kpartx_output.pop(3)
-                else:
-                    raise MountError("Unexpected number of partitions from " \
-                                     "kpartx: %d != %d" % \
-                                        (len(kpartx_output), d['numpart']))
-
-            for i in range(len(kpartx_output)):
-                line = kpartx_output[i]
-                newdev = line.split()[0]
-                mapperdev = "/dev/mapper/" + newdev
-                loopdev = d['disk'].device + newdev[-1]
-
-                msger.debug("Dev %s: %s -> %s" % (newdev, loopdev, mapperdev))
-                pnum = d['partitions'][i]
-                self.partitions[pnum]['device'] = loopdev
-                self.partitions[pnum]['mapper_device'] = mapperdev
-
-                # grub's install wants partitions to be named
-                # to match their parent device + partition num
-                # kpartx doesn't work like this, so we add compat
-                # symlinks to point to /dev/mapper
-                if os.path.lexists(loopdev):
-                    os.unlink(loopdev)
-                os.symlink(mapperdev, loopdev)
-
-            msger.debug("Adding partx mapping for %s" % d['disk'].device)
-            rc = runner.show([self.kpartx, "-v", "-sa", d['disk'].device])
-
-            if rc != 0:
-                # Make sure that the device maps are also removed on error case.
-                # The d['mapped'] isn't set to True if the kpartx fails so
-                # failed mapping will not be cleaned on cleanup either.
-                runner.quiet([self.kpartx, "-sd", d['disk'].device])
-                raise MountError("Failed to map partitions for '%s'" %
-                                 d['disk'].device)
-
-            for p in self.partitions:
-                if p['mapper_device'] and os.path.islink(p['mapper_device']):
-                    p['mpath_device'] = resolve_ref(p['mapper_device'])
-                else:
-                    p['mpath_device'] = ''
-
-            # FIXME: need a better way to fix the latency
-            import time
-            time.sleep(1)
-
-            if not os.path.exists(mapperdev):
-                # load mapper device if not updated
-                runner.quiet([self.dmsetup, "mknodes"])
-                # still not updated, roll back
-                if not os.path.exists(mapperdev):
-                    runner.quiet([self.kpartx, "-sd", d['disk'].device])
-                    raise MountError("Failed to load mapper devices for '%s'" %
-                                     d['disk'].device)
-
+            # set first, so that a partial mapping is undone at cleanup
             d['mapped'] = True
+            for pnum in d['partitions']:
+                p = self.partitions[pnum]
+                p['device'] = get_loop_device(self.losetupcmd,
+                        d['disk'].device,
+                        ["--offset", str(p['start'] * self.sector_size),
+                         "--sizelimit", str(p['size'] * self.sector_size)])
+                p['mapper_device'] = p['device']
+                p['mpath_device'] = ''
+                msger.debug("Mapped partition %d of %s to %s" % \
+                            (p['num'], d['disk'].device, p['device']))
 
     def __unmap_partitions(self):
         for dev in self.disks.keys():
@@ -497,17 +348,22 @@ class PartitionedMount(Mount):
             if not d['mapped']:
                 continue
 
-            msger.debug("Removing compat symlinks")
+            msger.debug("Unmapping %s" % d['disk'].device)
             for pnum in d['partitions']:
-                if self.partitions[pnum]['device'] != None:
-                    os.unlink(self.partitions[pnum]['device'])
-                    self.partitions[pnum]['device'] = None
+                p = self.partitions[pnum]
+                if p['device'] is None:
+                    continue
 
-            msger.debug("Unmapping %s" % d['disk'].device)
-            rc = runner.quiet([self.kpartx, "-sd", d['disk'].device])
-            if rc != 0:
-                raise MountError("Failed to unmap partitions for '%s'" %
-                                 d['disk'].device)
+                rc = runner.quiet([self.losetupcmd, "-d", p['device']])
+                if rc != 0:
+                    raise MountError("Failed to unmap partition %d of '%s'" %
+                                     (p['num'], d['disk'].device))
+                # a busy loop device is detached when its last user closes it
+                if not wait_until(lambda: not loop_is_attached(p['device'])):
+                    msger.warning("Loop device %s of partition %d is still "
+                                  "busy" % (p['device'], p['num']))
+                p['device'] = None
+                p['mapper_device'] = None
 
             d['mapped'] = False
 
@@ -534,6 +390,10 @@ class PartitionedMount(Mount):
                     pass
 
     def unmount(self):
+        if self.from_dir:
+            # nothing is mounted, and the mounts are kept for resparse()
+            return
+
         self.__unmount_subvolumes()
         for mp in self.unmount_order:
             if mp == 'swap':
@@ -630,7 +490,7 @@ class PartitionedMount(Mount):
                                         'fstype': "btrfs", # Filesystem type
                                         'fsopts': items[3] + ",subvol=%s" %  items[1], # Filesystem mount options
                                         'disk_name': p['disk_name'], # physical disk name holding partition
-                                        'device': None, # kpartx device node for partition
+                                        'device': None, # loop device node for partition
                                         'mount': None, # Mount object
                                         'subvol': items[1], # Subvolume name
                                         'boot': False, # Bootable flag
@@ -763,21 +623,62 @@ class PartitionedMount(Mount):
 
         self.snapshot_created = True
 
+    def __get_partition(self, mountpoint):
+        for p in self.partitions:
+            if p['mountpoint'] == mountpoint:
+                return p
+        return None
+
+    def __format_partition(self, p, pdisk):
+        """ Create the file system of a partition, or its swap space if
+        'pdisk' is None. Called concurrently for all the partitions. """
+        start = time.time()
+        if pdisk is None:
+            runner.show([self.mkswap,
+                         '-L', p['label'],
+                         '-U', p['uuid'],
+                         p['device']])
+        else:
+            pdisk.format()
+        msger.info("Formatted %s as %s in %.1fs"
+                   % (p['device'], p['fstype'] or "swap",
+                      time.time() - start))
+
+    def __format_partitions(self, pdisks):
+        """ Format all the partitions at once, as they are independent
+        block devices, 'pdisks' maps mount points to the DiskMount objects
+        of the partitions """
+        args = [(self.__get_partition(mp), pdisks.get(mp))
+                for mp in self.mount_order]
+
+        # mkfs mostly waits for the disks, so one thread per partition
+        if len(args) > 1:
+            pool = ThreadPool(len(args))
+            try:
+                results = [pool.apply_async(self.__format_partition, arg)
+                           for arg in args]
+                for result in results:
+                    result.get()
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for arg in args:
+                self.__format_partition(*arg)
+
     def mount(self):
         for dev in self.disks.keys():
             d = self.disks[dev]
             d['disk'].create()
 
         self.__format_disks()
-        self.__map_partitions()
+        if not self.from_dir:
+            self.__map_partitions()
         self.__calculate_mountorder()
 
+        pdisks = {}
         for mp in self.mount_order:
-            p = None
-            for p1 in self.partitions:
-                if p1['mountpoint'] == mp:
-                    p = p1
-                    break
+            p = self.__get_partition(mp)
 
             if not p['label']:
                 if p['mountpoint'] == "/":
@@ -788,10 +689,10 @@ class PartitionedMount(Mount):
             if mp == 'swap':
                 import uuid
                 p['uuid'] = str(uuid.uuid1())
-                runner.show([self.mkswap,
-                             '-L', p['label'],
-                             '-U', p['uuid'],
-                             p['device']])
+                continue
+
+            if self.from_dir:
+                pdisks[mp] = self.__get_dir_mount(p)
                 continue
 
             rmmountdir = False
@@ -809,7 +710,7 @@ class PartitionedMount(Mount):
             if p['fstype'] == "btrfs" and not p['fsopts']:
                 p['fsopts'] = "subvolid=0"
 
-            pdisk = my_disk_mount(RawDisk(p['size'] * self.sector_size, p['device']),
+            pdisks[mp] = my_disk_mount(RawDisk(p['size'] * self.sector_size, p['device']),
                                  self.mountdir + p['mountpoint'],
                                  p['fstype'],
                                  4096,
@@ -817,6 +718,27 @@ class PartitionedMount(Mount):
                                  rmmountdir,
                                  self.skipformat,
                                  fsopts = p['fsopts'])
+
+        if self.from_dir:
+            for mp in self.mount_order:
+                if mp == 'swap':
+                    continue
+                p = self.__get_partition(mp)
+                pdisks[mp].mount()
+                p['mount'] = pdisks[mp]
+                p['uuid'] = pdisks[mp].uuid
+            return
+
+        # the file systems are created concurrently, then mounted in order
+        with profiler.phase("format"):
+            self.__format_partitions(pdisks)
+
+        for mp in self.mount_order:
+            if mp == 'swap':
+                continue
+
+            p = self.__get_partition(mp)
+            pdisk = pdisks[mp]
             pdisk.mount(pdisk.fsopts)
             if p['fstype'] == "btrfs" and p['mountpoint'] == "/":
                 if not self.skipformat:
@@ -825,6 +747,69 @@ class PartitionedMount(Mount):
             p['mount'] = pdisk
             p['uuid'] = pdisk.uuid
 
+    def __get_dir_mount(self, p):
+        """ The DirDiskMount object of the partition 'p', writing its file
+        system into its region of the disk file """
+        if p['fstype'] in ("vfat", "msdos"):
+            my_dir_mount = VfatDirMount
+        elif p['fstype'] in ("ext2", "ext3", "ext4"):
+            my_dir_mount = ExtDirMount
+        else:
+            raise MountError("Can't create a %s file system from a "
+                             "directory" % p['fstype'])
+
+        lofile = self.disks[p['disk_name']]['disk'].lofile
+        return my_dir_mount(FileDisk(lofile,
+                                     p['size'] * self.sector_size,
+                                     p['start'] * self.sector_size),
+                            self.mountdir + p['mountpoint'],
+                            p['fstype'],
+                            4096,
+                            p['label'],
+                            fsopts = p['fsopts'])
+
+    def __build_swap(self, p):
+        """ Write the swap signature of the partition 'p', as mkswap only
+        takes a whole file """
+        lofile = self.disks[p['disk_name']]['disk'].lofile
+        fd, swapfile = tempfile.mkstemp(dir = os.path.dirname(lofile))
+        try:
+            os.ftruncate(fd, p['size'] * self.sector_size)
+            rc = runner.show([self.mkswap,
+                              '-L', p['label'],
+                              '-U', p['uuid'],
+                              swapfile])
+            if rc != 0:
+                raise MountError("Failed to create swap space of partition "
+                                 "%d of %s" % (p['num'], lofile))
+
+            # the signature is in the first page, the rest is zeroed
+            os.lseek(fd, 0, os.SEEK_SET)
+            header = os.read(fd, os.sysconf("SC_PAGE_SIZE"))
+        finally:
+            os.close(fd)
+            os.unlink(swapfile)
+
+        with open(lofile, "r+b") as disk_file:
+            disk_file.seek(p['start'] * self.sector_size)
+            disk_file.write(header)
+
     def resparse(self, size = None):
-        # Can't re-sparse a disk image - too hard
-        pass
+        if not self.from_dir or self.dirs_built:
+            # Can't re-sparse a disk image - too hard
+            return
+        self.dirs_built = True
+
+        # the nested mount points first, and their trees are moved aside
+        # once built so that they aren't part of the parent file systems
+        parkdir = tempfile.mkdtemp(prefix = "built-",
+                                   dir = os.path.dirname(self.mountdir))
+        with profiler.phase("mkfs"):
+            for mp in self.unmount_order:
+                p = self.__get_partition(mp)
+                if mp == 'swap':
+                    self.__build_swap(p)
+                elif mp == '/':
+                    p['mount'].build()
+                else:
+                    p['mount'].build(parkdir = parkdir)
@@ -0,0 +1,293 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2014 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc., 59
+# Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+""" This module implements a content-addressed package store.
+
+Packages are stored once under 'cachedir/pkgstore', named after the
+checksum recorded for them in the primary metadata, and hard linked into
+the per-repo paths 'cachedir/packages/<repo>/' used by the backends. So an
+RPM served by several repos is stored once, and concurrent mic builds
+sharing the cache directory reuse each other's downloads.
+
+Objects are written to a temporary file which is renamed into place, under
+a lock file per object. The last use of an object is recorded in its
+access time, the least recently used ones are evicted first when the store
+is pruned to its size cap. """
+
+import os
+import time
+import errno
+import shutil
+import hashlib
+
+from mic import msger
+from mic.utils.lock import SimpleLockfile, LockfileError
+
+STORE_NAME = "pkgstore"
+
+# seconds to wait for a concurrent writer of the same object, and the age
+# of a lock file which is considered left over by a killed mic
+LOCK_TIMEOUT = 60
+LOCK_STALE = 600
+
+# seconds since their last use during which objects aren't evicted, so that
+# concurrent builds keep the packages they have just linked
+PRUNE_GRACE = 3600
+
+# hash names used in repo metadata which hashlib knows differently
+_HASH_ALIASES = {
+    "sha": "sha1",
+    "sha1": "sha1",
+    "sha224": "sha224",
+    "sha256": "sha256",
+    "sha384": "sha384",
+    "sha512": "sha512",
+    "md5": "md5",
+}
+
+def _file_digest(path, hash_name):
+    hash_obj = hashlib.new(hash_name)
+    with open(path, "rb") as fobj:
+        while True:
+            chunk = fobj.read(1024 * 1024)
+            if not chunk:
+                break
+            hash_obj.update(chunk)
+    return hash_obj.hexdigest()
+
+def get_tmpname(path):
+    """ Get a temporary name in the directory of 'path', unique to the
+    process, to write 'path' to and rename it into place when complete """
+    return os.path.join(os.path.dirname(path),
+                        ".%s.%d.tmp" % (os.path.basename(path), os.getpid()))
+
+def _atomic_link(src, dst):
+    """ Make 'dst' a hard link of 'src' (or a copy of it if they are on
+    different file-systems), replacing 'dst' atomically """
+    tmpdst = get_tmpname(dst)
+    try:
+        os.link(src, tmpdst)
+    except OSError, err:
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(src, tmpdst)
+
+    try:
+        os.rename(tmpdst, dst)
+    except OSError:
+        os.unlink(tmpdst)
+        raise
+
+class PackageStore(object):
+    """ Content-addressed store of the packages of a cache directory """
+
+    def __init__(self, cachedir, max_size=0):
+        """ 'max_size' is the size cap of the store in bytes, 0 for no cap """
+        self.cachedir = os.path.abspath(cachedir)
+        self.storedir = os.path.join(self.cachedir, STORE_NAME)
+        self.max_size = max_size
+
+    def _object_path(self, checksum_type, checksum):
+        hash_name = _HASH_ALIASES.get(str(checksum_type).lower())
+        if not hash_name or not checksum:
+            return None
+        checksum = str(checksum).lower()
+        return os.path.join(self.storedir, hash_name, checksum[:2],
+                            checksum + ".rpm")
+
+    def _lock(self, path):
+        lock = SimpleLockfile(path + ".lock")
+        lock.wait_acquire(LOCK_TIMEOUT, LOCK_STALE)
+        return lock
+
+    def link(self, checksum_type, checksum, dest):
+        """ Link the stored object with 'checksum' to the per-repo path
+        'dest'. Returns True if it was found in the store. """
+        path = self._object_path(checksum_type, checksum)
+        if path is None or not os.path.exists(path):
+            return False
+
+        if not os.path.exists(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+
+        try:
+            _atomic_link(path, dest)
+            # record the use for LRU eviction, keep mtime for rpmmisc ledger
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except OSError, err:
+            # evicted by a concurrent prune
+            if err.errno == errno.ENOENT:
+                return False
+            raise
+
+        msger.verbose("Found %s in package store" % os.path.basename(dest))
+        return True
+
+    def add(self, checksum_type, checksum, src):
+        """ Add the downloaded package 'src' to the store, if its content
+        matches 'checksum', and make 'src' a link of the stored object.
+        Returns True if the package is stored. """
+        path = self._object_path(checksum_type, checksum)
+        if path is None:
+            return False
+
+        hash_name = os.path.basename(os.path.dirname(os.path.dirname(path)))
+        if _file_digest(src, hash_name) != str(checksum).lower():
+            msger.warning("%s doesn't match its checksum %s, not stored"
+                          % (os.path.basename(src), checksum))
+            return False
+
+        objdir = os.path.dirname(path)
+        if not os.path.exists(objdir):
+            try:
+                os.makedirs(objdir)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+
+        try:
+            lock = self._lock(path)
+        except LockfileError:
+            msger.warning("Package store object %s is locked, not stored"
+                          % path)
+            return False
+
+        try:
+            if not os.path.exists(path):
+                _atomic_link(src, path)
+            else:
+                # stored by someone else meanwhile, share it
+                _atomic_link(path, src)
+        finally:
+            lock.release()
+
+        return True
+
+    def _iter_objects(self):
+        """ Yield (path, size, atime) of all the stored objects """
+        if not os.path.isdir(self.storedir):
+            return
+
+        for dirpath, _, filenames in os.walk(self.storedir):
+            for filename in filenames:
+                if not filename.endswith(".rpm"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield (path, stat.st_size, stat.st_atime)
+
+    def stats(self):
+        """ Returns a dict with the number and total size of the stored
+        objects, the size cap, and the total size of the packages in the
+        per-repo paths which aren't linked to the store """
+        count = size = 0
+        inodes = set()
+        for path, objsize, _ in self._iter_objects():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            count += 1
+            size += objsize
+            inodes.add((stat.st_dev, stat.st_ino))
+
+        unshared = 0
+        for path in self._iter_repo_pkgs():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) not in inodes:
+                unshared += stat.st_size
+                inodes.add((stat.st_dev, stat.st_ino))
+
+        return {"count": count,
+                "size": size,
+                "max_size": self.max_size,
+                "unshared_size": unshared}
+
+    def _iter_repo_pkgs(self):
+        pkgdir = os.path.join(self.cachedir, "packages")
+        if not os.path.isdir(pkgdir):
+            return
+
+        for dirpath, _, filenames in os.walk(pkgdir):
+            for filename in filenames:
+                if filename.endswith(".rpm"):
+                    yield os.path.join(dirpath, filename)
+
+    def prune(self, max_size=None):
+        """ Evict the least recently used objects, and their links in the
+        per-repo paths, until the store fits in 'max_size' bytes (the size
+        cap of the store if None). The objects used in the last PRUNE_GRACE
+        seconds are kept, concurrent builds may be installing them. Returns
+        the (count, size) evicted. """
+        if max_size is None:
+            if not self.max_size:
+                return (0, 0)
+            max_size = self.max_size
+
+        if not os.path.isdir(self.storedir):
+            return (0, 0)
+
+        lock = SimpleLockfile(os.path.join(self.storedir, "prune.lock"))
+        try:
+            lock.acquire()
+        except LockfileError:
+            msger.verbose("Package store is being pruned by another mic")
+            return (0, 0)
+
+        try:
+            objects = sorted(self._iter_objects(), key=lambda obj: obj[2])
+            total = sum(obj[1] for obj in objects)
+
+            evicted = {}
+            now = time.time()
+            for path, size, atime in objects:
+                if total <= max_size or now - atime < PRUNE_GRACE:
+                    # the rest was used more recently
+                    break
+                try:
+                    objlock = self._lock(path)
+                except LockfileError:
+                    continue
+                try:
+                    stat = os.stat(path)
+                    os.unlink(path)
+                except OSError:
+                    # removed or replaced by a concurrent build
+                    continue
+                finally:
+                    objlock.release()
+                evicted[(stat.st_dev, stat.st_ino)] = size
+                total -= size
+
+            if evicted:
+                for path in self._iter_repo_pkgs():
+                    try:
+                        stat = os.stat(path)
+                        if (stat.st_dev, stat.st_ino) in evicted:
+                            os.unlink(path)
+                    except OSError:
+                        continue
+        finally:
+            lock.release()
+
+        return (len(evicted), sum(evicted.values()))
@@ -0,0 +1,324 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2014 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc., 59
+# Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+""" This module implements an opt-in profiler of the phases of a build.
+
+The phases and sub-phases of a build are marked with the phase() context
+manager, which does nothing unless a profiler is started. For each phase
+the profiler records the wall time, the CPU time of mic and of the commands
+it waited for, the time mic waited for block IO, and the peak RSS. The
+external commands run through mic.utils.runner are counted and timed too.
+
+The report is a dict which can be dumped as JSON. Phases entered several
+times under the same parent (e.g. once per partition) are accumulated in
+one entry, 'count' tells how many times it was entered. Each thread has its
+own stack of open phases, the first phase a thread enters is a sub-phase of
+the total. """
+
+import os
+import time
+import json
+import resource
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# bump it whenever the layout of the report changes
+REPORT_VERSION = 1
+
+# the max length of the command lines recorded in the report
+CMDLINE_MAX = 256
+
+_profiler = None
+
+try:
+    _CLK_TCK = float(os.sysconf("SC_CLK_TCK"))
+except (ValueError, OSError):
+    _CLK_TCK = 100.0
+
+def _read_iowait():
+    """ Seconds mic waited for block IO, from the delay accounting of the
+    kernel, 0 if it's not available """
+    try:
+        with open("/proc/self/stat") as fobj:
+            stat = fobj.read()
+    except IOError:
+        return 0.0
+
+    # the fields after the command name, which may contain spaces, start
+    # with field 3 and delayacct_blkio_ticks is field 42
+    fields = stat[stat.rfind(")") + 2:].split()
+    try:
+        return int(fields[39]) / _CLK_TCK
+    except (IndexError, ValueError):
+        return 0.0
+
+def _read_host_iowait():
+    """ Seconds all the CPUs of the host were idle waiting for IO """
+    try:
+        with open("/proc/stat") as fobj:
+            fields = fobj.readline().split()
+        return int(fields[5]) / _CLK_TCK
+    except (IOError, IndexError, ValueError):
+        return 0.0
+
+def _read_hwm():
+    """ The peak RSS of mic in KiB since the last _reset_hwm() """
+    try:
+        with open("/proc/self/status") as fobj:
+            for line in fobj:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (IOError, IndexError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _reset_hwm():
+    """ Reset the peak RSS of mic to its current RSS, so that the peak of
+    each phase can be measured """
+    try:
+        with open("/proc/self/clear_refs", "w") as fobj:
+            fobj.write("5")
+    except IOError:
+        pass
+
+class _Sample(object):
+    """ The counters at a point in time """
+
+    def __init__(self):
+        self.wall = time.time()
+        (self.user, self.sys,
+         self.cuser, self.csys) = os.times()[:4]
+        self.iowait = _read_iowait()
+        self.host_iowait = _read_host_iowait()
+
+class _Phase(object):
+    """ The accumulated counters of a phase """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.wall = 0.0
+        self.cpu_user = 0.0
+        self.cpu_sys = 0.0
+        self.children_cpu_user = 0.0
+        self.children_cpu_sys = 0.0
+        self.iowait = 0.0
+        self.host_iowait = 0.0
+        self.rss_peak = 0
+        self.children_rss_peak = 0
+        self.commands = 0
+        self.command_wall = 0.0
+        self.phases = OrderedDict()
+
+    def add(self, start, end):
+        self.wall += end.wall - start.wall
+        self.cpu_user += end.user - start.user
+        self.cpu_sys += end.sys - start.sys
+        self.children_cpu_user += end.cuser - start.cuser
+        self.children_cpu_sys += end.csys - start.csys
+        self.iowait += end.iowait - start.iowait
+        self.host_iowait += end.host_iowait - start.host_iowait
+
+    def child(self, name):
+        if name not in self.phases:
+            self.phases[name] = _Phase(name)
+        return self.phases[name]
+
+    def as_dict(self, start=None, end=None):
+        phase = self
+        if start is not None:
+            # the report of a phase still running
+            phase = _Phase(self.name)
+            phase.__dict__.update(self.__dict__)
+            phase.add(start, end)
+
+        return OrderedDict([
+            ("name", phase.name),
+            ("count", phase.count),
+            ("wall", round(phase.wall, 3)),
+            ("cpu_user", round(phase.cpu_user, 3)),
+            ("cpu_sys", round(phase.cpu_sys, 3)),
+            ("children_cpu_user", round(phase.children_cpu_user, 3)),
+            ("children_cpu_sys", round(phase.children_cpu_sys, 3)),
+            ("iowait", round(phase.iowait, 3)),
+            ("host_iowait", round(phase.host_iowait, 3)),
+            ("rss_peak", phase.rss_peak),
+            ("children_rss_peak", phase.children_rss_peak),
+            ("commands", phase.commands),
+            ("command_wall", round(phase.command_wall, 3)),
+            ("phases", [sub.as_dict() for sub in phase.phases.values()]),
+        ])
+
+class Profiler(object):
+    """ Record the phases of a build and the commands it runs """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.commands = []
+        self.root = _Phase("total")
+        self.root.count = 1
+        self.started = _Sample()
+        _reset_hwm()
+        self._local = threading.local()
+        self._local.stack = [(self.root, self.started)]
+
+    def _get_stack(self):
+        """ The open phases of the current thread as (phase, start sample) """
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = [(self.root, self.started)]
+        return stack
+
+    def _update_peaks(self):
+        """ Account the peak RSS since the last reset to all open phases,
+        the peak RSS of the children is the largest RSS of the commands
+        waited for so far """
+        hwm = _read_hwm()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        for phase, _ in self._get_stack():
+            phase.rss_peak = max(phase.rss_peak, hwm)
+            phase.children_rss_peak = max(phase.children_rss_peak, children)
+
+    def enter(self, name):
+        """ Start the sub-phase 'name' of the current phase """
+        with self._lock:
+            self._update_peaks()
+            _reset_hwm()
+            stack = self._get_stack()
+            phase = stack[-1][0].child(name)
+            phase.count += 1
+            stack.append((phase, _Sample()))
+
+    def leave(self):
+        """ End the current phase """
+        with self._lock:
+            end = _Sample()
+            self._update_peaks()
+            phase, start = self._get_stack().pop()
+            phase.add(start, end)
+
+    def current(self):
+        """ The path of the current phase, e.g. 'install/download' """
+        return "/".join(phase.name for phase, _ in self._get_stack()[1:])
+
+    def add_command(self, cmdln_or_args, start, end, returncode):
+        """ Record an external command run between the samples 'start' and
+        'end' """
+        if isinstance(cmdln_or_args, list):
+            cmdln = " ".join(cmdln_or_args)
+        else:
+            cmdln = cmdln_or_args
+        cmd = os.path.basename(cmdln.split(None, 1)[0]) if cmdln else ""
+        wall = end.wall - start.wall
+
+        with self._lock:
+            self.commands.append(OrderedDict([
+                ("command", cmd),
+                ("cmdline", cmdln[:CMDLINE_MAX]),
+                ("phase", self.current()),
+                ("start", round(start.wall - self.started.wall, 3)),
+                ("wall", round(wall, 3)),
+                ("cpu", round(end.cuser - start.cuser +
+                              end.csys - start.csys, 3)),
+                ("returncode", returncode),
+            ]))
+            for phase, _ in self._get_stack():
+                phase.commands += 1
+                phase.command_wall += wall
+
+    def report(self):
+        """ Return the report of the phases entered so far """
+        with self._lock:
+            self._update_peaks()
+            end = _Sample()
+            summary = OrderedDict()
+            for record in sorted(self.commands, key=lambda r: -r["wall"]):
+                item = summary.setdefault(record["command"],
+                                          OrderedDict([("count", 0),
+                                                       ("wall", 0.0),
+                                                       ("cpu", 0.0)]))
+                item["count"] += 1
+                item["wall"] += record["wall"]
+                item["cpu"] += record["cpu"]
+
+            for item in summary.values():
+                item["wall"] = round(item["wall"], 3)
+                item["cpu"] = round(item["cpu"], 3)
+
+            return OrderedDict([
+                ("version", REPORT_VERSION),
+                ("started", time.strftime("%Y-%m-%d %H:%M:%S",
+                                          time.localtime(self.started.wall))),
+                ("cpus", os.sysconf("SC_NPROCESSORS_ONLN")),
+                ("total", self.root.as_dict(self.started, end)),
+                ("command_summary", summary),
+                ("commands", list(self.commands)),
+            ])
+
+    def save(self, path, **extra):
+        """ Write the report, updated with 'extra', to 'path' as JSON """
+        report = self.report()
+        report.update(extra)
+        with open(path, "w") as fobj:
+            json.dump(report, fobj, indent=4)
+        return report
+
+def start():
+    """ Start profiling the process """
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+def stop():
+    """ Stop profiling, and return the profiler """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+def get_profiler():
+    """ Return the profiler if profiling is started, None otherwise """
+    return _profiler
+
+@contextmanager
+def phase(name):
+    """ Profile the code in the context as the phase 'name', a sub-phase of
+    the current phase """
+    profiler = _profiler
+    if profiler is None:
+        yield
+        return
+
+    profiler.enter(name)
+    try:
+        yield
+    finally:
+        profiler.leave()
+
+def command_start():
+    """ Sample the counters before running an external command, None if
+    profiling isn't started """
+    if _profiler is None:
+        return None
+    return _Sample()
+
+def command_end(start, cmdln_or_args, returncode):
+    """ Record the external command started at sample 'start' """
+    profiler = _profiler
+    if profiler is None or start is None:
+        return
+    profiler.add_command(cmdln_or_args, start, _Sample(), returncode)
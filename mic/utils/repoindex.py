@@ -0,0 +1,327 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2014 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc., 59
+# Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+""" This module implements indexes of repository metadata.
+
+A primary.xml file is parsed only once, in a streaming way, into a small
+sqlite database which has the same 'packages' table layout as the
+primary_db (primary.sqlite) published by createrepo. All the helpers in
+mic.utils.misc can therefore query xml and sqlite repos in the same way.
+
+The index is kept in the repo cache directory and is rebuilt only when the
+primary checksum recorded in repomd.xml changes.
+
+Group files (patterns.xml and comps.xml) are likewise parsed once into a
+dict mapping every group id, name and summary to its package list, which
+is pickled next to the group file and validated by its checksum. """
+
+import os
+import tempfile
+import cPickle
+
+try:
+    import sqlite3 as sqlite
+except ImportError:
+    import sqlite
+
+try:
+    from xml.etree import cElementTree
+except ImportError:
+    import cElementTree
+
+from mic import msger
+from mic.utils.errors import CreatorError
+
+INDEX_NAME = "primary.idx"
+# bump it whenever the layout of the index database changes
+INDEX_VERSION = "2"
+
+_SCHEMA = (
+    "CREATE TABLE db_info (version TEXT, checksum TEXT)",
+    "CREATE TABLE packages (name TEXT, arch TEXT, version TEXT, "
+    "release TEXT, location_href TEXT, rpm_sourcerpm TEXT, "
+    "checksum_type TEXT, pkgId TEXT)",
+    "CREATE INDEX packagename ON packages (name)",
+    "CREATE INDEX packagearch ON packages (arch)",
+    "CREATE INDEX packagesourcerpm ON packages (rpm_sourcerpm)",
+)
+
+GROUP_INDEX_SUFFIX = ".idx"
+# bump it whenever the layout of the group index changes
+GROUP_INDEX_VERSION = "1"
+
+# (primary path, checksum) -> index path, for indexes validated in process
+_validated = {}
+
+# (group file path, checksum) -> group index, for indexes loaded in process
+_group_indexes = {}
+
+def _localname(tag):
+    return tag[tag.rfind("}") + 1:]
+
+def _iter_packages(primary):
+    """ Stream <package> elements of 'primary' and yield a tuple for each
+    one, in document order, matching the columns of the 'packages' table. """
+
+    context = cElementTree.iterparse(primary, events=("start", "end"))
+    root = None
+    for event, elm in context:
+        if event == "start":
+            if root is None:
+                root = elm
+            continue
+
+        if _localname(elm.tag) != "package":
+            continue
+
+        name = arch = ver = rel = href = srpm = cstype = pkgid = None
+        for child in elm:
+            tag = _localname(child.tag)
+            if tag == "name":
+                name = child.text
+            elif tag == "arch":
+                arch = child.text
+            elif tag == "version":
+                ver = child.attrib.get("ver")
+                rel = child.attrib.get("rel")
+            elif tag == "location":
+                href = child.attrib.get("href")
+            elif tag == "checksum":
+                cstype = child.attrib.get("type")
+                pkgid = child.text
+            elif tag == "format":
+                for fchild in child:
+                    if _localname(fchild.tag) == "sourcerpm":
+                        srpm = fchild.text
+                        break
+
+        yield (name, arch, ver, rel, href, srpm, cstype, pkgid)
+
+        # drop the parsed package, keep memory usage flat
+        elm.clear()
+        root.clear()
+
+def _read_checksum(index):
+    if not os.path.exists(index):
+        return None
+
+    try:
+        con = sqlite.connect(index)
+        try:
+            row = con.execute("select version, checksum from db_info").fetchone()
+        finally:
+            con.close()
+    except sqlite.Error:
+        return None
+
+    if not row or row[0] != INDEX_VERSION:
+        return None
+
+    return row[1]
+
+def _primary_checksum(repo, item="primary"):
+    """ Return the key an index of 'repo' is validated against: the
+    open-checksum of 'item' from repomd.xml, or size and mtime if it's
+    unknown. """
+
+    checksums = repo.get("checksums") or {}
+    if checksums.get(item):
+        return checksums[item]
+
+    stat = os.stat(repo[item])
+    return "%d-%d" % (stat.st_size, stat.st_mtime)
+
+def _build_index(primary, index, checksum):
+    msger.verbose("Indexing repo metadata: %s" % primary)
+
+    fd, tmpindex = tempfile.mkstemp(dir=os.path.dirname(index),
+                                    prefix=".%s-" % INDEX_NAME)
+    os.close(fd)
+    try:
+        con = sqlite.connect(tmpindex)
+        try:
+            for stmt in _SCHEMA:
+                con.execute(stmt)
+            con.executemany("insert into packages values "
+                            "(?, ?, ?, ?, ?, ?, ?, ?)",
+                            _iter_packages(primary))
+            con.execute("insert into db_info values (?, ?)",
+                        (INDEX_VERSION, checksum))
+            con.commit()
+        finally:
+            con.close()
+        # rename is atomic, so concurrent builds never see a partial index
+        os.rename(tmpindex, index)
+    except SyntaxError:
+        os.unlink(tmpindex)
+        raise CreatorError("%s syntax error." % primary)
+    except:
+        os.unlink(tmpindex)
+        raise
+
+def get_primary_db(repo):
+    """ Return the path of a sqlite database with a 'packages' table for
+    'repo', which is an item of the list returned by
+    misc.get_metadata_from_repos. """
+
+    primary = repo["primary"]
+    if primary.endswith(".sqlite"):
+        return primary
+
+    checksum = _primary_checksum(repo)
+    if (primary, checksum) in _validated:
+        return _validated[(primary, checksum)]
+
+    index = os.path.join(os.path.dirname(primary), INDEX_NAME)
+    if _read_checksum(index) != checksum:
+        _build_index(primary, index, checksum)
+
+    _validated[(primary, checksum)] = index
+    return index
+
+def connect(repo):
+    """ Open the primary database of 'repo' """
+    con = sqlite.connect(get_primary_db(repo))
+    con.text_factory = str
+    return con
+
+def _iter_top_elements(groupfile, match):
+    """ Stream the elements of 'groupfile' for which 'match(elm, depth)' is
+    true, the root element has depth 0. Matched elements are dropped after
+    being yielded. """
+
+    try:
+        depth = -1
+        root = None
+        for event, elm in cElementTree.iterparse(groupfile,
+                                                 events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if root is None:
+                    root = elm
+                continue
+
+            if match(elm, depth):
+                yield elm
+                elm.clear()
+                if depth == 1:
+                    root.clear()
+            depth -= 1
+    except SyntaxError:
+        raise SyntaxError("%s syntax error." % groupfile)
+
+def _uniq(items):
+    seen = set()
+    result = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            result.append(item)
+    return result
+
+def _iter_patterns(patterns):
+    """ Yield a tuple (keys, package list) for each pattern of 'patterns',
+    the keys are the name and the summary of the pattern. """
+
+    for elm in _iter_top_elements(patterns, lambda elm, depth: depth == 1):
+        name = summary = requires = None
+        for child in elm:
+            tag = _localname(child.tag)
+            if tag == "name" and name is None:
+                name = child
+            elif tag == "summary" and summary is None:
+                summary = child
+            elif requires is None and child.tag.endswith("requires"):
+                requires = child
+
+        keys = [child.text for child in (name, summary) if child is not None]
+        pkglist = []
+        if requires is not None:
+            pkglist = _uniq(pkg.attrib["name"] for pkg in requires)
+        yield (keys, pkglist)
+
+def _iter_comps(comps):
+    """ Yield a tuple (keys, package list) for each group of 'comps', the
+    keys are the id and the name of the group. """
+
+    for elm in _iter_top_elements(comps, lambda elm, depth: elm.tag == "group"):
+        keys = []
+        for tag in ("id", "name"):
+            child = elm.find(tag)
+            if child is not None:
+                keys.append(child.text)
+
+        pkglist = _uniq(req.text for req in elm.getiterator("packagereq"))
+        yield (keys, pkglist)
+
+def _build_group_index(groupfile, kind):
+    if kind == "patterns":
+        groups = _iter_patterns(groupfile)
+    else:
+        groups = _iter_comps(groupfile)
+
+    # the first group in the file wins, as when searching it
+    index = {}
+    for keys, pkglist in groups:
+        for key in keys:
+            if key is not None and key not in index:
+                index[key] = pkglist
+    return index
+
+def _load_group_index(path, checksum):
+    try:
+        with open(path, "rb") as fobj:
+            version, idx_checksum, index = cPickle.load(fobj)
+    except (IOError, EOFError, ValueError, TypeError, cPickle.PickleError):
+        return None
+
+    if version != GROUP_INDEX_VERSION or idx_checksum != checksum:
+        return None
+    return index
+
+def _save_group_index(path, checksum, index):
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path),
+                                   prefix=".%s-" % os.path.basename(path))
+    try:
+        with os.fdopen(fd, "wb") as fobj:
+            cPickle.dump((GROUP_INDEX_VERSION, checksum, index), fobj,
+                         cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmppath, path)
+    except:
+        os.unlink(tmppath)
+        raise
+
+def get_group_index(repo, kind):
+    """ Return a dict mapping the group names of 'repo' to their package
+    lists. 'kind' is "patterns" (keyed by name and summary) or "comps"
+    (keyed by id and name), 'repo' needs the path of the group file as
+    'kind' and optionally its open-checksum in 'checksums'. """
+
+    groupfile = repo[kind]
+    checksum = _primary_checksum(repo, kind)
+    if (groupfile, checksum) in _group_indexes:
+        return _group_indexes[(groupfile, checksum)]
+
+    path = groupfile + GROUP_INDEX_SUFFIX
+    index = _load_group_index(path, checksum)
+    if index is None:
+        msger.verbose("Indexing repo groups: %s" % groupfile)
+        index = _build_group_index(groupfile, kind)
+        _save_group_index(path, checksum, index)
+
+    _group_indexes[(groupfile, checksum)] = index
+    return index
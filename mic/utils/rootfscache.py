@@ -0,0 +1,257 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2014 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc., 59
+# Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+""" This module implements a cache of installed root file-systems.
+
+Right after the packages are installed, the install root is saved as a
+compressed tarball under 'cachedir/rootfs', named after a hash of the
+resolved package set and of the parameters of the rpm transaction (the
+arch and the rpm macros). A later build resolving the same package set
+restores the tarball into its freshly mounted install root instead of
+downloading and installing the packages.
+
+The files mic itself writes into the install root before installing
+(/etc/fstab, /etc/mtab) and the content of the pseudo file-systems bind
+mounted into it are not saved. The last use of a snapshot is recorded in
+its mtime, the snapshots unused for too long and then the least recently
+used ones beyond the size cap are evicted.
+
+copy_rootfs() copies an install root into another one with the same
+exclusions, to build several images from a single install. """
+
+import os
+import time
+import pipes
+import hashlib
+
+from mic import msger
+from mic.utils import runner
+from mic.utils.misc import human_size
+from mic.utils.errors import CreatorError
+
+CACHE_NAME = "rootfs"
+# bump it whenever the content of the snapshots changes
+CACHE_VERSION = "2"
+
+# paths relative to the install root which are never saved, the device
+# nodes of the loop devices are created by the raw image creator
+EXCLUDES = ("./proc/*", "./sys/*", "./dev/pts/*", "./dev/loop*",
+            "./dev/mapper", "./etc/fstab", "./etc/mtab",
+            "./var/lib/rpm/__db*", "./__catched_stderr.buf", "lost+found")
+
+# (suffix, compress command line) in order of preference, each command
+# decompresses with '-d -c'
+_COMPRESSORS = (
+    (".tar.zst", ["zstd", "-q", "-T0"]),
+    (".tar.gz", ["pigz"]),
+    (".tar.gz", ["gzip"]),
+)
+
+def _which(binary):
+    for path in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        if os.access(os.path.join(path, binary), os.X_OK):
+            return os.path.join(path, binary)
+    return None
+
+def _tar_opts():
+    """ The options of tar to save and restore an install root as is """
+    opts = ["--numeric-owner", "-S"]
+    if "--xattrs" in runner.outs(["tar", "--help"]):
+        # keep the file capabilities and the SMACK/SELinux labels
+        opts += ["--xattrs", "--xattrs-include=*"]
+    return opts
+
+def _tar_excludes():
+    return " ".join("--exclude=%s" % pipes.quote(pattern)
+                    for pattern in EXCLUDES)
+
+def copy_rootfs(src, dst):
+    """ Copy the install root 'src' into the install root 'dst', which is
+    mounted already, keeping the ownership, the extended attributes and the
+    holes of the files """
+    msger.info("Copying install root %s to %s ..." % (src, dst))
+    tar = "tar %s" % " ".join(_tar_opts())
+    cmdln = "set -o pipefail; %s %s -C %s -cpf - . | %s -C %s -xpf -" \
+            % (tar, _tar_excludes(), pipes.quote(src), tar, pipes.quote(dst))
+    if runner.show(["bash", "-c", cmdln]) != 0:
+        raise CreatorError("Failed to copy install root %s to %s"
+                           % (src, dst))
+
+class RootfsCache(object):
+    """ Cache of the install roots of a cache directory """
+
+    # the sub-directory of the cache directory holding the snapshots
+    cache_name = CACHE_NAME
+    # what the snapshots are, in the messages
+    snapshot_desc = "install root"
+
+    def __init__(self, cachedir, max_size=0, max_age=0, params=None):
+        """ 'max_size' is the size cap of the cache in bytes, 'max_age' the
+        max time in seconds a snapshot is kept unused, 0 for no limit.
+        'params' is a dict of the parameters of the transaction, which are
+        part of the key of the snapshots. """
+        self.cachedir = os.path.abspath(cachedir)
+        self.snapdir = os.path.join(self.cachedir, self.cache_name)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.params = params or {}
+
+    def available(self):
+        """ Check if the tools needed by the cache are installed """
+        return _which("tar") is not None and \
+               any(_which(cmdln[0]) for _, cmdln in _COMPRESSORS)
+
+    def get_key(self, packages):
+        """ Hash the list 'packages' of package identifiers (e.g. NEVRA and
+        checksum) and the parameters of the transaction, into the key of a
+        snapshot """
+        hash_obj = hashlib.sha256()
+        hash_obj.update("version=%s\n" % CACHE_VERSION)
+        for name in sorted(self.params):
+            hash_obj.update("%s=%s\n" % (name, self.params[name]))
+        for pkg in sorted(set(packages)):
+            hash_obj.update("%s\n" % pkg)
+        return hash_obj.hexdigest()
+
+    def _find(self, key):
+        for suffix, _ in _COMPRESSORS:
+            path = os.path.join(self.snapdir, key + suffix)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def restore(self, key, instroot):
+        """ Restore the snapshot 'key' into 'instroot'. Returns True if it
+        was found and restored, raises CreatorError if it was found but
+        couldn't be restored, as 'instroot' is partially restored then. """
+        path = self._find(key)
+        if path is None:
+            return False
+
+        msger.info("Restoring cached install root %s ..."
+                   % os.path.basename(path))
+        # touch it first so that a concurrent prune doesn't evict it
+        try:
+            os.utime(path, None)
+        except OSError:
+            return False
+
+        decompress = [cmdln[0] for suffix, cmdln in _COMPRESSORS
+                      if path.endswith(suffix) and _which(cmdln[0])]
+        if not decompress:
+            return False
+
+        cmdln = "set -o pipefail; %s -d -c %s | tar %s -C %s -xpf -" \
+                % (decompress[0], pipes.quote(path),
+                   " ".join(_tar_opts()), pipes.quote(instroot))
+        if runner.show(["bash", "-c", cmdln]) != 0:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            raise CreatorError("Failed to restore cached install root %s, "
+                               "evicted it, please retry" % path)
+        return True
+
+    def save(self, key, instroot):
+        """ Save 'instroot' as the snapshot 'key'. Returns True if it was
+        saved. """
+        for suffix, compress in _COMPRESSORS:
+            if _which(compress[0]):
+                break
+        else:
+            return False
+
+        if not os.path.isdir(self.snapdir):
+            os.makedirs(self.snapdir)
+
+        path = os.path.join(self.snapdir, key + suffix)
+        tmppath = os.path.join(self.snapdir, ".%s.%d" % (key, os.getpid()))
+
+        msger.info("Saving install root to cache ...")
+        cmdln = "set -o pipefail; tar %s %s -C %s -cpf - . | %s > %s" \
+                % (" ".join(_tar_opts()), _tar_excludes(),
+                   pipes.quote(instroot), " ".join(compress),
+                   pipes.quote(tmppath))
+        try:
+            if runner.show(["bash", "-c", cmdln]) != 0:
+                msger.warning("Failed to save install root to cache")
+                return False
+            # rename is atomic, so concurrent builds never see a partial one
+            os.rename(tmppath, path)
+        finally:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+
+        msger.verbose("Saved install root as %s (%s)"
+                      % (path, human_size(os.path.getsize(path))))
+        self.prune()
+        return True
+
+    def _iter_snapshots(self):
+        """ Yield (path, size, mtime) of all the snapshots """
+        if not os.path.isdir(self.snapdir):
+            return
+
+        for filename in os.listdir(self.snapdir):
+            if filename.startswith("."):
+                continue
+            path = os.path.join(self.snapdir, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            yield (path, stat.st_size, stat.st_mtime)
+
+    def stats(self):
+        """ Returns a dict with the number and total size of the snapshots,
+        and the size and age caps """
+        snapshots = list(self._iter_snapshots())
+        return {"count": len(snapshots),
+                "size": sum(snap[1] for snap in snapshots),
+                "max_size": self.max_size,
+                "max_age": self.max_age}
+
+    def prune(self, max_size=None, max_age=None):
+        """ Evict the snapshots unused for more than 'max_age' seconds, then
+        the least recently used ones until the cache fits in 'max_size'
+        bytes (the caps of the cache if None). Returns the (count, size)
+        evicted. """
+        if max_size is None:
+            max_size = self.max_size
+        if max_age is None:
+            max_age = self.max_age
+
+        snapshots = sorted(self._iter_snapshots(), key=lambda snap: snap[2])
+        total = sum(snap[1] for snap in snapshots)
+        now = time.time()
+
+        count = evicted = 0
+        for path, size, mtime in snapshots:
+            if not (max_age and now - mtime > max_age) and \
+               not (max_size and total > max_size):
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            msger.verbose("Evicted cached %s %s" % (self.snapshot_desc, path))
+            total -= size
+            count += 1
+            evicted += size
+
+        return (count, evicted)
@@ -18,8 +18,15 @@
 import os
 import sys
 import re
+import struct
+import hashlib
 import rpm
 
+try:
+    import sqlite3 as sqlite
+except ImportError:
+    import sqlite
+
 from mic import msger
 from mic.utils.errors import CreatorError
 from mic.utils.proxy import get_proxy_for
@@ -375,8 +382,245 @@ def getBaseArch():
 
         return basearch
 
-def checkRpmIntegrity(bin_rpm, package):
-    return runner.quiet([bin_rpm, "-K", "--nosignature", package])
+_RPM_LEAD_MAGIC = '\xed\xab\xee\xdb'
+_RPM_LEAD_SIZE = 96
+_RPM_HEADER_MAGIC = '\x8e\xad\xe8'
+
+# header tag types
+_RPM_INT32_TYPE = 4
+_RPM_INT64_TYPE = 5
+_RPM_STRING_TYPE = 6
+_RPM_BIN_TYPE = 7
+_RPM_STRING_ARRAY_TYPE = 8
+
+# signature header tags
+_RPMSIGTAG_SIZE = 1000
+_RPMSIGTAG_LONGSIZE = 270
+_RPMSIGTAG_MD5 = 1004
+_RPMSIGTAG_SHA1 = 269
+_RPMSIGTAG_SHA256 = 273
+
+# main header tags
+_RPMTAG_PAYLOADDIGEST = 5092
+_RPMTAG_PAYLOADDIGESTALGO = 5093
+
+# PGP hash algorithm ids used by PAYLOADDIGESTALGO
+_PGP_HASH_ALGOS = { 1: 'md5', 2: 'sha1', 8: 'sha256', 9: 'sha384',
+                    10: 'sha512', 11: 'sha224' }
+
+class RpmDigestError(Exception):
+    """ The package can't be parsed for in-process digest verification """
+    pass
+
+def _readRpmHeaderBlob(rfile):
+    """ Read a header structure from 'rfile', return the raw header bytes
+    and a dict mapping tags to their values. """
+
+    intro = rfile.read(16)
+    if len(intro) != 16 or intro[:3] != _RPM_HEADER_MAGIC:
+        raise RpmDigestError("bad header magic")
+
+    il, dl = struct.unpack('>II', intro[8:16])
+    index = rfile.read(16 * il)
+    store = rfile.read(dl)
+    if len(index) != 16 * il or len(store) != dl:
+        raise RpmDigestError("truncated header")
+
+    tags = {}
+    for i in range(il):
+        tag, typ, off, cnt = struct.unpack('>IIII', index[i*16:(i+1)*16])
+        if typ == _RPM_BIN_TYPE:
+            tags[tag] = store[off:off+cnt]
+        elif typ == _RPM_INT32_TYPE:
+            tags[tag] = struct.unpack('>%dI' % cnt, store[off:off+4*cnt])
+        elif typ == _RPM_INT64_TYPE:
+            tags[tag] = struct.unpack('>%dQ' % cnt, store[off:off+8*cnt])
+        elif typ == _RPM_STRING_TYPE:
+            tags[tag] = store[off:store.index('\0', off)]
+        elif typ == _RPM_STRING_ARRAY_TYPE:
+            tags[tag] = store[off:].split('\0')[:cnt]
+
+    return intro + index + store, tags
+
+def verifyRpmDigests(package):
+    """ Check the digests of an rpm package in process, like
+    'rpm -K --nosignature' does: the size of header and payload, the MD5
+    of header and payload, the SHA1/SHA256 of the header and the payload
+    digest, whichever are recorded in the package.
+
+    Returns the header digest on success, raises RpmDigestError if the
+    package has no digest, or CreatorError if a digest mismatches.
+    """
+
+    with open(package, 'rb') as rfile:
+        lead = rfile.read(_RPM_LEAD_SIZE)
+        if len(lead) != _RPM_LEAD_SIZE or lead[:4] != _RPM_LEAD_MAGIC:
+            raise CreatorError("bad rpm lead")
+
+        try:
+            sigblob, sigtags = _readRpmHeaderBlob(rfile)
+            # signature header is padded to 8 bytes
+            rfile.read((8 - len(sigblob) % 8) % 8)
+            hdrblob, hdrtags = _readRpmHeaderBlob(rfile)
+        except RpmDigestError, err:
+            raise CreatorError(str(err))
+
+        md5 = None
+        if _RPMSIGTAG_MD5 in sigtags:
+            md5 = hashlib.md5(hdrblob)
+
+        payload = None
+        if _RPMTAG_PAYLOADDIGEST in hdrtags:
+            algo = hdrtags.get(_RPMTAG_PAYLOADDIGESTALGO, (8,))[0]
+            if algo in _PGP_HASH_ALGOS:
+                payload = hashlib.new(_PGP_HASH_ALGOS[algo])
+
+        size = len(hdrblob)
+        while True:
+            chunk = rfile.read(1024 * 1024)
+            if not chunk:
+                break
+            size += len(chunk)
+            if md5:
+                md5.update(chunk)
+            if payload:
+                payload.update(chunk)
+
+    digest = None
+    if _RPMSIGTAG_SHA256 in sigtags:
+        digest = hashlib.sha256(hdrblob).hexdigest()
+        if digest != sigtags[_RPMSIGTAG_SHA256]:
+            raise CreatorError("header SHA256 digest mismatch")
+
+    if _RPMSIGTAG_SHA1 in sigtags:
+        sha1 = hashlib.sha1(hdrblob).hexdigest()
+        if sha1 != sigtags[_RPMSIGTAG_SHA1]:
+            raise CreatorError("header SHA1 digest mismatch")
+        digest = digest or sha1
+
+    for tag in (_RPMSIGTAG_SIZE, _RPMSIGTAG_LONGSIZE):
+        if tag in sigtags and sigtags[tag][0] != size:
+            raise CreatorError("header+payload size mismatch")
+
+    if md5:
+        if md5.digest() != sigtags[_RPMSIGTAG_MD5]:
+            raise CreatorError("MD5 digest mismatch")
+        digest = digest or md5.hexdigest()
+
+    if payload:
+        if payload.hexdigest() != hdrtags[_RPMTAG_PAYLOADDIGEST][0]:
+            raise CreatorError("payload digest mismatch")
+
+    if not digest:
+        raise RpmDigestError("no digest found in %s" % package)
+
+    return digest
+
+class RpmVerifyLedger(object):
+    """ Record of packages which passed the integrity check, keyed by path,
+    size and mtime, so that unchanged packages in the cache are not checked
+    again on later builds. """
+
+    def __init__(self, dbpath):
+        self.con = sqlite.connect(dbpath, timeout = 60)
+        self.con.execute("CREATE TABLE IF NOT EXISTS verified (path TEXT "
+                         "PRIMARY KEY, size INTEGER, mtime INTEGER, "
+                         "digest TEXT)")
+        self.con.commit()
+
+    def lookup(self, path):
+        """ Return True if 'path' was verified and is unchanged since """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+
+        row = self.con.execute("select size, mtime from verified where "
+                               "path = ?", (path,)).fetchone()
+        return row is not None and row[0] == st.st_size and \
+               row[1] == int(st.st_mtime)
+
+    def record(self, path, digest):
+        st = os.stat(path)
+        self.con.execute("insert or replace into verified values "
+                         "(?, ?, ?, ?)",
+                         (path, st.st_size, int(st.st_mtime), digest))
+        self.con.commit()
+
+    def forget(self, path):
+        self.con.execute("delete from verified where path = ?", (path,))
+        self.con.commit()
+
+_ledgers = {}
+
+def getVerifyLedger(cachedir):
+    """ Return the package verification ledger in 'cachedir' """
+
+    dbpath = os.path.join(os.path.abspath(cachedir), "packages", "verified.db")
+    if dbpath not in _ledgers:
+        if not os.path.exists(os.path.dirname(dbpath)):
+            os.makedirs(os.path.dirname(dbpath))
+        _ledgers[dbpath] = RpmVerifyLedger(dbpath)
+
+    return _ledgers[dbpath]
+
+def _verifyRpm(args):
+    bin_rpm, package = args
+    try:
+        return (0, verifyRpmDigests(package))
+    except RpmDigestError:
+        # nothing to check in process, leave it to rpm
+        return (runner.quiet([bin_rpm, "-K", "--nosignature", package]), None)
+    except (CreatorError, IOError, OSError), err:
+        msger.debug("integrity check of %s failed: %s" % (package, err))
+        return (1, None)
+
+def checkRpmsIntegrity(bin_rpm, packages, ledger = None, workers = None):
+    """ Check the integrity of 'packages' in a thread pool, returns a dict
+    mapping each package to 0 if it's fine or non-zero if it's damaged.
+    Packages recorded in 'ledger' are not checked again. """
+
+    results = {}
+    tocheck = []
+    for package in packages:
+        package = os.path.abspath(package)
+        if ledger and ledger.lookup(package):
+            results[package] = 0
+        else:
+            tocheck.append(package)
+
+    if not tocheck:
+        return results
+
+    if workers is None:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+
+    if workers > 1 and len(tocheck) > 1:
+        # hashlib releases the GIL while hashing, threads are good enough
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(workers, len(tocheck)))
+        try:
+            rets = pool.map(_verifyRpm, [(bin_rpm, p) for p in tocheck])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        rets = map(_verifyRpm, [(bin_rpm, p) for p in tocheck])
+
+    for package, (ret, digest) in zip(tocheck, rets):
+        results[package] = ret
+        if ledger:
+            if ret == 0:
+                ledger.record(package, digest)
+            else:
+                ledger.forget(package)
+
+    return results
+
+def checkRpmIntegrity(bin_rpm, package, ledger = None):
+    package = os.path.abspath(package)
+    return checkRpmsIntegrity(bin_rpm, [package], ledger, 1)[package]
 
 def checkSig(ts, package):
     """ Takes a transaction set and a package, check it's sigs,
@@ -16,10 +16,144 @@
 # Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
 import os
+import time
+import threading
 import subprocess
+from collections import deque
 
 from mic import msger
-from mic.utils import errors
+from mic.utils import errors, profiler
+
+# the number of the last output lines kept by stream()
+TAIL_LINES = 100
+# the max length of an output line read at once by stream()
+LINE_MAX = 64 * 1024
+# the number of the most recent commands kept in the history
+HISTORY_MAX = 1000
+
+class CommandRecord(object):
+    """ An external command run by this module: its 'cmdline', 'command'
+    name, 'returncode', 'duration' in seconds, the number of bytes of
+    output read from it as 'output_bytes', and the time it 'started' """
+
+    def __init__(self, cmdline, command, started):
+        self.cmdline = cmdline
+        self.command = command
+        self.started = started
+        self.returncode = None
+        self.duration = 0.0
+        self.output_bytes = 0
+
+    def __repr__(self):
+        return "<CommandRecord %r rc=%s %.3fs %dB>" % (self.cmdline,
+                self.returncode, self.duration, self.output_bytes)
+
+_history_lock = threading.Lock()
+_history = deque(maxlen=HISTORY_MAX)
+# command name -> [count, failed, duration, output_bytes] of all commands
+_stats = {}
+
+def _get_cmdline(cmdln_or_args):
+    if isinstance(cmdln_or_args, list):
+        return ' '.join(cmdln_or_args)
+    return cmdln_or_args
+
+def _add_record(record):
+    with _history_lock:
+        _history.append(record)
+        stats = _stats.setdefault(record.command, [0, 0, 0.0, 0])
+        stats[0] += 1
+        if record.returncode != 0:
+            stats[1] += 1
+        stats[2] += record.duration
+        stats[3] += record.output_bytes
+
+def get_history(command=None):
+    """ Return the CommandRecord of the most recent commands, the oldest
+    first, only the ones named 'command' if given """
+    with _history_lock:
+        records = list(_history)
+    if command is not None:
+        records = [r for r in records if r.command == command]
+    return records
+
+def get_stats():
+    """ Return a dict mapping the name of every command run so far to a
+    dict with its 'count', 'failed' count, total 'duration' and total
+    'output_bytes' """
+    with _history_lock:
+        return dict((name, {'count': stats[0],
+                            'failed': stats[1],
+                            'duration': stats[2],
+                            'output_bytes': stats[3]})
+                    for name, stats in _stats.items())
+
+def clear_history():
+    """ Forget the commands run so far """
+    with _history_lock:
+        _history.clear()
+        _stats.clear()
+
+def _new_record(cmdln_or_args):
+    cmdline = _get_cmdline(cmdln_or_args)
+    return CommandRecord(cmdline, os.path.basename(cmdline.split(None, 1)[0]),
+                         time.time())
+
+def _popen(cmdln_or_args, **kwargs):
+    """ Start a command, returns the Popen object """
+    if isinstance(cmdln_or_args, list):
+        cmd = cmdln_or_args[0]
+        shell = False
+    else:
+        import shlex
+        cmd = shlex.split(cmdln_or_args)[0]
+        shell = True
+
+    try:
+        return subprocess.Popen(cmdln_or_args, shell=shell, **kwargs)
+    except OSError, e:
+        if e.errno == 2:
+            # [Errno 2] No such file or directory
+            raise errors.CreatorError('Cannot run command: %s, lost dependency?' % cmd)
+        else:
+            raise # relay
+
+def stream(cmdln_or_args, callback=None, tail=TAIL_LINES):
+    """ Run a command, reading its output incrementally instead of
+    buffering it all in memory
+    input:
+        cmdln_or_args: can be both args and cmdln str (shell=True)
+        callback: called with each line of STDOUT and STDERR, without the
+                  line break, as soon as it is read
+        tail: the number of the last lines of output to keep
+    return:
+        (rc, the last 'tail' lines of output as a list)
+    """
+    record = _new_record(cmdln_or_args)
+    started = profiler.command_start()
+    lines = deque(maxlen=tail)
+    try:
+        p = _popen(cmdln_or_args, stdout=subprocess.PIPE,
+                   stderr=subprocess.STDOUT)
+        try:
+            while True:
+                line = p.stdout.readline(LINE_MAX)
+                if not line:
+                    break
+                record.output_bytes += len(line)
+                line = line.rstrip('\r\n')
+                lines.append(line)
+                if callback:
+                    callback(line)
+        finally:
+            p.stdout.close()
+            record.returncode = p.wait()
+    finally:
+        record.duration = time.time() - record.started
+        _add_record(record)
+        profiler.command_end(started, cmdln_or_args, record.returncode)
+
+    return (record.returncode, list(lines))
 
 def runtool(cmdln_or_args, catch=1):
     """ wrapper for most of the subprocess calls
@@ -38,14 +172,6 @@ def runtool(cmdln_or_args, catch=1):
         # invalid catch selection, will cause exception, that's good
         return None
 
-    if isinstance(cmdln_or_args, list):
-        cmd = cmdln_or_args[0]
-        shell = False
-    else:
-        import shlex
-        cmd = shlex.split(cmdln_or_args)[0]
-        shell = True
-
     if catch != 3:
         dev_null = os.open("/dev/null", os.O_WRONLY)
 
@@ -62,44 +188,33 @@ def runtool(cmdln_or_args, catch=1):
         sout = subprocess.PIPE
         serr = subprocess.STDOUT
 
+    record = _new_record(cmdln_or_args)
+    started = profiler.command_start()
     try:
-        p = subprocess.Popen(cmdln_or_args, stdout=sout,
-                             stderr=serr, shell=shell)
+        p = _popen(cmdln_or_args, stdout=sout, stderr=serr)
         (sout, serr) = p.communicate()
         # combine stdout and stderr, filter None out
         out = ''.join(filter(None, [sout, serr]))
-    except OSError, e:
-        if e.errno == 2:
-            # [Errno 2] No such file or directory
-            raise errors.CreatorError('Cannot run command: %s, lost dependency?' % cmd)
-        else:
-            raise # relay
+        record.returncode = p.returncode
+        record.output_bytes = len(out)
     finally:
         if catch != 3:
             os.close(dev_null)
+        record.duration = time.time() - record.started
+        _add_record(record)
+        profiler.command_end(started, cmdln_or_args, record.returncode)
 
     return (p.returncode, out)
 
 def show(cmdln_or_args):
-    # show all the message using msger.verbose
+    # show all the message using msger.verbose, line by line as they come
 
-    rc, out = runtool(cmdln_or_args, catch=3)
+    msger.verbose('running command: "%s"' % _get_cmdline(cmdln_or_args))
 
-    if isinstance(cmdln_or_args, list):
-        cmd = ' '.join(cmdln_or_args)
-    else:
-        cmd = cmdln_or_args
-
-    msg =  'running command: "%s"' % cmd
-    if out: out = out.strip()
-    if out:
-        msg += ', with output::'
-        msg += '\n  +----------------'
-        for line in out.splitlines():
-            msg += '\n  | %s' % line
-        msg += '\n  +----------------'
-
-    msger.verbose(msg)
+    def show_line(line):
+        msger.verbose('  | %s' % line)
+
+    rc, _ = stream(cmdln_or_args, show_line)
     return rc
 
 def outs(cmdln_or_args, catch=1):
@@ -0,0 +1,209 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2014 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc., 59
+# Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+""" This module implements copying of (big and sparse) image files.
+
+The destination shares the extents of the source if the file-system can
+reflink them (FICLONE). Otherwise only the mapped ranges of the source,
+as reported by Filemap, are copied, in the kernel with copy_file_range()
+where possible, and the holes are left as holes in the destination. """
+
+import os
+import stat
+import errno
+import fcntl
+import shutil
+import ctypes
+import ctypes.util
+import logging
+
+from mic import msger
+from mic.utils.misc import human_size
+from mic.utils import Filemap
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+COPY_CHUNK_SIZE = 1024 * 1024
+# the max length copy_file_range() is asked to copy at once
+COPY_RANGE_SIZE = 64 * 1024 * 1024
+
+# errors meaning that a copy method is not supported for the given files
+_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                errno.ENOTTY, errno.EBADF, errno.ETXTBSY, errno.EPERM)
+
+def _get_copy_file_range():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        func = libc.copy_file_range
+    except (OSError, AttributeError):
+        return None
+
+    func.restype = ctypes.c_ssize_t
+    func.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+                     ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+                     ctypes.c_size_t, ctypes.c_uint)
+    return func
+
+_copy_file_range = _get_copy_file_range()
+
+class CopyStats(object):
+    """ What a copy did: the logical 'size' of the file, the number of
+    bytes actually 'moved' through the page cache or the kernel, and the
+    'method' used """
+
+    def __init__(self, size, moved, method):
+        self.size = size
+        self.moved = moved
+        self.method = method
+
+    def __str__(self):
+        return "%s of %s moved by %s" % (human_size(self.moved),
+                                         human_size(self.size), self.method)
+
+def _reflink(src_fd, dst_fd):
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except IOError, err:
+        if err.errno in _UNSUPPORTED:
+            return False
+        raise
+
+def _kernel_copy(src_fd, dst_fd, offset, length):
+    """ Copy 'length' bytes at 'offset' with copy_file_range(), returns the
+    number of bytes copied, which is less than 'length' if the kernel or
+    the file-systems can't do it """
+    src_off = ctypes.c_longlong(offset)
+    dst_off = ctypes.c_longlong(offset)
+    copied = 0
+    while copied < length:
+        ret = _copy_file_range(src_fd, ctypes.byref(src_off),
+                               dst_fd, ctypes.byref(dst_off),
+                               min(length - copied, COPY_RANGE_SIZE), 0)
+        if ret < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err in _UNSUPPORTED:
+                break
+            raise OSError(err, os.strerror(err))
+        if ret == 0:
+            break
+        copied += ret
+    return copied
+
+def _user_copy(src_fd, dst_fd, offset, length):
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    copied = 0
+    while copied < length:
+        chunk = os.read(src_fd, min(length - copied, COPY_CHUNK_SIZE))
+        if not chunk:
+            break
+        while chunk:
+            written = os.write(dst_fd, chunk)
+            chunk = chunk[written:]
+            copied += written
+    return copied
+
+def get_mapped_ranges(src_fobj, size):
+    """ Yield (offset, length) of the mapped areas of 'src_fobj', the whole
+    file if its holes can't be detected """
+    log = logging.getLogger(__name__)
+    if not log.handlers:
+        log.addHandler(logging.NullHandler())
+
+    if not size:
+        return
+
+    try:
+        fmap = Filemap.filemap(src_fobj, log)
+    except (Filemap.Error, Filemap.ErrorNotSupp):
+        yield (0, size)
+        return
+
+    for first, last in fmap.get_mapped_ranges(0, fmap.blocks_cnt):
+        offset = first * fmap.block_size
+        yield (offset, min((last + 1) * fmap.block_size, size) - offset)
+
+def copy_file(src, dst):
+    """ Copy the content of the file 'src' to 'dst', keeping it sparse.
+    Returns a CopyStats instance. """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+
+    src_fobj = open(src, "rb")
+    try:
+        size = os.fstat(src_fobj.fileno()).st_size
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            src_fd = src_fobj.fileno()
+            if size and _reflink(src_fd, dst_fd):
+                stats = CopyStats(size, 0, "reflink")
+            else:
+                use_kernel = _copy_file_range is not None
+                moved = 0
+                for offset, length in get_mapped_ranges(src_fobj, size):
+                    copied = 0
+                    if use_kernel:
+                        copied = _kernel_copy(src_fd, dst_fd, offset, length)
+                        if copied < length:
+                            use_kernel = False
+                    if copied < length:
+                        copied += _user_copy(src_fd, dst_fd, offset + copied,
+                                             length - copied)
+                    moved += copied
+
+                # the holes at the end
+                os.ftruncate(dst_fd, size)
+                if _copy_file_range is not None and use_kernel:
+                    method = "copy_file_range"
+                else:
+                    method = "sparse copy"
+                stats = CopyStats(size, moved, method)
+        finally:
+            os.close(dst_fd)
+    finally:
+        src_fobj.close()
+
+    shutil.copymode(src, dst)
+    msger.verbose("Copied %s to %s: %s" % (src, dst, stats))
+    return stats
+
+def move_file(src, dst):
+    """ Move 'src' to 'dst' like shutil.move(), but copying files across
+    file-systems with copy_file(). Returns a CopyStats instance for a
+    copied file, None if it was renamed. """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+
+    try:
+        os.rename(src, dst)
+        return None
+    except OSError, err:
+        if err.errno != errno.EXDEV:
+            raise
+
+    if not stat.S_ISREG(os.lstat(src).st_mode):
+        shutil.move(src, dst)
+        return None
+
+    stats = copy_file(src, dst)
+    shutil.copystat(src, dst)
+    os.unlink(src)
+    return stats
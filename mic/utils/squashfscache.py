@@ -0,0 +1,151 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2014 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc., 59
+# Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+""" This module implements a cache of squashfs images.
+
+The squashfs images of the live images are saved under 'cachedir/squashfs',
+named after a hash of the data they are made of: the paths, sizes and
+mapped extents of the files squashed (i.e. the ext3fs image of a live
+image, whose holes are skipped), and the compressor and block size. The
+same file-system image is then compressed once, e.g. when the livecd and
+the liveusb images of the same root file-system are built.
+
+The eviction of the unused images is the one of the rootfs cache. """
+
+import os
+import errno
+import hashlib
+
+from mic import msger
+from mic.utils import sparsecopy
+from mic.utils.misc import human_size
+from mic.utils.rootfscache import RootfsCache
+
+CACHE_NAME = "squashfs"
+# bump it whenever the content of the cached images changes
+CACHE_VERSION = "1"
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def _hash_file(hash_obj, path):
+    """ Update 'hash_obj' with the mapped extents of the file 'path' """
+    with open(path, "rb") as fobj:
+        size = os.fstat(fobj.fileno()).st_size
+        hash_obj.update("size=%d\n" % size)
+        for offset, length in sparsecopy.get_mapped_ranges(fobj, size):
+            hash_obj.update("extent=%d,%d\n" % (offset, length))
+            fobj.seek(offset)
+            while length > 0:
+                chunk = fobj.read(min(length, HASH_CHUNK_SIZE))
+                if not chunk:
+                    break
+                hash_obj.update(chunk)
+                length -= len(chunk)
+
+def _link_or_copy(src, dst):
+    """ Hard link 'src' to 'dst', or copy it if they are on different
+    file-systems """
+    try:
+        os.link(src, dst)
+    except OSError, err:
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        sparsecopy.copy_file(src, dst)
+
+class SquashfsCache(RootfsCache):
+    """ Cache of the squashfs images of a cache directory """
+
+    cache_name = CACHE_NAME
+    snapshot_desc = "squashfs image"
+
+    def available(self):
+        return True
+
+    def get_key(self, path, options=None):
+        """ Hash the files under 'path', the extents of their data only,
+        and the 'options' of mksquashfs changing its output, into the key
+        of a squashfs image """
+        options = options or {}
+        hash_obj = hashlib.sha256()
+        hash_obj.update("version=%s\n" % CACHE_VERSION)
+        for name in ("compressor", "block_size"):
+            hash_obj.update("%s=%s\n" % (name, options.get(name) or ""))
+
+        if not os.path.isdir(path):
+            _hash_file(hash_obj, path)
+            return hash_obj.hexdigest()
+
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                filepath = os.path.join(root, name)
+                hash_obj.update("file=%s\n" % os.path.relpath(filepath, path))
+                if not os.path.islink(filepath):
+                    _hash_file(hash_obj, filepath)
+        return hash_obj.hexdigest()
+
+    def _find(self, key):
+        path = os.path.join(self.snapdir, key + ".img")
+        if os.path.exists(path):
+            return path
+        return None
+
+    def restore(self, key, dst):
+        """ Put the cached squashfs image 'key' at 'dst'. Returns True if
+        it was found. """
+        path = self._find(key)
+        if path is None:
+            return False
+
+        try:
+            # touch it first so that a concurrent prune doesn't evict it
+            os.utime(path, None)
+            _link_or_copy(path, dst)
+        except (OSError, IOError), err:
+            msger.warning("Failed to restore cached squashfs image %s: %s"
+                          % (path, err))
+            return False
+
+        msger.info("Reused cached squashfs image %s" % os.path.basename(path))
+        return True
+
+    def save(self, key, src):
+        """ Save the squashfs image 'src' as 'key'. Returns True if it was
+        saved. """
+        if not os.path.isdir(self.snapdir):
+            os.makedirs(self.snapdir)
+
+        path = os.path.join(self.snapdir, key + ".img")
+        tmppath = os.path.join(self.snapdir, ".%s.%d" % (key, os.getpid()))
+        try:
+            try:
+                _link_or_copy(src, tmppath)
+                # rename is atomic, so concurrent builds never see a
+                # partial one
+                os.rename(tmppath, path)
+            except (OSError, IOError), err:
+                msger.warning("Failed to save squashfs image to cache: %s"
+                              % err)
+                return False
+        finally:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+
+        msger.verbose("Saved squashfs image as %s (%s)"
+                      % (path, human_size(os.path.getsize(path))))
+        self.prune()
+        return True
@@ -18,6 +18,7 @@ Source0:    %{name}_%{version}.tar.gz
 
 Requires:   python >= 2.6
 Requires:   python-urlgrabber >= 3.9.0
+Requires:   python-pycurl
 %if 0%{?suse_version} || 0%{?tizen_version:1}
 Requires:   python-xml
 %endif
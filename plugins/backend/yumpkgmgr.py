@@ -26,7 +26,7 @@ import yum
 
 from mic import msger
 from mic.kickstart import ksparser
-from mic.utils import misc, rpmmisc
+from mic.utils import misc, rpmmisc, profiler
 from mic.utils.grabber import TextProgress
 from mic.utils.proxy import get_proxy_for
 from mic.utils.errors import CreatorError
@@ -135,6 +135,8 @@ class Yum(BackendPlugin, yum.YumBase):
         self.check_pkgs = []
 
         self.install_debuginfo = False
+        # the repo metadata prefetched by misc.get_metadata_from_repos
+        self.repo_metadata = None
 
     def doFileLogSetup(self, uid, logfile):
         # don't do the file log for the livecd as it can lead to open fds
@@ -297,6 +299,7 @@ class Yum(BackendPlugin, yum.YumBase):
         repo.gpgcheck = 1
         repo.enable()
         repo.setup(0)
+        self.__reuse_metadata(repo, name, url)
         self.repos.add(repo)
         if cost:
             repo.cost = cost
@@ -304,6 +307,21 @@ class Yum(BackendPlugin, yum.YumBase):
         msger.verbose('repo: %s was added' % name)
         return repo
 
+    def __reuse_metadata(self, repo, name, url):
+        """ Make 'repo' use the metadata of the repo prefetched by
+        misc.get_metadata_from_repos, which is stored in the cache of the
+        repo under the same names: yum keeps the cached files whose
+        checksum matches the repomd.xml, which isn't downloaded again """
+        prefetched = misc.find_repo_metadata(self.repo_metadata, name, url)
+        if not prefetched or \
+           os.path.realpath(prefetched["repomd"]) != \
+           os.path.realpath(os.path.join(repo.cachedir, "repomd.xml")):
+            return
+
+        repo.metadata_expire = -1
+        repo.setMetadataCookie()
+        msger.verbose("Reusing prefetched metadata of repo: %s" % name)
+
     def installLocal(self, pkg, po=None, updateonly=False):
         ts = rpmUtils.transaction.initReadOnlyTransaction()
         try:
@@ -334,7 +352,8 @@ class Yum(BackendPlugin, yum.YumBase):
         os.environ["HOME"] = "/"
         os.environ["LD_PRELOAD"] = ""
         try:
-            (res, resmsg) = self.buildTransaction()
+            with profiler.phase("resolve"):
+                (res, resmsg) = self.buildTransaction()
         except yum.Errors.RepoError, e:
             raise CreatorError("Unable to download from repo : %s" %(e,))
 
@@ -413,36 +432,38 @@ class Yum(BackendPlugin, yum.YumBase):
             for repo in repos:
                 repo.setCallback(TextProgress(total_count - cached_count))
 
-            self.downloadPkgs(dlpkgs)
+            with profiler.phase("download"):
+                self.downloadPkgs(dlpkgs)
             # FIXME: sigcheck?
 
-            self.initActionTs()
-            self.populateTs(keepold=0)
-
-            deps = self.ts.check()
-            if len(deps) != 0:
-                # This isn't fatal, Ubuntu has this issue but it is ok.
-                msger.debug(deps)
-                msger.warning("Dependency check failed!")
-
-            rc = self.ts.order()
-            if rc != 0:
-                raise CreatorError("ordering packages for installation failed")
-
-            # FIXME: callback should be refactored a little in yum
-            cb = rpmmisc.RPMInstallCallback(self.ts)
-            cb.tsInfo = self.tsInfo
-            cb.filelog = False
-
-            msger.warning('\nCaution, do NOT interrupt the installation, '
-                          'else mic cannot finish the cleanup.')
-
-            installlogfile = "%s/__catched_stderr.buf" % (self.instroot)
-            msger.enable_logstderr(installlogfile)
-            transactionResult = self.runTransaction(cb)
-            if transactionResult.return_code != 0 and self.strict_mode:
-                raise CreatorError("mic failes to install some packages")
-            self._cleanupRpmdbLocks(self.conf.installroot)
+            with profiler.phase("transaction"):
+                self.initActionTs()
+                self.populateTs(keepold=0)
+
+                deps = self.ts.check()
+                if len(deps) != 0:
+                    # This isn't fatal, Ubuntu has this issue but it is ok.
+                    msger.debug(deps)
+                    msger.warning("Dependency check failed!")
+
+                rc = self.ts.order()
+                if rc != 0:
+                    raise CreatorError("ordering packages for installation failed")
+
+                # FIXME: callback should be refactored a little in yum
+                cb = rpmmisc.RPMInstallCallback(self.ts)
+                cb.tsInfo = self.tsInfo
+                cb.filelog = False
+
+                msger.warning('\nCaution, do NOT interrupt the installation, '
+                              'else mic cannot finish the cleanup.')
+
+                installlogfile = "%s/__catched_stderr.buf" % (self.instroot)
+                msger.enable_logstderr(installlogfile)
+                transactionResult = self.runTransaction(cb)
+                if transactionResult.return_code != 0 and self.strict_mode:
+                    raise CreatorError("mic failes to install some packages")
+                self._cleanupRpmdbLocks(self.conf.installroot)
 
         except rpmUtils.RpmUtilsError, e:
             raise CreatorError("mic does NOT support delta rpm: %s" % e)
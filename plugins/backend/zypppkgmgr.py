@@ -17,6 +17,8 @@
 
 import os
 import shutil
+import filecmp
+import tempfile
 import urlparse
 import rpm
 
@@ -29,12 +31,22 @@ if not hasattr(zypp, 'PoolQuery') or \
 
 from mic import msger
 from mic.kickstart import ksparser
-from mic.utils import misc, rpmmisc, runner, fs_related
-from mic.utils.grabber import myurlgrab, TextProgress
+from mic.utils import misc, rpmmisc, runner, fs_related, pkgstore, profiler
+from mic.utils.grabber import multi_urlgrab, TextProgress
 from mic.utils.proxy import get_proxy_for
 from mic.utils.errors import CreatorError, RepoError, RpmError
+from mic.utils.lock import SimpleLockfile, LockfileError
 from mic.imager.baseimager import BaseImageCreator
 
+# the max time in seconds waiting for another mic updating and loading the
+# caches of its repos, long enough for the metadata of big repos; the lock
+# of a killed mic is broken right away
+REPO_LOCK_TIMEOUT = 1800
+
+def _escape_alias(name):
+    """ The name of the caches of the repo 'name', as zypp escapes it """
+    return name.replace("/", "_")
+
 class RepositoryStub:
     def __init__(self):
         self.name = None
@@ -80,6 +92,22 @@ class Zypp(BackendPlugin):
 
         self.has_prov_query = True
         self.install_debuginfo = False
+        self.download_threads = 1
+        # size cap of the package store in MiB, 0 for no cap
+        self.pkgcache_max_size = 0
+        self.__pkgstore = None
+        # a rootfscache.RootfsCache to reuse installed roots, if enabled
+        self.rootfs_cache = None
+        # the repo metadata prefetched by misc.get_metadata_from_repos
+        self.repo_metadata = None
+        # whether to rebuild the caches of the repos instead of reusing them
+        self.refresh_metadata = False
+        # the repo definitions of this process only, the caches of the repos
+        # are shared by the builds using the same cache directory
+        self.reposdir = None
+        # the lock of the caches of the repos, held from when the first one
+        # is brought up to date until they are loaded
+        self.__repos_lock = None
         # this can't be changed, it is used by zypp
         self.tmp_file_path = '/var/tmp'
 
@@ -91,16 +119,23 @@ class Zypp(BackendPlugin):
     def closeRpmDB(self):
         pass
 
-    def close(self):
+    def __close_transaction(self):
         if self.ts:
             self.ts.closeDB()
             self.ts = None
 
         if self.ts_pre:
             self.ts_pre.closeDB()
-            self.ts = None
+            self.ts_pre = None
 
+    def close(self):
+        self.__close_transaction()
         self.closeRpmDB()
+        self.__unlock_repos()
+
+        if self.reposdir:
+            shutil.rmtree(self.reposdir, ignore_errors = True)
+            self.reposdir = None
 
     def __del__(self):
         self.close()
@@ -443,7 +478,8 @@ class Zypp(BackendPlugin):
             else:
                 del os.environ['HOME']
 
-            self.__build_repo_cache(name)
+            self.__lock_repos()
+            self.__build_repo_cache(name, url)
 
         except RuntimeError, e:
             raise CreatorError(str(e))
@@ -463,7 +499,8 @@ class Zypp(BackendPlugin):
     def runInstall(self, checksize = 0):
         os.environ["HOME"] = "/"
         os.environ["LD_PRELOAD"] = ""
-        self.buildTransaction()
+        with profiler.phase("resolve"):
+            self.buildTransaction()
 
         todo = zypp.GetResolvablesToInsDel(self.Z.pool())
         installed_pkgs = todo._toInstall
@@ -521,12 +558,19 @@ class Zypp(BackendPlugin):
             else:
                 self.__pkgs_license[license] = [pkg_long_name]
 
+        rootfs_key = None
+        if self.rootfs_cache:
+            rootfs_key = self.getRootfsKey(dlpkgs)
+            if self.restoreRootfs(rootfs_key):
+                return
+
         total_count = len(dlpkgs)
         cached_count = 0
         download_total_size = sum(map(lambda x: int(x.downloadSize()), dlpkgs))
         localpkgs = self.localpkgs.keys()
 
         msger.info("Checking packages cached ...")
+        cached_pkgs = {}
         for po in dlpkgs:
             # Check if it is cached locally
             if po.name() in localpkgs:
@@ -541,11 +585,21 @@ class Zypp(BackendPlugin):
                 nocache = repo.nocache if repo else False
 
                 if os.path.exists(local):
-                    if nocache or self.checkPkg(local) !=0:
+                    if nocache:
                         os.unlink(local)
                     else:
-                        download_total_size -= int(po.downloadSize())
-                        cached_count += 1
+                        cached_pkgs[os.path.abspath(local)] = po
+                elif not nocache and self.linkStoredPkg(po, local):
+                    # verified against its checksum when it was stored
+                    download_total_size -= int(po.downloadSize())
+                    cached_count += 1
+
+        for local, ret in self.checkPkgs(cached_pkgs.keys()).iteritems():
+            if ret != 0:
+                os.unlink(local)
+            else:
+                download_total_size -= int(cached_pkgs[local].downloadSize())
+                cached_count += 1
         cache_avail_size = misc.get_filesystem_avail(self.cachedir)
         if cache_avail_size < download_total_size:
             raise CreatorError("No enough space used for downloading.")
@@ -567,17 +621,28 @@ class Zypp(BackendPlugin):
         try:
             if download_count > 0:
                 msger.info("Downloading packages ...")
-            self.downloadPkgs(dlpkgs, download_count)
+            with profiler.phase("download"):
+                self.downloadPkgs(dlpkgs, download_count)
         except CreatorError, e:
             raise CreatorError("Package download failed: %s" %(e,))
 
         try:
-            self.installPkgs(dlpkgs)
+            with profiler.phase("transaction"):
+                self.installPkgs(dlpkgs)
         except (RepoError, RpmError):
             raise
         except Exception, e:
             raise CreatorError("Package installation failed: %s" % (e,))
 
+        if rootfs_key:
+            self.rootfs_cache.save(rootfs_key, self.instroot)
+
+        # the packages aren't needed any more, keep the store in its cap
+        evicted, size = self.getPkgStore().prune()
+        if evicted:
+            msger.verbose("Evicted %d packages (%s) from package store"
+                          % (evicted, misc.human_size(size)))
+
     def getVcsInfo(self):
         if self.__pkgs_vcsinfo:
             return
@@ -638,10 +703,11 @@ class Zypp(BackendPlugin):
         if self.repo_manager:
             return
 
-        # Clean up repo metadata
-        shutil.rmtree(self.cachedir + "/etc", ignore_errors = True)
-        shutil.rmtree(self.cachedir + "/solv", ignore_errors = True)
-        shutil.rmtree(self.cachedir + "/raw", ignore_errors = True)
+        # the raw metadata and the solv files of the repos are kept across
+        # builds, and checked against the repos when they are added
+        fs_related.makedirs(self.cachedir + "/raw")
+        self.reposdir = tempfile.mkdtemp(prefix = "repos.d-",
+                                         dir = self.cachedir)
 
         zypp.KeyRing.setDefaultAccept( zypp.KeyRing.ACCEPT_UNSIGNED_FILE
                                      | zypp.KeyRing.ACCEPT_VERIFICATION_FAILED
@@ -653,7 +719,7 @@ class Zypp(BackendPlugin):
                 zypp.RepoManagerOptions(zypp.Pathname(self.instroot))
 
         self.repo_manager_options.knownReposPath = \
-                zypp.Pathname(self.cachedir + "/etc/zypp/repos.d")
+                zypp.Pathname(self.reposdir)
 
         self.repo_manager_options.repoCachePath = \
                 zypp.Pathname(self.cachedir)
@@ -669,12 +735,72 @@ class Zypp(BackendPlugin):
 
         self.repo_manager = zypp.RepoManager(self.repo_manager_options)
 
-    def __build_repo_cache(self, name):
+    def __lock_repos(self):
+        """ Lock the caches of the repos against the other mic processes
+        using the same cache directory. One lock covers all the repos, so
+        that builds listing the same repos in another order don't wait on
+        each other. """
+        if self.__repos_lock:
+            return
+
+        lock = SimpleLockfile(self.cachedir + "/raw/.lock")
+        try:
+            lock.wait_acquire(REPO_LOCK_TIMEOUT)
+        except LockfileError, err:
+            raise CreatorError("Failed to lock the repo caches: %s" % err)
+        self.__repos_lock = lock
+
+    def __unlock_repos(self):
+        if self.__repos_lock:
+            self.__repos_lock.release()
+            self.__repos_lock = None
+
+    def __seed_repo_cache(self, name, url):
+        """ Lay out the metadata of the repo 'name' prefetched and verified
+        by misc.get_metadata_from_repos in its raw cache, from which zypp
+        builds its cache without downloading it again. The raw cache is
+        kept if it has the same repomd.xml. Returns False if there is no
+        prefetched metadata of the repo. """
+        repo = misc.find_repo_metadata(self.repo_metadata, name, url)
+        if not repo:
+            return False
+
+        rawdir = os.path.join(self.cachedir, "raw", _escape_alias(name))
+        cached = os.path.join(rawdir, "repodata", "repomd.xml")
+        if os.path.exists(cached) and \
+           filecmp.cmp(cached, repo["repomd"], shallow = False):
+            msger.verbose("Metadata of repo %s is up to date" % name)
+            return True
+
+        if misc.link_repo_metadata(repo, rawdir):
+            msger.verbose("Reusing prefetched metadata of repo: %s" % name)
+            return True
+
+        return False
+
+    def __build_repo_cache(self, name, url):
+        """ Bring the raw metadata and the solv file of the repo 'name' up
+        to date with the repo, they are only rebuilt if its repomd.xml
+        changed, or if refresh_metadata is set """
         repo = self.repo_manager.getRepositoryInfo(name)
-        if self.repo_manager.isCached(repo) or not repo.enabled():
+        if not repo.enabled():
             return
 
-        msger.info('Refreshing repository: %s ...' % name)
+        alias = _escape_alias(name)
+        if self.refresh_metadata:
+            shutil.rmtree(os.path.join(self.cachedir, "raw", alias),
+                          ignore_errors = True)
+            shutil.rmtree(os.path.join(self.cachedir, "solv", alias),
+                          ignore_errors = True)
+
+        if not self.__seed_repo_cache(name, url):
+            msger.info('Refreshing repository: %s ...' % name)
+            self.repo_manager.refreshMetadata(repo,
+                                              zypp.RepoManager.RefreshIfNeeded)
+
+        # zypp checks the cookie of the solv file against the raw metadata
+        if not self.repo_manager.isCached(repo):
+            msger.info('Building cache of repository: %s ...' % name)
         self.repo_manager.buildCache(repo, zypp.RepoManager.BuildIfNeeded)
 
     def __initialize_zypp(self):
@@ -692,10 +818,14 @@ class Zypp(BackendPlugin):
         # repoPackagesCachePath is corrected by this
         self.repo_manager = zypp.RepoManager(self.repo_manager_options)
         repos = self.repo_manager.knownRepositories()
-        for repo in repos:
-            if not repo.enabled():
-                continue
-            self.repo_manager.loadFromCache(repo)
+        try:
+            for repo in repos:
+                if not repo.enabled():
+                    continue
+                self.repo_manager.loadFromCache(repo)
+        finally:
+            # the pool doesn't read the caches anymore
+            self.__unlock_repos()
 
         self.Z = zypp.ZYppFactory_instance().getZYpp()
         self.Z.initializeTarget(zypp.Pathname(self.instroot))
@@ -713,6 +843,59 @@ class Zypp(BackendPlugin):
             raise RepoError("found %d resolver problem, abort!" \
                             % len(probs))
 
+    def getPkgStore(self):
+        if self.__pkgstore is None:
+            self.__pkgstore = pkgstore.PackageStore(self.cachedir,
+                                    self.pkgcache_max_size * 1024 * 1024)
+        return self.__pkgstore
+
+    def linkStoredPkg(self, po, filename):
+        """ Link the package 'po' to 'filename' from the package store,
+        returns True if it was stored """
+        checksum = po.location().checksum()
+        if checksum.empty():
+            return False
+        return self.getPkgStore().link(checksum.type(), checksum.checksum(),
+                                       filename)
+
+    def storePkg(self, po, filename):
+        """ Add the downloaded package 'po' at 'filename' to the store """
+        checksum = po.location().checksum()
+        if checksum.empty():
+            return False
+        return self.getPkgStore().add(checksum.type(), checksum.checksum(),
+                                      filename)
+
+    def getRootfsKey(self, package_objects):
+        """ The key of the install root of 'package_objects' in the rootfs
+        cache, from their NEVRA and checksum """
+        pkgids = []
+        for po in package_objects:
+            nevra = "%s-%s.%s" % (po.name(), po.edition(), po.arch())
+            if po.name() in self.localpkgs:
+                pkgids.append("%s md5:%s" % (nevra, misc.get_md5sum(
+                                  self.localpkgs[po.name()])))
+                continue
+
+            checksum = po.location().checksum()
+            if checksum.empty():
+                pkgids.append(nevra)
+            else:
+                pkgids.append("%s %s:%s" % (nevra, checksum.type(),
+                                            checksum.checksum()))
+        return self.rootfs_cache.get_key(pkgids)
+
+    def restoreRootfs(self, key):
+        """ Restore the install root 'key' from the rootfs cache instead of
+        installing the packages, returns True if it was cached """
+        if self.rootfs_cache._find(key) is None:
+            return False
+
+        # the rpmdb is replaced, reopen it when it is used again
+        self.__close_transaction()
+        with profiler.phase("restore"):
+            return self.rootfs_cache.restore(key, self.instroot)
+
     def getLocalPkgPath(self, po):
         repoinfo = po.repoInfo()
         cacheroot = repoinfo.packagesPath()
@@ -762,6 +945,8 @@ class Zypp(BackendPlugin):
         localpkgs = self.localpkgs.keys()
         progress_obj = TextProgress(count)
 
+        jobs = []
+        downloads = []
         for po in package_objects:
             if po.name() in localpkgs:
                 continue
@@ -777,12 +962,25 @@ class Zypp(BackendPlugin):
 
             url = self.get_url(po)
             proxies = self.get_proxies(po)
+            if url.full.startswith("file:/"):
+                jobs.append((url.full, filename, proxies))
+                continue
 
-            try:
-                filename = myurlgrab(url.full, filename, proxies, progress_obj)
-            except CreatorError:
-                self.close()
-                raise
+            # download to a temporary name, renamed when it's complete, so
+            # concurrent builds never see partial packages
+            tmpname = pkgstore.get_tmpname(filename)
+            jobs.append((url.full, tmpname, proxies))
+            downloads.append((po, tmpname, filename))
+
+        try:
+            multi_urlgrab(jobs, self.download_threads, progress_obj)
+        except CreatorError:
+            self.close()
+            raise
+
+        for po, tmpname, filename in downloads:
+            os.rename(tmpname, filename)
+            self.storePkg(po, filename)
 
     def preinstallPkgs(self):
         if not self.ts_pre:
@@ -920,12 +1118,21 @@ class Zypp(BackendPlugin):
         ret = 1
         if not os.path.exists(pkg):
             return ret
-        ret = rpmmisc.checkRpmIntegrity('rpm', pkg)
-        if ret != 0:
-            msger.warning("package %s is damaged: %s" \
-                          % (os.path.basename(pkg), pkg))
 
-        return ret
+        return self.checkPkgs([pkg]).values()[0]
+
+    def checkPkgs(self, pkgs):
+        """ Check the integrity of existing packages 'pkgs' concurrently,
+        returns a dict mapping each absolute package path to 0 if it's fine
+        """
+        ledger = rpmmisc.getVerifyLedger(self.cachedir)
+        results = rpmmisc.checkRpmsIntegrity('rpm', pkgs, ledger)
+        for pkg, ret in results.iteritems():
+            if ret != 0:
+                msger.warning("package %s is damaged: %s" \
+                              % (os.path.basename(pkg), pkg))
+
+        return results
 
     def _add_prob_flags(self, *flags):
         for flag in flags:
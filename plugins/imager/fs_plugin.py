@@ -16,7 +16,7 @@
 # Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
 from mic import chroot, msger, rt_util
-from mic.utils import cmdln, misc, errors, fs_related
+from mic.utils import cmdln, misc, errors, fs_related, profiler
 from mic.imager import fs
 from mic.conf import configmgr
 from mic.plugin import pluginmgr
@@ -105,8 +105,10 @@ class FsPlugin(ImagerPlugin):
 
         try:
             creator.check_depend_tools()
-            creator.mount(None, creatoropts["cachedir"])
-            creator.install()
+            with profiler.phase("mount"):
+                creator.mount(None, creatoropts["cachedir"])
+            with profiler.phase("install"):
+                creator.install()
             #Download the source packages ###private options
             if opts.include_src:
                 installed_pkgs =  creator.get_installed_packages()
@@ -116,14 +118,21 @@ class FsPlugin(ImagerPlugin):
                         creator._instroot, creatoropts["cachedir"]):
                     msger.warning("Source packages can't be downloaded")
 
-            creator.configure(creatoropts["repomd"])
-            creator.copy_kernel()
-            creator.unmount()
-            creator.package(creatoropts["destdir"])
-            creator.create_manifest()
+            with profiler.phase("configure"):
+                creator.configure(creatoropts["repomd"])
+            with profiler.phase("copy_kernel"):
+                creator.copy_kernel()
+            with profiler.phase("unmount"):
+                creator.unmount()
+            with profiler.phase("package"):
+                creator.package(creatoropts["destdir"])
+            with profiler.phase("create_manifest"):
+                creator.create_manifest()
             if creatoropts['release'] is not None:
-                creator.release_output(ksconf, creatoropts['destdir'],
-                        creatoropts['release'])
+                with profiler.phase("release_output"):
+                    creator.release_output(ksconf, creatoropts['destdir'],
+                            creatoropts['release'])
+            creator.save_profile()
             creator.print_outimage_info()
         except errors.CreatorError:
             raise
@@ -20,7 +20,7 @@ import shutil
 import tempfile
 
 from mic import chroot, msger, rt_util
-from mic.utils import misc, fs_related, errors
+from mic.utils import misc, fs_related, errors, sparsecopy, profiler
 from mic.conf import configmgr
 import mic.imager.livecd as livecd
 from mic.plugin import pluginmgr
@@ -107,15 +107,24 @@ class LiveCDPlugin(ImagerPlugin):
 
         try:
             creator.check_depend_tools()
-            creator.mount(None, creatoropts["cachedir"])
-            creator.install()
-            creator.configure(creatoropts["repomd"])
-            creator.copy_kernel()
-            creator.unmount()
-            creator.package(creatoropts["destdir"])
-            creator.create_manifest()
+            with profiler.phase("mount"):
+                creator.mount(None, creatoropts["cachedir"])
+            with profiler.phase("install"):
+                creator.install()
+            with profiler.phase("configure"):
+                creator.configure(creatoropts["repomd"])
+            with profiler.phase("copy_kernel"):
+                creator.copy_kernel()
+            with profiler.phase("unmount"):
+                creator.unmount()
+            with profiler.phase("package"):
+                creator.package(creatoropts["destdir"])
+            with profiler.phase("create_manifest"):
+                creator.create_manifest()
             if creatoropts['release'] is not None:
-                creator.release_output(ksconf, creatoropts['destdir'], creatoropts['release'])
+                with profiler.phase("release_output"):
+                    creator.release_output(ksconf, creatoropts['destdir'], creatoropts['release'])
+            creator.save_profile()
             creator.print_outimage_info()
 
         except errors.CreatorError:
@@ -252,7 +261,7 @@ class LiveCDPlugin(ImagerPlugin):
             imgname = os.path.basename(srcimg)
             imgname = os.path.splitext(imgname)[0] + ".img"
             rtimage = os.path.join(tempfile.mkdtemp(dir = "/var/tmp", prefix = "tmp"), imgname)
-            shutil.copyfile(os_image, rtimage)
+            sparsecopy.copy_file(os_image, rtimage)
 
         finally:
             imgloop.cleanup()
@@ -19,8 +19,9 @@ import os
 import shutil
 import tempfile
 
-from mic import chroot, msger, rt_util
-from mic.utils import misc, fs_related, errors, cmdln
+from mic import chroot, msger, rt_util, archive
+from mic.utils import misc, fs_related, errors, cmdln, sparsecopy
+from mic.utils import profiler
 from mic.conf import configmgr
 from mic.plugin import pluginmgr
 from mic.imager.loop import LoopImageCreator, load_mountpoints
@@ -31,16 +32,21 @@ class LoopPlugin(ImagerPlugin):
 
     @classmethod
     @cmdln.option("--compress-disk-image", dest="compress_image",
-                  type='choice', choices=("gz", "bz2", "lzo"), default=None,
+                  type='choice', choices=("gz", "bz2", "lzo", "xz", "zst"), default=None,
                   help="Same with --compress-image")
                   # alias to compress-image for compatibility
     @cmdln.option("--compress-image", dest="compress_image",
-                  type='choice', choices=("gz", "bz2", "lzo"), default=None,
-                  help="Compress all loop images with 'gz' or 'bz2' or 'lzo',"
+                  type='choice', choices=("gz", "bz2", "lzo", "xz", "zst"), default=None,
+                  help="Compress all loop images with 'gz', 'bz2', 'lzo', "
+                  "'xz' or 'zst',"
                   "Note: if you want to use 'lzo', package 'lzop' is needed to"
                   "be installed manually.")
     @cmdln.option("--shrink", action='store_true', default=False,
                   help="Whether to shrink loop images to minimal size")
+    @cmdln.option("--build-from-dir", dest="build_from_dir",
+                  action='store_true', default=False,
+                  help="Install into a plain directory and create the file "
+                  "systems from it, without loop devices")
     def do_create(self, subcmd, opts, *args):
         """${cmd_name}: create loop image
 
@@ -53,6 +59,13 @@ class LoopPlugin(ImagerPlugin):
         if len(args) != 1:
             raise errors.Usage("Extra arguments given")
 
+        if opts.compress_image:
+            try:
+                archive.check_compress_level(opts.compress_image,
+                                             configmgr.create['compress_level'])
+            except ValueError, err:
+                raise errors.Usage(str(err))
+
         creatoropts = configmgr.create
         ksconf = args[0]
 
@@ -105,7 +118,8 @@ class LoopPlugin(ImagerPlugin):
         creator = LoopImageCreator(creatoropts,
                                    pkgmgr,
                                    opts.compress_image,
-                                   opts.shrink)
+                                   opts.shrink,
+                                   opts.build_from_dir)
 
         if len(recording_pkgs) > 0:
             creator._recording_pkgs = recording_pkgs
@@ -119,18 +133,27 @@ class LoopPlugin(ImagerPlugin):
 
         try:
             creator.check_depend_tools()
-            creator.mount(None, creatoropts["cachedir"])
-            creator.install()
-            creator.configure(creatoropts["repomd"])
-            creator.copy_kernel()
-            creator.unmount()
-            creator.package(creatoropts["destdir"])
-            creator.create_manifest()
+            with profiler.phase("mount"):
+                creator.mount(None, creatoropts["cachedir"])
+            with profiler.phase("install"):
+                creator.install()
+            with profiler.phase("configure"):
+                creator.configure(creatoropts["repomd"])
+            with profiler.phase("copy_kernel"):
+                creator.copy_kernel()
+            with profiler.phase("unmount"):
+                creator.unmount()
+            with profiler.phase("package"):
+                creator.package(creatoropts["destdir"])
+            with profiler.phase("create_manifest"):
+                creator.create_manifest()
 
             if creatoropts['release'] is not None:
-                creator.release_output(ksconf,
-                                       creatoropts['destdir'],
-                                       creatoropts['release'])
+                with profiler.phase("release_output"):
+                    creator.release_output(ksconf,
+                                           creatoropts['destdir'],
+                                           creatoropts['release'])
+            creator.save_profile()
             creator.print_outimage_info()
 
         except errors.CreatorError:
@@ -258,5 +281,5 @@ class LoopPlugin(ImagerPlugin):
         image = os.path.join(tempfile.mkdtemp(dir="/var/tmp", prefix="tmp"),
                              "target.img")
         msger.info("Copying file system ...")
-        shutil.copyfile(srcimg, image)
+        sparsecopy.copy_file(srcimg, image)
         return image
@@ -0,0 +1,294 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2014 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc., 59
+# Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from mic import msger, rt_util, archive
+from mic.utils import fs_related, errors, cmdln, profiler
+from mic.conf import configmgr
+from mic.plugin import pluginmgr
+from mic.imager.fs import FsImageCreator
+from mic.imager.loop import LoopImageCreator
+from mic.imager.qcow import QcowImageCreator
+from mic.imager.raw import RawImageCreator
+from mic.imager.livecd import LiveCDImageCreator
+from mic.imager.liveusb import LiveUSBImageCreator
+
+from mic.pluginbase import ImagerPlugin
+
+# the formats whose install root is prepared before installing the packages,
+# e.g. the initrd of the live images is built by the kernel package with a
+# dracut configuration written by the live image creator
+LIVE_FORMATS = ("livecd", "liveusb")
+
+# the timeout of waiting for a job, which keeps the wait interruptible
+JOB_TIMEOUT = 1 << 31
+
+def _new_creator(fmt, creatoropts, pkgmgr, opts):
+    if fmt == "fs":
+        return FsImageCreator(creatoropts, pkgmgr)
+    elif fmt == "loop":
+        return LoopImageCreator(creatoropts, pkgmgr, opts.compress_image,
+                                opts.shrink, opts.build_from_dir)
+    elif fmt == "qcow":
+        return QcowImageCreator(creatoropts, pkgmgr)
+    elif fmt == "raw":
+        return RawImageCreator(creatoropts, pkgmgr, opts.compress_image,
+                               opts.generate_bmap, opts.fstab_entry,
+                               opts.build_from_dir)
+    elif fmt == "livecd":
+        return LiveCDImageCreator(creatoropts, pkgmgr)
+    elif fmt == "liveusb":
+        return LiveUSBImageCreator(creatoropts, pkgmgr)
+
+def _get_image_names(fmt, creator):
+    if fmt in ("loop", "qcow"):
+        return [creator.name + ".img"] + creator.get_image_names()
+    elif fmt == "raw":
+        return ["%s-%s.raw" % (creator.name, disk_name)
+                for disk_name in creator.get_disk_names()]
+    elif fmt == "livecd":
+        return [creator.name + ".iso"]
+    elif fmt == "liveusb":
+        return [creator.name + ".usbimg"]
+    return [creator.name]
+
+def _package(fmt, creator, destdir):
+    """ Pack the image of a populated creator, run in a job """
+    with profiler.phase(fmt):
+        with profiler.phase("unmount"):
+            creator.unmount()
+        if fmt == "raw":
+            with profiler.phase("generate_bmap"):
+                creator.generate_bmap()
+        with profiler.phase("package"):
+            creator.package(destdir)
+        with profiler.phase("create_manifest"):
+            creator.create_manifest()
+
+class MultiPlugin(ImagerPlugin):
+    name = 'multi'
+
+    formats = ("fs", "loop", "qcow", "raw", "livecd", "liveusb")
+
+    @classmethod
+    @cmdln.option("--formats", dest="formats", type="string", default=None,
+                  help="Comma separated list of the image formats to create, "
+                  "among 'fs', 'loop', 'qcow', 'raw', 'livecd' and 'liveusb'")
+    @cmdln.option("--jobs", dest="jobs", type="int", default=None,
+                  help="Max number of images packed concurrently, default is "
+                  "the number of formats or of CPUs if lower")
+    @cmdln.option("--compress-image", dest="compress_image", type='choice',
+                  choices=("gz", "bz2", "lzo", "xz", "zst"), default=None,
+                  help="Compress all loop and raw images before package")
+    @cmdln.option("--shrink", action='store_true', default=False,
+                  help="Whether to shrink loop images to minimal size")
+    @cmdln.option("--generate-bmap", action="store_true", default=None,
+                  help="also generate the block map file of raw images")
+    @cmdln.option("--fstab-entry", dest="fstab_entry", type='choice',
+                  choices=("name", "uuid"), default="uuid",
+                  help="Set fstab entry of raw images, 'name' means using "
+                  "device names, 'uuid' means using filesystem uuid")
+    @cmdln.option("--build-from-dir", dest="build_from_dir",
+                  action='store_true', default=False,
+                  help="Install loop and raw images into plain directories "
+                  "and create their file systems from them, without loop "
+                  "devices")
+    def do_create(self, subcmd, opts, *args):
+        """${cmd_name}: create images of several formats from one install
+
+        The packages are installed and the kickstart configuration and %post
+        scripts are applied once, then the install root is copied into each
+        image, which is packed to a sub-directory of the output directory
+        named after its format. A live format, if any, is installed first.
+
+        Usage:
+            ${name} ${cmd_name} <ksfile> --formats <fmt,...> [OPTS]
+
+        ${cmd_option_list}
+        """
+
+        if len(args) != 1:
+            raise errors.Usage("Extra arguments given")
+
+        if not opts.formats:
+            raise errors.Usage("No image format given, use --formats")
+
+        formats = [fmt.strip() for fmt in opts.formats.split(",")
+                   if fmt.strip()]
+        for fmt in formats:
+            if fmt not in self.formats:
+                raise errors.Usage("Unsupported image format: %s, available "
+                                   "choices: %s" % (fmt, ",".join(self.formats)))
+        if len(set(formats)) != len(formats):
+            raise errors.Usage("Duplicated image format in: %s" % opts.formats)
+
+        if opts.jobs is not None and opts.jobs < 1:
+            raise errors.Usage("Invalid number of jobs: %d" % opts.jobs)
+
+        if opts.compress_image:
+            try:
+                archive.check_compress_level(opts.compress_image,
+                                             configmgr.create['compress_level'])
+            except ValueError, err:
+                raise errors.Usage(str(err))
+
+        creatoropts = configmgr.create
+        ksconf = args[0]
+
+        if creatoropts['runtime'] == "bootstrap":
+            configmgr._ksconf = ksconf
+            rt_util.bootstrap_mic()
+        elif not rt_util.inbootstrap():
+            try:
+                fs_related.find_binary_path('mic-native')
+            except errors.CreatorError:
+                if not msger.ask("Subpackage \"mic-native\" has not been "
+                                 "installed in your host system, still "
+                                 "continue with \"native\" running mode?",
+                                 False):
+                    raise errors.Abort("Abort because subpackage 'mic-native' "
+                                       "has not been installed")
+
+        recording_pkgs = []
+        if len(creatoropts['record_pkgs']) > 0:
+            recording_pkgs = creatoropts['record_pkgs']
+
+        if creatoropts['release'] is not None:
+            if 'name' not in recording_pkgs:
+                recording_pkgs.append('name')
+            if 'vcs' not in recording_pkgs:
+                recording_pkgs.append('vcs')
+
+        configmgr._ksconf = ksconf
+
+        # try to find the pkgmgr
+        pkgmgr = None
+        backends = pluginmgr.get_plugins('backend')
+        if 'auto' == creatoropts['pkgmgr']:
+            for key in configmgr.prefer_backends:
+                if key in backends:
+                    pkgmgr = backends[key]
+                    break
+        else:
+            for key in backends.keys():
+                if key == creatoropts['pkgmgr']:
+                    pkgmgr = backends[key]
+                    break
+
+        if not pkgmgr:
+            raise errors.CreatorError("Can't find backend: %s, "
+                                      "available choices: %s" %
+                                      (creatoropts['pkgmgr'],
+                                       ','.join(backends.keys())))
+
+        # the image the packages are installed into
+        master = formats[0]
+        for fmt in formats:
+            if fmt in LIVE_FORMATS:
+                master = fmt
+                break
+
+        creators = []
+        for fmt in formats:
+            fmtopts = dict(creatoropts)
+            fmtopts['destdir'] = os.path.join(creatoropts['destdir'], fmt)
+            creator = _new_creator(fmt, fmtopts, pkgmgr, opts)
+            if len(recording_pkgs) > 0:
+                creator._recording_pkgs = recording_pkgs
+            # the log file is moved to the release of the last image
+            creator.releaselog = False
+            creators.append((fmt, creator))
+
+            self.check_image_exists(creator.destdir,
+                                    creator.pack_to,
+                                    _get_image_names(fmt, creator),
+                                    creatoropts['release'])
+
+        creators[-1][1].releaselog = creatoropts.get('releaselog', False)
+        source = dict(creators)[master]
+
+        jobs = opts.jobs or min(len(creators), multiprocessing.cpu_count())
+        msger.info("Creating %s images from one install, %d jobs"
+                   % (",".join(formats), jobs))
+
+        pool = None
+        try:
+            for fmt, creator in creators:
+                creator.check_depend_tools()
+
+            with profiler.phase("mount"):
+                source.mount(None, creatoropts["cachedir"])
+            with profiler.phase("install"):
+                source.install()
+            with profiler.phase("configure"):
+                source.configure(creatoropts["repomd"])
+            with profiler.phase("copy_kernel"):
+                source.copy_kernel()
+
+            # the loop devices are set up and the trees are copied one
+            # image at a time, as they compete for the same disks
+            for fmt, creator in creators:
+                if creator is source:
+                    continue
+                msger.info("Populating %s image ..." % fmt)
+                with profiler.phase(fmt):
+                    with profiler.phase("mount"):
+                        creator.mount(None, creatoropts["cachedir"])
+                    with profiler.phase("populate"):
+                        creator.populate(source)
+                    with profiler.phase("copy_kernel"):
+                        creator.copy_kernel()
+
+            pool = ThreadPool(jobs)
+            results = [pool.apply_async(_package,
+                                        (fmt, creator, creator.destdir))
+                       for fmt, creator in creators]
+            pool.close()
+            for result in results:
+                result.get(JOB_TIMEOUT)
+
+            if creatoropts['release'] is not None:
+                with profiler.phase("release_output"):
+                    for fmt, creator in creators:
+                        creator.release_output(ksconf, creator.destdir,
+                                               creatoropts['release'])
+            for fmt, creator in creators:
+                creator.save_profile()
+                creator.print_outimage_info()
+
+        except errors.CreatorError:
+            raise
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            for fmt, creator in reversed(creators):
+                creator.cleanup()
+
+        msger.info("Finished.")
+        return 0
+
+    @classmethod
+    def do_chroot(cls, target, cmd=[]):
+        pass
+
+    @classmethod
+    def do_unpack(cls, srcimg):
+        pass
@@ -14,51 +14,12 @@
 # with this program; if not, write to the Free Software Foundation, Inc., 59
 # Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
-import os
-import shutil
-
 from mic import msger, rt_util
 from mic.conf import configmgr
 from mic.plugin import pluginmgr
 from mic.pluginbase import ImagerPlugin
-from mic.imager.loop import LoopImageCreator
-from mic.utils import errors, fs_related, runner
-
-class QcowImageCreator(LoopImageCreator):
-    img_format = 'qcow'
-
-    def __init__(self, creatoropts=None, pkgmgr=None):
-        LoopImageCreator.__init__(self, creatoropts, pkgmgr) 
-        self.cmd_qemuimg = 'qemu-img'
-
-    def _stage_final_image(self):
-        try:
-            self.cmd_qemuimg = fs_related.find_binary_path('qemu-img')
-        except errors.CreatorError:
-            return LoopImageCreator._stage_final_image(self)
-
-        self._resparse()
-
-        imgfile = None
-        for item in self._instloops:
-            if item['mountpoint'] == '/':
-                if item['fstype'] == "ext4":
-                    runner.show('/sbin/tune2fs -O ^huge_file,extents,uninit_bg %s'
-                                % imgfile)
-                self.image_files.setdefault('partitions', {}).update(
-                         {item['mountpoint']: item['label']})
-                imgfile = os.path.join(self._imgdir, item['name'])
-
-        if imgfile:
-            qemuimage = imgfile + ".x86"
-            runner.show("%s convert -O qcow2 %s %s"
-                        % (self.cmd_qemuimg, imgfile, qemuimage))
-            os.unlink(imgfile)
-            os.rename(qemuimage, imgfile)
-
-        for item in os.listdir(self._imgdir):
-            shutil.move(os.path.join(self._imgdir, item),
-                        os.path.join(self._outdir, item))
+from mic.imager.qcow import QcowImageCreator
+from mic.utils import errors, fs_related, profiler
 
 class QcowPlugin(ImagerPlugin):
     name = 'qcow'
@@ -139,18 +100,27 @@ class QcowPlugin(ImagerPlugin):
 
         try:
             creator.check_depend_tools()
-            creator.mount(None, creatoropts["cachedir"])
-            creator.install()
-            creator.configure(creatoropts["repomd"])
-            creator.copy_kernel()
-            creator.unmount()
-            creator.package(creatoropts["destdir"])
-            creator.create_manifest()
+            with profiler.phase("mount"):
+                creator.mount(None, creatoropts["cachedir"])
+            with profiler.phase("install"):
+                creator.install()
+            with profiler.phase("configure"):
+                creator.configure(creatoropts["repomd"])
+            with profiler.phase("copy_kernel"):
+                creator.copy_kernel()
+            with profiler.phase("unmount"):
+                creator.unmount()
+            with profiler.phase("package"):
+                creator.package(creatoropts["destdir"])
+            with profiler.phase("create_manifest"):
+                creator.create_manifest()
 
             if creatoropts['release'] is not None:
-                creator.release_output(ksconf,
-                                       creatoropts['destdir'],
-                                       creatoropts['release'])
+                with profiler.phase("release_output"):
+                    creator.release_output(ksconf,
+                                           creatoropts['destdir'],
+                                           creatoropts['release'])
+            creator.save_profile()
             creator.print_outimage_info()
 
         except errors.CreatorError:
@@ -20,8 +20,8 @@ import shutil
 import re
 import tempfile
 
-from mic import chroot, msger, rt_util
-from mic.utils import misc, fs_related, errors, runner, cmdln
+from mic import chroot, msger, rt_util, archive
+from mic.utils import misc, fs_related, errors, runner, cmdln, profiler
 from mic.conf import configmgr
 from mic.plugin import pluginmgr
 from mic.utils.partitionedfs import PartitionedMount
@@ -34,10 +34,10 @@ class RawPlugin(ImagerPlugin):
 
     @classmethod
     @cmdln.option("--compress-disk-image", dest = "compress_image", type = 'choice',
-                  choices = ("gz", "bz2", "lzo"), default = None,
+                  choices = ("gz", "bz2", "lzo", "xz", "zst"), default = None,
                   help = "Same with --compress-image")
     @cmdln.option("--compress-image", dest = "compress_image", type = 'choice',
-                  choices = ("gz", "bz2", "lzo"), default = None,
+                  choices = ("gz", "bz2", "lzo", "xz", "zst"), default = None,
                   help = "Compress all raw images before package, Note: if you want "
                   "to use 'lzo', package 'lzop' is needed to be installed manually.")
     @cmdln.option("--generate-bmap", action = "store_true", default = None,
@@ -46,6 +46,10 @@ class RawPlugin(ImagerPlugin):
                   choices = ("name", "uuid"), default = "uuid",
                   help = "Set fstab entry, 'name' means using device names, "
                        "'uuid' means using filesystem uuid")
+    @cmdln.option("--build-from-dir", dest = "build_from_dir",
+                  action = "store_true", default = False,
+                  help = "Install into a plain directory and create the "
+                  "file systems from it, without loop devices")
     def do_create(self, subcmd, opts, *args):
         """${cmd_name}: create raw image
 
@@ -58,6 +62,13 @@ class RawPlugin(ImagerPlugin):
         if len(args) != 1:
             raise errors.Usage("Extra arguments given")
 
+        if opts.compress_image:
+            try:
+                archive.check_compress_level(opts.compress_image,
+                                             configmgr.create['compress_level'])
+            except ValueError, err:
+                raise errors.Usage(str(err))
+
         creatoropts = configmgr.create
         ksconf = args[0]
 
@@ -108,7 +119,8 @@ class RawPlugin(ImagerPlugin):
                                        ','.join(backends.keys())))
 
         creator = raw.RawImageCreator(creatoropts, pkgmgr, opts.compress_image,
-                                      opts.generate_bmap, opts.fstab_entry)
+                                      opts.generate_bmap, opts.fstab_entry,
+                                      opts.build_from_dir)
 
         if len(recording_pkgs) > 0:
             creator._recording_pkgs = recording_pkgs
@@ -122,16 +134,26 @@ class RawPlugin(ImagerPlugin):
 
         try:
             creator.check_depend_tools()
-            creator.mount(None, creatoropts["cachedir"])
-            creator.install()
-            creator.configure(creatoropts["repomd"])
-            creator.copy_kernel()
-            creator.unmount()
-            creator.generate_bmap()
-            creator.package(creatoropts["destdir"])
-            creator.create_manifest()
+            with profiler.phase("mount"):
+                creator.mount(None, creatoropts["cachedir"])
+            with profiler.phase("install"):
+                creator.install()
+            with profiler.phase("configure"):
+                creator.configure(creatoropts["repomd"])
+            with profiler.phase("copy_kernel"):
+                creator.copy_kernel()
+            with profiler.phase("unmount"):
+                creator.unmount()
+            with profiler.phase("generate_bmap"):
+                creator.generate_bmap()
+            with profiler.phase("package"):
+                creator.package(creatoropts["destdir"])
+            with profiler.phase("create_manifest"):
+                creator.create_manifest()
             if creatoropts['release'] is not None:
-                creator.release_output(ksconf, creatoropts['destdir'], creatoropts['release'])
+                with profiler.phase("release_output"):
+                    creator.release_output(ksconf, creatoropts['destdir'], creatoropts['release'])
+            creator.save_profile()
             creator.print_outimage_info()
 
         except errors.CreatorError:
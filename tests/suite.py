@@ -8,6 +8,14 @@ import test_baseimager
 import test_runner
 import test_chroot
 import test_proxy
+import test_gpt_parser
+import test_dirmount
+import test_squashfscache
+import test_lock
+import test_pkgstore
+import test_metadata
+import test_grabber
+import test_rpmmisc
 
 if os.getuid() != 0:
     raise SystemExit("Root permission is needed")
@@ -20,5 +28,13 @@ suite.addTests(test_baseimager.suite())
 suite.addTests(test_runner.suite())
 suite.addTests(test_chroot.suite())
 suite.addTests(test_proxy.suite())
+suite.addTests(test_gpt_parser.suite())
+suite.addTests(test_dirmount.suite())
+suite.addTests(test_squashfscache.suite())
+suite.addTests(test_lock.suite())
+suite.addTests(test_pkgstore.suite())
+suite.addTests(test_metadata.suite())
+suite.addTests(test_grabber.suite())
+suite.addTests(test_rpmmisc.suite())
 result = unittest.TextTestRunner(verbosity=2).run(suite)
 sys.exit(not result.wasSuccessful())
@@ -4,6 +4,7 @@ It is used to test mic/archive.py
 
 
 import os
+import time
 import shutil
 import unittest
 
@@ -57,7 +58,7 @@ class ArchiveTest(unittest.TestCase):
         """Test get compress format """
         compress_list = archive.get_compress_formats()
         compress_list.sort()
-        self.assertEqual(compress_list, ['bz2', 'gz', 'lzo'])
+        self.assertEqual(compress_list, ['bz2', 'gz', 'lzo', 'xz', 'zst'])
 
     def test_compress_negtive_file_path_is_required(self):
         """Test if the first parameter: file path is empty"""
@@ -117,6 +118,42 @@ class ArchiveTest(unittest.TestCase):
             self.assertTrue(os.path.exists(output_name))
             os.remove(output_name)
 
+    @unittest.skipUnless(archive.which("xz"), "xz is not installed")
+    def test_compress_xz(self):
+        """Test compress format: xz"""
+        for file_item in self.files:
+            output_name = archive.compress(file_item, 'xz', 6, 2)
+            self.assertEqual('%s.xz' % file_item, output_name)
+            self.assertTrue(os.path.exists(output_name))
+            os.remove(output_name)
+
+    @unittest.skipUnless(archive.which("zstd"), "zstd is not installed")
+    def test_compress_zst(self):
+        """Test compress format: zst"""
+        for file_item in self.files:
+            output_name = archive.compress(file_item, 'zst', 19, 0)
+            self.assertEqual('%s.zst' % file_item, output_name)
+            self.assertTrue(os.path.exists(output_name))
+            self.assertFalse(os.path.exists(file_item))
+            os.remove(output_name)
+
+    def test_compress_negtive_wrong_compress_level(self):
+        """Test compress level out of the range of the format"""
+        with self.assertRaises(ValueError):
+            archive.compress(self.relative_file, 'gz', 0)
+        with self.assertRaises(ValueError):
+            archive.compress(self.relative_file, 'zst', 23)
+
+    def test_check_compress_level(self):
+        """Test checking the compress level of the format of a file name"""
+        self.assertEqual('gz', archive.get_compress_format('a.tar.gz'))
+        self.assertEqual('bz2', archive.get_compress_format('a.tbz2'))
+        self.assertEqual(None, archive.get_compress_format('a.tar'))
+        archive.check_compress_level('zst', 22)
+        archive.check_compress_level('gz', None)
+        with self.assertRaises(ValueError):
+            archive.check_compress_level('gz', 15)
+
     def _test_compress_lzo(self):
         """Test compress format: lzo"""
         for file_item in self.files:
@@ -218,6 +255,33 @@ class ArchiveTest(unittest.TestCase):
             archive.decompress(output_name)
             self.assertTrue(os.path.exists(file_item))
 
+    @unittest.skipUnless(archive.which("xz"), "xz is not installed")
+    def test_decompress_xz_no_compress_format(self):
+        """Test decompress
+            Format: xz
+            one parameters is given, only target file"""
+        for file_item in self.files:
+            output_name = archive.compress(file_item, 'xz')
+            self.assertEqual('%s.xz' % file_item, output_name)
+            self.assertTrue(os.path.exists(output_name))
+            self.assertFalse(os.path.exists(file_item))
+            archive.decompress(output_name)
+            self.assertTrue(os.path.exists(file_item))
+
+    @unittest.skipUnless(archive.which("zstd"), "zstd is not installed")
+    def test_decompress_zst_no_compress_format(self):
+        """Test decompress
+            Format: zst
+            one parameters is given, only target file"""
+        for file_item in self.files:
+            output_name = archive.compress(file_item, 'zst')
+            self.assertEqual('%s.zst' % file_item, output_name)
+            self.assertTrue(os.path.exists(output_name))
+            self.assertFalse(os.path.exists(file_item))
+            archive.decompress(output_name)
+            self.assertTrue(os.path.exists(file_item))
+            self.assertFalse(os.path.exists(output_name))
+
     def _test_decompress_lzo(self):
         """Test decompress
             Format: lzo
@@ -248,7 +312,8 @@ class ArchiveTest(unittest.TestCase):
         archive_formats = archive.get_archive_formats()
         archive_formats.sort()
         self.assertEqual(archive_formats,
-                        ["bztar", "gztar", "lzotar", "tar", 'zip'])
+                        ["bztar", "gztar", "lzotar", "tar", "xztar", "zip",
+                         "zsttar"])
 
     def test_get_archive_suffixes(self):
         """Test get archive suffixes"""
@@ -257,7 +322,8 @@ class ArchiveTest(unittest.TestCase):
 
         self.assertEqual(archive_suffixes,
                          ['.tar', '.tar.bz', '.tar.bz2', '.tar.gz', '.tar.lzo',
-                         '.taz', '.tbz', '.tbz2', '.tgz', '.tzo', '.zip'])
+                         '.tar.xz', '.tar.zst', '.taz', '.tbz', '.tbz2',
+                         '.tgz', '.txz', '.tzo', '.tzst', '.zip'])
 
     def test_make_archive_negtive_archive_name_is_required(self):
         """Test if first parameter: file path is empty"""
@@ -536,6 +602,30 @@ class ArchiveTest(unittest.TestCase):
             self.assertTrue(os.path.exists(os.path.join(out_dir, item)))
             shutil.rmtree(out_dir)
 
+    @unittest.skipUnless(archive.which("xz"), "xz is not installed")
+    def test_make_archive_tar_xz(self):
+        """ Test make_archive format: tar.xz"""
+        for item in self.files + self.dirs:
+            out_file = '%s.tar.xz' % item
+            self.assertTrue(archive.make_archive(out_file, item, 1, 2))
+            self.assertTrue(os.path.exists(out_file))
+            os.remove(out_file)
+
+    @unittest.skipUnless(archive.which("zstd"), "zstd is not installed")
+    def test_extract_archive_tar_zst(self):
+        """ Test make_archive and extract_archive format: tar.zst"""
+        for item in self.dirs:
+            out_file = 'df.tar.zst'
+            self.assertTrue(archive.make_archive(out_file, item))
+            self.assertTrue(os.path.exists(out_file))
+
+            out_dir = 'un_tar_dir'
+            archive.extract_archive(out_file, out_dir)
+            self.assertTrue(os.path.exists(os.path.join(out_dir, '1.txt')))
+            self.assertTrue(os.path.exists(os.path.join(out_dir, 'dir1')))
+            shutil.rmtree(out_dir)
+            os.remove(out_file)
+
     def test_make_archive_tbz_with_different_name(self):
         """ Test make_archive format: tbz
             It packs the source with another name"""
@@ -652,5 +742,72 @@ class ArchiveTest(unittest.TestCase):
             self.assertTrue(os.path.exists(os.path.join(out_dir, item)))
             shutil.rmtree(out_dir)
 
+
+class CompressBenchmark(unittest.TestCase):
+    """
+        compare the compression ratio against the wall time of the formats
+    """
+    SAMPLE_SIZE = 8 * 1024 * 1024
+
+    def setUp(self):
+        """Create a sample looking like a disk image: text, random data
+        and zeroes"""
+        self.sample = './benchmark.img'
+        chunk = ''.join('line %d of some text data\n' % i
+                        for i in xrange(4096))
+        with open(self.sample, 'wb') as sample:
+            while sample.tell() < self.SAMPLE_SIZE / 2:
+                sample.write(chunk)
+            sample.write(os.urandom(self.SAMPLE_SIZE / 4))
+            sample.write('\0' * (self.SAMPLE_SIZE / 4))
+        with open(self.sample, 'rb') as sample:
+            self.data = sample.read()
+
+    def tearDown(self):
+        for path in (self.sample, self.sample + '.xz', self.sample + '.zst'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _benchmark(self, compress_format, level, threads):
+        """Compress and decompress the sample, return the compression ratio
+        and the wall time of both"""
+        size = os.path.getsize(self.sample)
+        start = time.time()
+        output_name = archive.compress(self.sample, compress_format, level,
+                                       threads)
+        compress_time = time.time() - start
+        ratio = float(size) / os.path.getsize(output_name)
+
+        start = time.time()
+        archive.decompress(output_name)
+        decompress_time = time.time() - start
+
+        with open(self.sample, 'rb') as sample:
+            self.assertEqual(sample.read(), self.data)
+        return ratio, compress_time, decompress_time
+
+    def test_benchmark(self):
+        """Benchmark the available formats at their default levels"""
+        cases = [('gz', None), ('bz2', None)]
+        if archive.which('xz'):
+            cases.extend([('xz', 1), ('xz', None)])
+        if archive.which('zstd'):
+            cases.extend([('zst', 1), ('zst', None), ('zst', 19)])
+
+        results = []
+        for compress_format, level in cases:
+            ratio, ctime, dtime = self._benchmark(compress_format, level, 0)
+            # random data can't be compressed, but the rest can
+            self.assertTrue(ratio > 1.2)
+            results.append((compress_format, level, ratio, ctime, dtime))
+
+        print
+        print '%-6s %-7s %8s %11s %13s' % ('format', 'level', 'ratio',
+                                          'compress', 'decompress')
+        for compress_format, level, ratio, ctime, dtime in results:
+            print '%-6s %-7s %8.2f %10.3fs %12.3fs' % (compress_format,
+                                                     level or 'default',
+                                                     ratio, ctime, dtime)
+
 if __name__ == "__main__":
     unittest.main()
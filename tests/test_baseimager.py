@@ -7,11 +7,12 @@ import glob
 import shutil
 import StringIO
 import subprocess
+import tempfile
 import unittest
 from mic import plugin as pluginmgr
 from mic import conf as configmgr
 from mic import msger
-from mic.imager import fs
+from mic.imager import fs, baseimager
 
 CWD = os.path.dirname(__file__) or '.'
 TEST_BASEIMGR_LOC = os.path.join(CWD, 'baseimgr_fixtures')
@@ -22,7 +23,8 @@ CACHEDIR = os.path.join(CWD, 'baseimgr_fixtures', 'cache')
 RPMLOCK_PATH = None
 
 def suite():
-    return unittest.makeSuite(BaseImgrTest)
+    return unittest.TestSuite([unittest.makeSuite(BaseImgrTest),
+                               unittest.makeSuite(PackToTest)])
 
 class BaseImgrTest(unittest.TestCase):
 
@@ -137,6 +139,26 @@ if os.getuid == 0:
     def testBaseImagerYum(self):
         self.BaseImager('yum')
 
+class PackToTest(unittest.TestCase):
+
+    def testPackTo(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for name, expected in (("img.tar.xz", "img.tar.xz"),
+                                   ("img.tar.zst", "img.tar.zst"),
+                                   ("img.tgz", "img.tgz"),
+                                   ("img.zip", "img.zip"),
+                                   ("img.xz", "img.xz.tar"),
+                                   ("@NAME@", "test.tar")):
+                creator = baseimager.BaseImageCreator({'name': 'test',
+                                                       'pack_to': name,
+                                                       'destdir': tmpdir,
+                                                       'tmpdir': tmpdir,
+                                                       'cachedir': tmpdir})
+                self.assertEqual(expected, creator.pack_to)
+        finally:
+            shutil.rmtree(tmpdir)
+
 if __name__ == "__main__":
     if os.getuid() != 0:
         raise SystemExit("Root permission is needed")
@@ -58,6 +58,8 @@ class ConfigMgrTest(unittest.TestCase):
         cachedir = self.configmgr.create['cachedir']
         repomd = [{'baseurl': 'file://%s' % REPOURI ,
              'cachedir': '%s' % cachedir,
+             'checksums': {'primary': '1d475a2af9b29cda28eaace008cd130301e6a2'
+                                      'e175735b0119e6e5bdbc16cd21'},
              'comps': None,
              'name': 'test',
              'patterns': None,
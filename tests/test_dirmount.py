@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import unittest
+from mic.utils import runner
+from mic.utils.fs_related import find_binary_path, FileDisk, ExtDirMount
+from mic.utils.errors import CreatorError
+from mic.utils.partitionedfs import PartitionedMount
+
+def suite():
+    return unittest.makeSuite(DirMountTest)
+
+def _has_binaries(*binaries):
+    try:
+        for binary in binaries:
+            find_binary_path(binary)
+    except CreatorError:
+        return False
+    return True
+
+def _fill_tree(path, count = 64):
+    for index in range(count):
+        subdir = os.path.join(path, "dir%d" % (index % 8))
+        if not os.path.isdir(subdir):
+            os.makedirs(subdir)
+        with open(os.path.join(subdir, "file%d" % index), "wb") as fobj:
+            fobj.write(os.urandom(index * 1024))
+    os.symlink("dir0/file1", os.path.join(path, "link"))
+
+@unittest.skipIf(not _has_binaries("mkfs.ext4", "e2fsck", "debugfs"),
+                 "e2fsprogs are not installed")
+class DirMountTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.tree = os.path.join(self.tmpdir, "root")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _fsck(self, device):
+        return runner.runtool(["e2fsck", "-f", "-n", device], catch=0)[0]
+
+    def _ls(self, device, path):
+        out = runner.outs(["debugfs", "-R", "ls -p %s" % path, device])
+        names = [line.split("/")[5] for line in out.splitlines()
+                 if line.startswith("/")]
+        return sorted(set(names) - set([".", "..", "lost+found"]))
+
+    def testMinimalImage(self):
+        image = os.path.join(self.tmpdir, "root.img")
+        mount = ExtDirMount(FileDisk(image, 1024 * 1024 * 1024), self.tree,
+                            "ext4", 4096, "platform")
+        mount.mount()
+        _fill_tree(self.tree)
+
+        size = mount.build(0)
+        self.assertEqual(size, os.path.getsize(image))
+        self.assertTrue(size < 64 * 1024 * 1024)
+        self.assertEqual(0, self._fsck(image))
+        self.assertEqual(["dir%d" % index for index in range(8)] + ["link"],
+                         self._ls(image, "/"))
+
+    def testPartitions(self):
+        pmount = PartitionedMount(self.tree, from_dir = True)
+        pmount.add_partition(8, "sda", "/boot", "ext2", "boot")
+        pmount.add_partition(32, "sda", "/", "ext4", "platform")
+        pmount.layout_partitions("gpt")
+        disk = FileDisk(os.path.join(self.tmpdir, "sda.raw"),
+                        pmount.disks["sda"]["min_size"])
+        pmount.add_disk("sda", disk)
+
+        pmount.mount()
+        _fill_tree(self.tree, 16)
+        with open(os.path.join(self.tree, "boot", "vmlinuz"), "wb") as fobj:
+            fobj.write(os.urandom(4096))
+        pmount.unmount()
+        pmount.resparse()
+
+        self.assertEqual(pmount.disks["sda"]["min_size"],
+                         os.path.getsize(disk.lofile))
+        boot, root = ["%s?offset=%d" % (disk.lofile, p['start'] * 512)
+                      for p in pmount.partitions]
+        self.assertEqual(0, self._fsck(boot))
+        self.assertEqual(0, self._fsck(root))
+        self.assertEqual(["vmlinuz"], self._ls(boot, "/"))
+        self.assertEqual([], self._ls(root, "/boot"))
+        self.assertTrue("link" in self._ls(root, "/"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,176 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from mic.utils import runner
+from mic.utils.fs_related import find_binary_path
+from mic.utils.errors import CreatorError, MountError
+from mic.utils.gpt_parser import GptParser, PartitionTableWriter, \
+                                 GPT_LEGACY_BOOT, GPT_TYPE_LINUX, \
+                                 GPT_TYPE_SWAP, GPT_TYPE_BASIC_DATA
+
+DISK_SECTORS = 64 * 1024
+CUSTOM_TYPE = "21686148-6449-6E6F-744E-656564454649"
+
+def suite():
+    return unittest.makeSuite(GptParserTest)
+
+def _find_parted():
+    try:
+        return find_binary_path("parted")
+    except CreatorError:
+        return None
+
+def _partition(num, start, size, fstype = "ext4", boot = False,
+               ptype = "primary", part_type = None):
+    return {'num': num, 'type': ptype, 'start': start, 'size': size,
+            'fstype': fstype, 'boot': boot, 'part_type': part_type,
+            'partuuid': None}
+
+def _gpt_partitions():
+    return [_partition(1, 2048, 8192, "vfat", boot = True),
+            _partition(2, 10240, 32768),
+            _partition(3, 43008, 4096, part_type = CUSTOM_TYPE),
+            _partition(4, 47104, 8192, "swap")]
+
+def _msdos_partitions():
+    # as laid out by PartitionedMount: the 3rd partition and the logical
+    # ones give their last sector to the EBR of the next logical partition
+    return [_partition(1, 1, 8191, "vfat", boot = True),
+            _partition(2, 8192, 16384),
+            _partition(3, 24576, 8191),
+            _partition(5, 32768, 8191, ptype = "logical"),
+            _partition(6, 40960, 4095, "swap", ptype = "logical")]
+
+def _parse_mbr_entries(sector):
+    entries = []
+    for index in range(4):
+        offs = 446 + index * 16
+        status, ptype, start, size = struct.unpack("<B3xB3xII",
+                                                   sector[offs:offs + 16])
+        entries.append((status, ptype, start, size))
+    return entries
+
+class GptParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.disk = os.path.join(self.tmpdir, "disk.raw")
+        with open(self.disk, "wb") as fobj:
+            fobj.truncate(DISK_SECTORS * 512)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _read_sector(self, lba):
+        with open(self.disk, "rb") as fobj:
+            fobj.seek(lba * 512)
+            return fobj.read(512)
+
+    def _parted_print(self):
+        """ Return [(num, start, end, flags)] as printed by parted """
+        out = runner.outs([_find_parted(), "-s", "-m", self.disk,
+                           "unit", "s", "print"])
+        result = []
+        for line in out.splitlines()[2:]:
+            fields = line.rstrip(";").split(":")
+            result.append((int(fields[0]), int(fields[1].rstrip("s")),
+                           int(fields[2].rstrip("s")), fields[-1]))
+        return result
+
+    def testGptRoundTrip(self):
+        partitions = _gpt_partitions()
+        PartitionTableWriter(self.disk).write("gpt", partitions)
+
+        pmbr = _parse_mbr_entries(self._read_sector(0))
+        self.assertEqual((0, 0xEE, 1, DISK_SECTORS - 1), pmbr[0])
+        self.assertEqual(self._read_sector(0)[510:], '\x55\xAA')
+
+        parser = GptParser(self.disk)
+        for primary in (True, False):
+            header = parser.read_header(primary)
+            self.assertEqual(34, header['first_lba'])
+            self.assertEqual(DISK_SECTORS - 34, header['last_lba'])
+            entries = list(parser.get_partitions(primary))
+            self.assertEqual(len(partitions), len(entries))
+            for p, entry in zip(partitions, entries):
+                self.assertEqual(p['num'], entry['index'] + 1)
+                self.assertEqual(p['start'], entry['first_lba'])
+                self.assertEqual(p['start'] + p['size'] - 1,
+                                 entry['last_lba'])
+                self.assertEqual(p['partuuid'], entry['part_uuid'])
+                self.assertEqual("primary", entry['name'])
+
+        entries = list(parser.get_partitions())
+        self.assertEqual(GPT_TYPE_BASIC_DATA, entries[0]['type_uuid'])
+        self.assertEqual(GPT_LEGACY_BOOT, entries[0]['flags'])
+        self.assertEqual(GPT_TYPE_LINUX, entries[1]['type_uuid'])
+        self.assertEqual(0, entries[1]['flags'])
+        self.assertEqual(CUSTOM_TYPE, entries[2]['type_uuid'])
+        self.assertEqual(GPT_TYPE_SWAP, entries[3]['type_uuid'])
+        self.assertEqual(len(set(p['partuuid'] for p in partitions)),
+                         len(partitions))
+
+    def testGptOutOfDisk(self):
+        partitions = [_partition(1, 2048, DISK_SECTORS - 2048)]
+        writer = PartitionTableWriter(self.disk)
+        self.assertRaises(MountError, writer.write, "gpt", partitions)
+
+    def testMsdosChain(self):
+        partitions = _msdos_partitions()
+        PartitionTableWriter(self.disk).write("msdos", partitions)
+
+        mbr = self._read_sector(0)
+        self.assertEqual(mbr[510:], '\x55\xAA')
+        self.assertEqual([(0x80, 0x0C, 1, 8191),
+                          (0, 0x83, 8192, 16384),
+                          (0, 0x83, 24576, 8191),
+                          (0, 0x0F, 32767, 40960 + 4095 - 32767)],
+                         _parse_mbr_entries(mbr))
+
+        # walk the EBR chain
+        ext_start = ebr = 32767
+        logicals = []
+        while True:
+            sector = self._read_sector(ebr)
+            self.assertEqual(sector[510:], '\x55\xAA')
+            entries = _parse_mbr_entries(sector)
+            logicals.append((entries[0][1], ebr + entries[0][2],
+                             entries[0][3]))
+            if not entries[1][3]:
+                break
+            self.assertEqual(0x0F, entries[1][1])
+            ebr = ext_start + entries[1][2]
+
+        self.assertEqual([(0x83, 32768, 8191), (0x82, 40960, 4095)],
+                         logicals)
+
+    @unittest.skipIf(_find_parted() is None, "parted is not installed")
+    def testGptAgainstParted(self):
+        partitions = _gpt_partitions()
+        PartitionTableWriter(self.disk).write("gpt", partitions)
+
+        printed = self._parted_print()
+        self.assertEqual([(p['num'], p['start'], p['start'] + p['size'] - 1)
+                          for p in partitions],
+                         [item[:3] for item in printed])
+        self.assertTrue("legacy_boot" in printed[0][3])
+
+    @unittest.skipIf(_find_parted() is None, "parted is not installed")
+    def testMsdosAgainstParted(self):
+        partitions = _msdos_partitions()
+        PartitionTableWriter(self.disk).write("msdos", partitions)
+
+        expected = [(p['num'], p['start'], p['start'] + p['size'] - 1)
+                    for p in partitions]
+        # the extended partition
+        expected.insert(3, (4, 32767, 40960 + 4095 - 1))
+        printed = self._parted_print()
+        self.assertEqual(expected, [item[:3] for item in printed])
+        self.assertTrue("boot" in printed[0][3])
+
+if __name__ == "__main__":
+    unittest.main()
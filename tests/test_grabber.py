@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+import time
+import unittest
+from mic.utils import grabber
+
+def suite():
+    return unittest.makeSuite(URLSessionPoolTest)
+
+class FakeSession(object):
+
+    def __init__(self, key, age = 0):
+        self.key = key
+        self.last_used = time.time() - age
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class URLSessionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = grabber.URLSessionPool(max_idle = 2, idle_timeout = 60)
+
+    def tearDown(self):
+        self.pool.close_all()
+
+    def _idle(self):
+        return sorted(self.pool._idle_sessions(),
+                      key = lambda session: session.last_used)
+
+    def testReuse(self):
+        session = FakeSession(("http", "example.com:80", None))
+        self.pool.release(session)
+        self.assertEqual([session], self._idle())
+
+        # the user info doesn't change the server
+        self.assertTrue(self.pool.acquire(
+            "http://user@example.com:80/repo/primary.xml") is session)
+        self.assertEqual([], self._idle())
+        self.assertFalse(session.closed)
+
+    def testNotReusable(self):
+        session = FakeSession(("http", "example.com", None))
+        self.pool.release(session, reusable = False)
+        self.assertTrue(session.closed)
+        self.assertEqual([], self._idle())
+        self.assertEqual(0, self.pool.stats["evicted"])
+
+    def testIdleTimeout(self):
+        old = FakeSession(("http", "old.example.com", None), 120)
+        new = FakeSession(("http", "new.example.com", None), 10)
+        self.pool.release(old)
+        self.pool.release(new)
+        self.assertTrue(old.closed)
+        self.assertFalse(new.closed)
+        self.assertEqual([new], self._idle())
+        self.assertEqual(1, self.pool.stats["evicted"])
+
+    def testMaxIdle(self):
+        sessions = [FakeSession(("http", "example.com", None), 40 - index)
+                    for index in range(4)]
+        for session in sessions:
+            self.pool.release(session)
+
+        # the least recently used ones are evicted
+        self.assertEqual(sessions[2:], self._idle())
+        self.assertEqual([True, True, False, False],
+                         [session.closed for session in sessions])
+        self.assertEqual(2, self.pool.stats["evicted"])
+
+        # the most recently used one is reused first
+        self.assertTrue(self.pool.acquire("http://example.com/")
+                        is sessions[3])
+
+    def testCloseAll(self):
+        sessions = [FakeSession(("http", "example.com", None)),
+                    FakeSession(("https", "example.com", None))]
+        for session in sessions:
+            self.pool.release(session)
+        self.pool.close_all()
+        self.assertEqual([], self._idle())
+        self.assertTrue(all(session.closed for session in sessions))
+
+    def testCounters(self):
+        self.pool.record(True)
+        self.pool.record(False)
+        self.pool.record(False)
+        self.assertEqual({"downloads": 3, "connections": 1, "reused": 2,
+                          "evicted": 0}, self.pool.stats)
+
+        self.pool.merge_stats([{"downloads": 2, "connections": 2},
+                               {"evicted": 1}])
+        self.assertEqual({"downloads": 5, "connections": 3, "reused": 2,
+                          "evicted": 1}, self.pool.stats)
+
+    @unittest.skipIf(grabber.pycurl is None, "pycurl isn't available")
+    def testProxyKey(self):
+        session = FakeSession(("http", "example.com", None))
+        self.pool.release(session)
+
+        other = self.pool.acquire("http://example.com/", "http://proxy:3128")
+        try:
+            self.assertFalse(other is session)
+            self.assertEqual(("http", "example.com", "http://proxy:3128"),
+                             other.key)
+            self.assertEqual([session], self._idle())
+        finally:
+            other.close()
+
+if __name__ == "__main__":
+    unittest.main()
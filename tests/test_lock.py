@@ -0,0 +1,54 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import unittest
+from mic.utils.lock import SimpleLockfile, LockfileError
+
+def suite():
+    return unittest.makeSuite(LockfileTest)
+
+class LockfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "test.lock")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _dead_pid(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        return pid
+
+    def testOwner(self):
+        lock = SimpleLockfile(self.path)
+        lock.acquire()
+        self.assertEqual("%d" % os.getpid(), open(self.path).read().strip())
+        self.assertRaises(LockfileError, SimpleLockfile(self.path).acquire)
+        lock.release()
+        self.assertFalse(os.path.exists(self.path))
+
+    def testWaitLiveOwner(self):
+        lock = SimpleLockfile(self.path)
+        lock.acquire()
+        self.assertRaises(LockfileError,
+                          SimpleLockfile(self.path).wait_acquire, 0.2)
+        lock.release()
+
+    def testBreakDeadOwner(self):
+        with open(self.path, "w") as fobj:
+            fobj.write("%d\n" % self._dead_pid())
+        lock = SimpleLockfile(self.path)
+        lock.wait_acquire(0.2)
+        self.assertTrue(lock.locked)
+        self.assertEqual("%d" % os.getpid(), open(self.path).read().strip())
+        self.assertEqual(["test.lock"], os.listdir(self.tmpdir))
+        lock.release()
+
+if __name__ == "__main__":
+    unittest.main()
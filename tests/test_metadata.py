@@ -0,0 +1,142 @@
+#!/usr/bin/python
+
+import os
+import bz2
+import gzip
+import shutil
+import hashlib
+import tempfile
+import unittest
+import subprocess
+import StringIO
+from mic.archive import which
+from mic.utils import misc
+from mic.utils.errors import CreatorError
+
+def suite():
+    return unittest.makeSuite(MetadataTest)
+
+def _gzip(data):
+    buf = StringIO.StringIO()
+    fobj = gzip.GzipFile(fileobj = buf, mode = "wb")
+    fobj.write(data)
+    fobj.close()
+    return buf.getvalue()
+
+def _command(cmd, data):
+    proc = subprocess.Popen(cmd, stdin = subprocess.PIPE,
+                            stdout = subprocess.PIPE)
+    return proc.communicate(data)[0]
+
+def _can_compress(suffix):
+    module = {".xz": misc.lzma, ".zst": misc.zstandard}[suffix]
+    command = misc.METADATA_DECOMPRESS_COMMANDS[suffix][0]
+    return module is not None or which(command) is not None
+
+_COMPRESSORS = {
+    "": lambda data: data,
+    ".gz": _gzip,
+    ".bz2": bz2.compress,
+    ".xz": lambda data: _command(["xz", "-c"], data),
+    ".zst": lambda data: _command(["zstd", "-c", "-q"], data),
+}
+
+# the compressors of the test data which aren't python modules
+_COMMANDS = {".xz": "xz", ".zst": "zstd"}
+
+class MetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "primary.xml")
+        self.data = "".join("<package name=\"pkg%d\"/>\n" % index
+                            for index in range(20000))
+        self.checksum = hashlib.sha256(self.data).hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _stream(self, compressed, suffix, checksum = None, **kwargs):
+        return misc._stream_metadata(StringIO.StringIO(compressed),
+                                     self.filename, suffix, "sha256",
+                                     checksum or self.checksum, **kwargs)
+
+    def _check_stored(self):
+        self.assertEqual(self.data, open(self.filename, "rb").read())
+        self.assertEqual(("sha256", self.checksum),
+                         misc._read_metadata_checksum(self.filename))
+        self.assertTrue(misc._is_metadata_cached(self.filename, "sha256",
+                                                 self.checksum))
+        self.assertEqual(sorted(["primary.xml", "primary.xml.checksum"]),
+                         sorted(name for name in os.listdir(self.tmpdir)
+                                if name.startswith("primary.xml")))
+
+    def _test_suffix(self, suffix, streams = 1):
+        if suffix in _COMMANDS and not which(_COMMANDS[suffix]):
+            self.skipTest("%s isn't installed" % _COMMANDS[suffix])
+        size = len(self.data) // streams + 1
+        compressed = "".join(_COMPRESSORS[suffix](self.data[i:i + size])
+                             for i in range(0, len(self.data), size))
+        self.assertEqual(self.filename, self._stream(compressed, suffix))
+        self._check_stored()
+
+    def testPlain(self):
+        self._test_suffix("")
+
+    def testGzip(self):
+        self._test_suffix(".gz")
+
+    def testGzipStreams(self):
+        self._test_suffix(".gz", 3)
+
+    def testBzip2Streams(self):
+        self._test_suffix(".bz2", 3)
+
+    def testXz(self):
+        self._test_suffix(".xz")
+
+    def testZstd(self):
+        self._test_suffix(".zst")
+
+    def testXzStreams(self):
+        self._test_suffix(".xz", 3)
+
+    def testZstdStreams(self):
+        self._test_suffix(".zst", 3)
+
+    def testMismatch(self):
+        self._stream(_gzip(self.data), ".gz")
+        with self.assertRaises(CreatorError):
+            self._stream(_gzip("other data"), ".gz")
+        # the stored file is only replaced once verified
+        self._check_stored()
+
+    def testCorrupt(self):
+        for suffix in (".gz", ".bz2", ".xz", ".zst"):
+            if suffix in (".xz", ".zst") and not _can_compress(suffix):
+                continue
+            with self.assertRaises(CreatorError):
+                self._stream("\xff" * 4096, suffix)
+            self.assertFalse(os.listdir(self.tmpdir))
+
+    def testRaw(self):
+        compressed = _gzip(self.data)
+        rawname = os.path.join(self.tmpdir, "primary.xml.gz")
+        raw_checksum = hashlib.sha256(compressed).hexdigest()
+        self._stream(compressed, ".gz", rawname = rawname,
+                     raw_sumtype = "sha256", raw_checksum = raw_checksum)
+        self.assertEqual(compressed, open(rawname, "rb").read())
+        self.assertTrue(misc._is_metadata_cached(rawname, "sha256",
+                                                 raw_checksum))
+
+    def testLegacyCache(self):
+        with open(self.filename, "wb") as fobj:
+            fobj.write(self.data)
+        self.assertFalse(misc._is_metadata_cached(self.filename, "sha256",
+                                                  "0" * 64))
+        self.assertTrue(misc._is_metadata_cached(self.filename, "sha256",
+                                                 self.checksum))
+        self._check_stored()
+
+if __name__ == "__main__":
+    unittest.main()
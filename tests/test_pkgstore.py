@@ -0,0 +1,61 @@
+#!/usr/bin/python
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import unittest
+from mic.utils import pkgstore
+
+def suite():
+    return unittest.makeSuite(PackageStoreTest)
+
+class PackageStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = pkgstore.PackageStore(self.tmpdir)
+        self.repodir = os.path.join(self.tmpdir, "packages", "repo")
+        os.makedirs(self.repodir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _add(self, name, data):
+        path = os.path.join(self.repodir, name)
+        with open(path, "wb") as fobj:
+            fobj.write(data)
+        self.assertTrue(self.store.add("sha256",
+                                       hashlib.sha256(data).hexdigest(),
+                                       path))
+        return path
+
+    def testPruneGrace(self):
+        for index in range(3):
+            self._add("pkg%d.rpm" % index, "%d" % index * 100)
+
+        # just used, possibly by concurrent builds
+        self.assertEqual((0, 0), self.store.prune(150))
+
+        old = time.time() - 2 * pkgstore.PRUNE_GRACE
+        for index, (path, _, _) in enumerate(self.store._iter_objects()):
+            if index < 2:
+                os.utime(path, (old, old))
+        self.assertEqual((2, 200), self.store.prune(150))
+        self.assertEqual(1, self.store.stats()["count"])
+        self.assertEqual(1, len(os.listdir(self.repodir)))
+
+    def testPruneRemoved(self):
+        path = self._add("pkg.rpm", "data")
+        old = time.time() - 2 * pkgstore.PRUNE_GRACE
+        objects = list(self.store._iter_objects())
+        os.utime(objects[0][0], (old, old))
+        # removed by a concurrent build since it was listed
+        self.store._iter_objects = lambda: iter(objects)
+        os.unlink(objects[0][0])
+        os.unlink(path)
+        self.assertEqual((0, 0), self.store.prune(0))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import struct
+import hashlib
+import tempfile
+import unittest
+from mic.utils import rpmmisc
+from mic.utils.errors import CreatorError
+
+CWD = os.path.dirname(__file__) or '.'
+FIXTURE = os.path.join(CWD, 'baseimgr_fixtures', 'i586', 'A-0.1-1.i586.rpm')
+
+RPMTAG_NAME = 1000
+
+def suite():
+    return unittest.makeSuite(RpmDigestTest)
+
+def _header(entries):
+    """ Build a header structure of (tag, type, value) entries """
+    index = store = ""
+    for tag, typ, value in entries:
+        if typ == rpmmisc._RPM_INT32_TYPE:
+            data, count = struct.pack(">%dI" % len(value), *value), len(value)
+        elif typ == rpmmisc._RPM_STRING_TYPE:
+            data, count = value + "\0", 1
+        elif typ == rpmmisc._RPM_STRING_ARRAY_TYPE:
+            data, count = "".join(s + "\0" for s in value), len(value)
+        else:
+            data, count = value, len(value)
+        index += struct.pack(">IIII", tag, typ, len(store), count)
+        store += data
+
+    return (rpmmisc._RPM_HEADER_MAGIC + "\x01\0\0\0\0" +
+            struct.pack(">II", len(entries), len(store)) + index + store)
+
+def _package(payload, sigtags = ("size", "md5", "sha1", "sha256"),
+             payloaddigest = None):
+    """ Build the content of an rpm package, whose signature header has
+    'sigtags' and whose main header records 'payloaddigest' if not None """
+    entries = [(RPMTAG_NAME, rpmmisc._RPM_STRING_TYPE, "test")]
+    if payloaddigest is not None:
+        entries += [(rpmmisc._RPMTAG_PAYLOADDIGEST,
+                     rpmmisc._RPM_STRING_ARRAY_TYPE, [payloaddigest]),
+                    (rpmmisc._RPMTAG_PAYLOADDIGESTALGO,
+                     rpmmisc._RPM_INT32_TYPE, [8])]
+    header = _header(entries)
+
+    values = {
+        "size": (rpmmisc._RPMSIGTAG_SIZE, rpmmisc._RPM_INT32_TYPE,
+                 [len(header + payload)]),
+        "md5": (rpmmisc._RPMSIGTAG_MD5, rpmmisc._RPM_BIN_TYPE,
+                hashlib.md5(header + payload).digest()),
+        "sha1": (rpmmisc._RPMSIGTAG_SHA1, rpmmisc._RPM_STRING_TYPE,
+                 hashlib.sha1(header).hexdigest()),
+        "sha256": (rpmmisc._RPMSIGTAG_SHA256, rpmmisc._RPM_STRING_TYPE,
+                   hashlib.sha256(header).hexdigest()),
+    }
+    signature = _header([values[name] for name in sigtags])
+    padding = "\0" * ((8 - len(signature) % 8) % 8)
+
+    lead = rpmmisc._RPM_LEAD_MAGIC + "\0" * (rpmmisc._RPM_LEAD_SIZE - 4)
+    return lead + signature + padding + header + payload
+
+class RpmDigestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "test-0.1-1.noarch.rpm")
+        self.payload = "payload" * 1000
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, data):
+        with open(self.path, "wb") as fobj:
+            fobj.write(data)
+        return self.path
+
+    def testFixture(self):
+        with open(FIXTURE, "rb") as fobj:
+            data = fobj.read()
+
+        # the main header follows the padded signature header
+        il, dl = struct.unpack(">II", data[104:112])
+        start = 96 + 16 + 16 * il + dl
+        start += (8 - start % 8) % 8
+        il, dl = struct.unpack(">II", data[start + 8:start + 16])
+        header = data[start:start + 16 + 16 * il + dl]
+
+        self.assertEqual(hashlib.sha1(header).hexdigest(),
+                         rpmmisc.verifyRpmDigests(FIXTURE))
+
+    def testDigests(self):
+        path = self._write(_package(self.payload))
+        digest = rpmmisc.verifyRpmDigests(path)
+
+        # the strongest header digest is returned
+        entries = [(RPMTAG_NAME, rpmmisc._RPM_STRING_TYPE, "test")]
+        self.assertEqual(hashlib.sha256(_header(entries)).hexdigest(),
+                         digest)
+
+    def testMD5Only(self):
+        path = self._write(_package(self.payload, sigtags = ("md5", )))
+        entries = [(RPMTAG_NAME, rpmmisc._RPM_STRING_TYPE, "test")]
+        digest = hashlib.md5(_header(entries) + self.payload).hexdigest()
+        self.assertEqual(digest, rpmmisc.verifyRpmDigests(path))
+
+    def testPayloadDigest(self):
+        digest = hashlib.sha256(self.payload).hexdigest()
+        path = self._write(_package(self.payload, payloaddigest = digest))
+        self.assertTrue(rpmmisc.verifyRpmDigests(path))
+
+        path = self._write(_package(self.payload, payloaddigest = "0" * 64))
+        self.assertRaisesRegexp(CreatorError, "payload digest mismatch",
+                                rpmmisc.verifyRpmDigests, path)
+
+    def testCorruptPayload(self):
+        data = _package(self.payload)
+        path = self._write(data[:-1] + "X")
+        self.assertRaisesRegexp(CreatorError, "MD5 digest mismatch",
+                                rpmmisc.verifyRpmDigests, path)
+
+    def testCorruptHeader(self):
+        data = _package(self.payload)
+        offset = data.rindex("test\0")
+        path = self._write(data[:offset] + "TEST" + data[offset + 4:])
+        self.assertRaisesRegexp(CreatorError, "header SHA256 digest mismatch",
+                                rpmmisc.verifyRpmDigests, path)
+
+    def testTruncated(self):
+        data = _package(self.payload)
+        path = self._write(data[:-10])
+        self.assertRaisesRegexp(CreatorError, "size mismatch",
+                                rpmmisc.verifyRpmDigests, path)
+
+        path = self._write(data[:rpmmisc._RPM_LEAD_SIZE + 20])
+        self.assertRaisesRegexp(CreatorError, "truncated header",
+                                rpmmisc.verifyRpmDigests, path)
+
+    def testBadLead(self):
+        path = self._write("not an rpm package" * 10)
+        self.assertRaisesRegexp(CreatorError, "bad rpm lead",
+                                rpmmisc.verifyRpmDigests, path)
+
+    def testNoDigest(self):
+        path = self._write(_package(self.payload, sigtags = ("size", )))
+        self.assertRaises(rpmmisc.RpmDigestError,
+                          rpmmisc.verifyRpmDigests, path)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -47,6 +47,39 @@ class RunnerTest(unittest.TestCase):
         self.assertEqual(0, rc)
         self.assertEqual("hello\n", out)
 
+    def testStream(self):
+        lines = []
+        (rc, tail) = runner.stream("seq 1 5; echo err >&2; exit 3",
+                                   lines.append, tail=2)
+        self.assertEqual(3, rc)
+        self.assertEqual(['1', '2', '3', '4', '5', 'err'], lines)
+        self.assertEqual(['5', 'err'], tail)
+
+    def testShowOutsQuiet(self):
+        self.assertEqual(0, runner.show("echo hello"))
+        self.assertEqual(1, runner.show(["false"]))
+        self.assertEqual("hello", runner.outs("echo hello"))
+        self.assertEqual(0, runner.quiet("echo hello"))
+
+    def testHistory(self):
+        runner.clear_history()
+        runner.show("seq 1 1000")
+        runner.outs(["echo", "hello"])
+        runner.quiet("exit 2")
+
+        records = runner.get_history()
+        self.assertEqual(["seq", "echo", "exit"],
+                         [r.command for r in records])
+        self.assertEqual([0, 0, 2], [r.returncode for r in records])
+        self.assertEqual(3893, records[0].output_bytes)
+        self.assertEqual(6, records[1].output_bytes)
+        self.assertEqual(1, len(runner.get_history("echo")))
+
+        stats = runner.get_stats()
+        self.assertEqual(1, stats["exit"]["failed"])
+        self.assertEqual(1, stats["seq"]["count"])
+        self.assertTrue(stats["seq"]["duration"] > 0)
+
 if __name__ == "__main__":
     unittest.main()
 
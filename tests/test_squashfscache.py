@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import unittest
+from mic.utils.squashfscache import SquashfsCache
+
+def suite():
+    return unittest.makeSuite(SquashfsCacheTest)
+
+class SquashfsCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = SquashfsCache(os.path.join(self.tmpdir, "cache"))
+        self.tree = os.path.join(self.tmpdir, "tree")
+        os.makedirs(os.path.join(self.tree, "LiveOS"))
+        self.image = os.path.join(self.tree, "LiveOS", "ext3fs.img")
+        with open(self.image, "wb") as fobj:
+            fobj.write(os.urandom(8192))
+            fobj.truncate(16 * 1024 * 1024)
+            fobj.seek(8 * 1024 * 1024)
+            fobj.write(os.urandom(4096))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _squash(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "wb") as fobj:
+            fobj.write(data)
+        return path
+
+    def testKey(self):
+        key = self.cache.get_key(self.tree, {"compressor": "xz"})
+        self.assertEqual(key, self.cache.get_key(self.tree,
+                                                 {"compressor": "xz",
+                                                  "processors": 4}))
+        self.assertNotEqual(key, self.cache.get_key(self.tree))
+        self.assertNotEqual(key, self.cache.get_key(self.tree,
+                                                    {"compressor": "xz",
+                                                     "block_size": "1M"}))
+
+        with open(self.image, "r+b") as fobj:
+            fobj.seek(8 * 1024 * 1024 + 100)
+            fobj.write("x")
+        self.assertNotEqual(key, self.cache.get_key(self.tree,
+                                                    {"compressor": "xz"}))
+
+    def testRestore(self):
+        key = self.cache.get_key(self.tree)
+        dst = os.path.join(self.tmpdir, "squashfs.img")
+        self.assertFalse(self.cache.restore(key, dst))
+
+        self.assertTrue(self.cache.save(key, self._squash("out.img", "sq1")))
+        self.assertTrue(self.cache.restore(key, dst))
+        self.assertEqual("sq1", open(dst, "rb").read())
+        self.assertEqual(1, self.cache.stats()['count'])
+
+    def testPrune(self):
+        self.cache.max_size = 6
+        for index in range(3):
+            self.cache.save("key%d" % index,
+                            self._squash("out%d.img" % index, "sq%d" % index))
+            os.utime(os.path.join(self.cache.snapdir, "key%d.img" % index),
+                     (index, index))
+        self.cache.prune()
+        self.assertEqual(2, self.cache.stats()['count'])
+        self.assertFalse(self.cache.restore("key0", os.path.join(self.tmpdir,
+                                                                 "dst.img")))
+
+if __name__ == "__main__":
+    unittest.main()